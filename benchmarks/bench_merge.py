@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Benchmark merge_dataframes() of derive_coverage_stats.py on a contig-heavy sample.
+
+Synthetic blast, samtools coverage, mosdepth, mapping quality and read
+length tables are built for --contigs consensus sequences (10% of them
+without a blast hit). The indexed join of merge_dataframes() is compared
+with the chained outer merges it replaced, which copied the growing table
+and ran fillna over every column after each of the four merges. Wall time
+and the peak memory allocated during the merge (tracemalloc) are reported.
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'bin'))
+
+from derive_coverage_stats import merge_dataframes  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--contigs", type=int, default=50_000,
+                        help="Number of consensus sequences (default: 50000)")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of runs of each merge, of which the fastest is kept")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def chained_merge(blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5):
+    """The merge_dataframes() implementation before the indexed join."""
+    return reduce(
+        lambda left, right: pd.merge(left, right, on="qseqid", how='outer').fillna(0),
+        [blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5]
+    )
+
+
+def make_tables(n_contigs, seed):
+    rng = np.random.default_rng(seed)
+    qseqids = np.array([f"cluster_{i}_RC{rng.integers(5, 5000)}" for i in range(n_contigs)])
+    n_hits = int(n_contigs * 0.9)
+    seq = "ACGT" * 175
+    blast_df = pd.DataFrame({
+        "sample_name": "bench",
+        "qseqid": qseqids,
+        "consensus_seq": seq,
+        "sgi": np.where(np.arange(n_contigs) < n_hits, "123456789", None),
+        "sacc": np.where(np.arange(n_contigs) < n_hits, "MZ123456.1", None),
+        "alignment_length": rng.integers(500, 900, n_contigs),
+        "pident": rng.uniform(80, 100, n_contigs),
+        "stitle": "Synthetic organism gene",
+        "qseq": seq,
+        "sseq": seq,
+        "species": "Species",
+        "target_organism_match": rng.choice(["Y", "N"], n_contigs),
+        "n_read_cont_cluster": rng.integers(5, 5000, n_contigs),
+    })
+    samtools_cov = pd.DataFrame({
+        "qseqid": qseqids[:n_hits],
+        "query_match_length": rng.integers(500, 900, n_hits),
+        "qseq_mapping_read_count": rng.integers(0, 5000, n_hits),
+        "qseq_mean_depth": rng.uniform(0, 1000, n_hits),
+        "qseq_pc_mapping_read": rng.uniform(0, 100, n_hits),
+    })
+    mosdepth_df = pd.DataFrame({
+        "qseqid": qseqids[:n_hits],
+        "qseq_pc_cov_30X": rng.uniform(0, 100, n_hits).round(1),
+    })
+    mq_df = pd.DataFrame({
+        "qseqid": qseqids[:n_hits],
+        "mean_MQ": rng.uniform(0, 60, n_hits),
+    })
+    df_passes_90_5 = pd.DataFrame({
+        "qseqid": qseqids[:n_hits],
+        "num_passing_90": rng.integers(0, 500, n_hits),
+        "pc_read_length_passes_90_5": rng.choice([True, False], n_hits),
+    })
+    return blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5
+
+
+def measure(merge, tables, repeats):
+    """Return the fastest wall time and the peak traced memory of a merge."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        merge(*tables)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    merge(*tables)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 1024 ** 2
+
+
+def main():
+    args = parse_args()
+    tables = make_tables(args.contigs, args.seed)
+    print(f"{args.contigs} consensus sequences, {len(tables[1])} with coverage statistics")
+    print(f"  {'merge':<18} {'wall':>9} {'peak memory':>12}")
+    for name, merge in (("chained outer", chained_merge), ("indexed concat", merge_dataframes)):
+        seconds, peak_mb = measure(merge, tables, args.repeats)
+        print(f"  {name:<18} {seconds:>8.3f}s {peak_mb:>9.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+"""Benchmark the Python stages in bin/ on synthetic inputs of increasing size.
+
+For each scale, synthetic inputs are generated (reads FASTA, read-to-contig
+mappings, BLAST top 10 hits, samtools coverage, mosdepth thresholds BED,
+mapping qualities and NanoStats) and the scripts are run in pipeline order
+as separate processes. Wall time and peak RSS of every run are written to a
+JSON file, which can be compared against the results of a previous release
+with --baseline.
+
+Scale 1 corresponds to a small sample of the test data (5 consensus
+sequences and 1,000 reads).
+
+The startup time of every `ont_amplicon <command>` is measured separately
+by running it with --help, which imports the command's module and exits.
+It is reported with scale 0.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+BIN_DIR = ROOT_DIR / 'bin'
+STUBS_DIR = Path(__file__).resolve().parent / 'stubs'
+
+SAMPLE = 'bench'
+BASE_CONTIGS = 5
+BASE_READS = 1000
+TARGET_SIZE = 700
+BASES = 'ACGT'
+
+BLAST_COLUMNS = [
+    "qseqid", "sgi", "sacc", "length", "nident", "pident", "mismatch", "gaps",
+    "gapopen", "qstart", "qend", "qlen", "sstart", "send", "slen", "sstrand",
+    "evalue", "bitscore", "qcovhsp", "stitle", "staxids", "qseq", "sseq",
+    "sseqid", "qcovs", "qframe", "sframe",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs='+', default=[10, 100, 1000],
+                        help="Input scales to benchmark (default: 10 100 1000)")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"),
+                        help="Path of the JSON results file")
+    parser.add_argument("--workdir", type=Path,
+                        help="Directory in which inputs are generated"
+                             " (default: a new temporary directory)")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the generated inputs and outputs")
+    parser.add_argument("--baseline", type=Path,
+                        help="Previous results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative slowdown or memory growth reported as a"
+                             " regression (default: 0.2)")
+    parser.add_argument("--startup_repeats", type=int, default=5,
+                        help="Number of runs of each command's startup benchmark,"
+                             " of which the fastest is kept (0 to skip)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choices(BASES, k=length))
+
+
+def write_inputs(workdir: Path, scale: int, seed: int) -> dict:
+    """Write the synthetic inputs of one scale and return their paths."""
+    rng = random.Random(seed)
+    workdir.mkdir(parents=True, exist_ok=True)
+    n_contigs = BASE_CONTIGS * scale
+    n_reads = BASE_READS * scale
+    paths = {
+        'consensus': workdir / f'{SAMPLE}_final_polished_consensus.fasta',
+        'consensus_match': workdir / f'{SAMPLE}_final_polished_consensus_match.fasta',
+        'top_10_hits': workdir / f'{SAMPLE}_final_polished_consensus_megablast_top_10_hits.txt',
+        'ids_to_rc': workdir / f'{SAMPLE}_ids_to_reverse_complement.txt',
+        'reads_fasta': workdir / f'{SAMPLE}.fasta',
+        'contig_seqids': workdir / f'{SAMPLE}_contigs_reads_ids.txt',
+        'coverage': workdir / f'{SAMPLE}_coverage.txt',
+        'bed': workdir / f'{SAMPLE}.thresholds.bed',
+        'mapping_quality': workdir / f'{SAMPLE}_mapq.txt',
+        'nanostat': workdir / f'{SAMPLE}_filtered_NanoStats.txt',
+        'qc_dir': workdir / 'qc',
+    }
+
+    contigs = {}
+    for i in range(n_contigs):
+        cluster_size = rng.randint(5, 5000)
+        contigs[f'cluster_{i}_RC{cluster_size}'] = random_seq(
+            rng, rng.randint(int(TARGET_SIZE * 0.8), int(TARGET_SIZE * 1.2)))
+
+    with paths['consensus'].open('w') as f, \
+            paths['consensus_match'].open('w') as match, \
+            paths['ids_to_rc'].open('w') as rc:
+        for i, (qseqid, seq) in enumerate(contigs.items()):
+            f.write(f'>{qseqid}\n{seq}\n')
+            match.write(f'>{qseqid}\n{seq}\n')
+            if i % 2:
+                rc.write(f'{qseqid}\n')
+
+    with paths['top_10_hits'].open('w') as f:
+        f.write('\t'.join(BLAST_COLUMNS) + '\n')
+        for qseqid, seq in contigs.items():
+            qlen = len(seq)
+            for hit in range(10):
+                taxid = rng.randint(1, 100_000)
+                sacc = f'MZ{rng.randint(100000, 999999)}.1'
+                pident = round(rng.uniform(80, 100), 3)
+                f.write('\t'.join(str(v) for v in [
+                    qseqid, rng.randint(1, 10**9), sacc, qlen, int(qlen * pident / 100),
+                    pident, rng.randint(0, 30), rng.randint(0, 5), rng.randint(0, 3),
+                    1, qlen, qlen, 1, qlen, qlen + rng.randint(0, 500), 'plus',
+                    f'{rng.uniform(0, 1e-50):.2e}', rng.randint(500, 1500), 100,
+                    f'Synthetic organism {taxid} gene', f'{taxid};{taxid + 1}', seq, seq,
+                    f'gb|{sacc}|', 100, 1, 1,
+                ]) + '\n')
+
+    contig_ids = list(contigs)
+    with paths['reads_fasta'].open('w') as reads, \
+            paths['contig_seqids'].open('w') as mapping:
+        for j in range(n_reads):
+            read_id = f'read_{j}'
+            length = max(50, int(rng.gauss(TARGET_SIZE, TARGET_SIZE * 0.2)))
+            reads.write(f'>{read_id}\n{random_seq(rng, length)}\n')
+            mapping.write(f'{read_id}\t{rng.choice(contig_ids)}\n')
+
+    reads_per_contig = n_reads // n_contigs
+    with paths['coverage'].open('w') as cov, \
+            paths['bed'].open('w') as bed, \
+            paths['mapping_quality'].open('w') as mq:
+        cov.write('#rname\tstartpos\tendpos\tnumreads\tcovbases\tcoverage'
+                  '\tmeandepth\tmeanbaseq\tmeanmapq\n')
+        bed.write('#chrom\tstart\tend\tregion\t30X\n')
+        for qseqid, seq in contigs.items():
+            length = len(seq)
+            cov.write(f'{qseqid}\t1\t{length}\t{reads_per_contig}\t{length}\t100'
+                      f'\t{reads_per_contig * 0.9:.2f}\t20\t60\n')
+            bed.write(f'{qseqid}\t0\t{length}\tunknown\t{rng.randint(0, length)}\n')
+            mq.write(f'{qseqid}\t{rng.uniform(0, 60):.2f}\n')
+
+    write_nanostats(paths['nanostat'], n_reads)
+    paths['qc_dir'].mkdir(exist_ok=True)
+    for i in range(scale):
+        write_nanostats(paths['qc_dir'] / f'sample{i}_raw_NanoStats.txt', n_reads * 2)
+        write_nanostats(paths['qc_dir'] / f'sample{i}_filtered_NanoStats.txt', n_reads)
+    write_nanostats(paths['qc_dir'] / f'{SAMPLE}_raw_NanoStats.txt', n_reads * 2)
+    write_nanostats(paths['qc_dir'] / f'{SAMPLE}_filtered_NanoStats.txt', n_reads)
+    return paths
+
+
+def write_nanostats(path: Path, n_reads: int):
+    path.write_text(
+        "Metrics\tdataset\n"
+        f"number_of_reads\t{n_reads}\n"
+        f"number_of_bases\t{float(n_reads * TARGET_SIZE)}\n"
+        f"n50\t{float(TARGET_SIZE)}\n"
+    )
+
+
+def write_report_inputs(result_dir: Path, paths: dict, n_reads: int, seed: int):
+    """Assemble a result directory as staged by the HTML_REPORT process."""
+    rng = random.Random(seed)
+    result_dir.mkdir(parents=True, exist_ok=True)
+    for key in ('consensus', 'consensus_match'):
+        shutil.copy(paths[key], result_dir)
+    shutil.copy(paths['top_10_hits'], result_dir)
+    shutil.copy(paths['qc_dir'] / 'run_qc_report.txt', result_dir)
+    shutil.copy(paths['qc_dir'] / 'run_qc_report.html', result_dir)
+    for path in paths['work_dir'].glob('*top_blast_with_cov_stats.txt'):
+        shutil.copy(path, result_dir)
+    # The BAM and index are only embedded as bytes, so random content is enough
+    (result_dir / f'{SAMPLE}_aln.sorted.bam').write_bytes(rng.randbytes(20 * n_reads))
+    (result_dir / f'{SAMPLE}_aln.sorted.bam.bai').write_bytes(rng.randbytes(1024))
+    for kind in ('raw', 'filtered'):
+        (result_dir / f'{SAMPLE}_{kind}_NanoPlot-report.html').write_text(
+            '<html><body>' + 'x' * n_reads + '</body></html>')
+    (result_dir / '20250101000000_nextflow_start_timestamp.txt').write_text(
+        '20250101000000\n')
+    for status in ('blast', 'rattle'):
+        (result_dir / f'{SAMPLE}_{status}_status.txt').write_text('passed\n')
+    (result_dir / 'params.yml').write_text('analyst_name: bench\n')
+    (result_dir / 'samplesheet.csv').write_text(
+        'sampleid,fastq_path,target_organism,target_gene,target_size,'
+        'fwd_primer,rev_primer,test,method\n'
+        f'{SAMPLE},/dev/null,drosophilidae,COI,{TARGET_SIZE},,,,\n'
+    )
+
+
+def run_script(name: str, args: list, cwd: Path, scale: int,
+               label: str = None, quiet: bool = False) -> dict:
+    """Run a bin/ script and return its wall time and peak RSS."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [str(STUBS_DIR), str(BIN_DIR), env.get('PYTHONPATH', '')])
+    command = [sys.executable, str(BIN_DIR / name)] + [str(a) for a in args]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # Wait for this child only, so that its own rusage is reported
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    stderr = process.stderr.read().decode(errors='replace')
+    process.stderr.close()
+    returncode = os.waitstatus_to_exitcode(status)
+    result = {
+        'script': label or name,
+        'scale': scale,
+        'wall_seconds': round(wall_seconds, 3),
+        'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        'returncode': returncode,
+    }
+    if quiet and not returncode:
+        return result
+    status_str = 'ok' if returncode == 0 else f'FAILED ({returncode})'
+    print(f"  {result['script']:<28} {result['wall_seconds']:>9.2f}s"
+          f" {result['peak_rss_mb']:>9.1f} MB  {status_str}")
+    if returncode:
+        print(stderr[-2000:], file=sys.stderr)
+    return result
+
+
+def run_scale(scale: int, workdir: Path, seed: int) -> list:
+    """Generate the inputs of one scale and benchmark every stage."""
+    work_dir = workdir / f'scale_{scale}'
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    print(f"Scale {scale}x: generating inputs in {work_dir}")
+    paths = write_inputs(work_dir, scale, seed)
+    paths['work_dir'] = work_dir
+    top_hits_tmp = paths['top_10_hits'].name.replace(
+        '_top_10_hits.txt', '_top_hits_tmp.txt')
+    top_hits = top_hits_tmp.replace('_top_hits_tmp.txt', '_top_hits.txt')
+
+    stages = [
+        ('reverse_complement.py', [
+            '--sample', SAMPLE, '--ids_to_rc', paths['ids_to_rc'],
+            '--fasta', paths['consensus'],
+        ], work_dir),
+        ('select_top_blast_hit.py', [
+            '--sample_name', SAMPLE, '--blastn_results', paths['top_10_hits'],
+            '--target_organism', 'drosophilidae', '--taxonkit_database_dir', '.',
+        ], work_dir),
+        ('fasta2table.py', [
+            '--fasta', paths['consensus'], '--sample', SAMPLE,
+            '--tophits', top_hits_tmp,
+        ], work_dir),
+        ('derive_coverage_stats.py', [
+            '--sample', SAMPLE, '--blastn_results', top_hits,
+            '--nanostat', paths['nanostat'], '--coverage', paths['coverage'],
+            '--bed', paths['bed'], '--target_size', TARGET_SIZE,
+            '--contig_seqids', paths['contig_seqids'],
+            '--reads_fasta', paths['reads_fasta'],
+            '--consensus', paths['consensus_match'],
+            '--mapping_quality', paths['mapping_quality'],
+        ], work_dir),
+        ('annotate_blast_hits.py', [
+            '--sample', SAMPLE, '--tophits', top_hits_tmp,
+            '--fasta', paths['consensus'],
+            '--nanostat', paths['nanostat'], '--coverage', paths['coverage'],
+            '--bed', paths['bed'], '--target_size', TARGET_SIZE,
+            '--contig_seqids', paths['contig_seqids'],
+            '--reads_fasta', paths['reads_fasta'],
+            '--consensus', paths['consensus_match'],
+            '--mapping_quality', paths['mapping_quality'],
+        ], work_dir),
+        ('seq_run_qc_report.py', [], paths['qc_dir']),
+    ]
+    results = [run_script(name, args, cwd, scale) for name, args, cwd in stages]
+
+    result_dir = work_dir / 'report'
+    write_report_inputs(result_dir, paths, BASE_READS * scale, seed)
+    results.append(run_script('build_report.py', [
+        '--samplesheet', result_dir / 'samplesheet.csv',
+        '--params_file', result_dir / 'params.yml',
+        '--default_params_file', ROOT_DIR / 'params/default_params.yml',
+        '--versions', ROOT_DIR / 'versions.yml',
+        '--analyst', 'bench', '--facility', 'bench',
+        '--result_dir', result_dir,
+    ], result_dir, scale))
+    return results
+
+
+def run_startup(repeats: int, cwd: Path) -> list:
+    """Return the fastest of several `ont_amplicon <command> --help` runs."""
+    commands = runpy.run_path(str(BIN_DIR / 'ont_amplicon'))['COMMANDS']
+
+    print(f"Startup: fastest of {repeats} runs")
+    results = []
+    for command in commands:
+        label = f'ont_amplicon {command}'
+        runs = [
+            run_script('ont_amplicon', [command, '--help'], cwd, 0,
+                       label=label, quiet=True)
+            for _ in range(repeats)
+        ]
+        fastest = min(runs, key=lambda r: r['wall_seconds'])
+        print(f"  {label:<28} {fastest['wall_seconds']:>9.2f}s"
+              f" {fastest['peak_rss_mb']:>9.1f} MB")
+        results.append(fastest)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: Path, tolerance: float) -> list:
+    """Return descriptions of the stages that regressed against a baseline."""
+    with baseline_path.open() as f:
+        baseline = {
+            (r['script'], r['scale']): r
+            for r in json.load(f)['results']
+        }
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['script'], result['scale']))
+        if not previous or result['returncode'] or previous['returncode']:
+            continue
+        for metric in ('wall_seconds', 'peak_rss_mb'):
+            if previous[metric] and (
+                result[metric] > previous[metric] * (1 + tolerance)
+            ):
+                regressions.append(
+                    f"{result['script']} at {result['scale']}x: {metric}"
+                    f" {previous[metric]} -> {result[metric]}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    # The stages run from within the work directory, so their input paths must not be relative
+    if args.workdir is None:
+        args.workdir = Path(tempfile.mkdtemp(prefix='ont_amplicon_benchmark_'))
+        created = True
+    else:
+        args.workdir = args.workdir.resolve()
+        created = not args.workdir.exists()
+        args.workdir.mkdir(parents=True, exist_ok=True)
+    results = []
+    if args.startup_repeats:
+        results.extend(run_startup(args.startup_repeats, args.workdir))
+    for scale in args.scales:
+        results.extend(run_scale(scale, args.workdir, args.seed))
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with args.output.open('w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if not args.keep:
+        # Only remove what was generated here, never a directory provided by the user
+        if created:
+            shutil.rmtree(args.workdir)
+        else:
+            for scale in args.scales:
+                shutil.rmtree(args.workdir / f'scale_{scale}', ignore_errors=True)
+    else:
+        print(f"Inputs and outputs kept in {args.workdir}")
+
+    failed = [r for r in results if r['returncode']]
+    regressions = compare(results, args.baseline, args.tolerance) if args.baseline else []
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
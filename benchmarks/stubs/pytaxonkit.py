@@ -0,0 +1,28 @@
+"""Stub of the pytaxonkit API used by select_top_blast_hit.py.
+
+Returns deterministic lineages and names without a taxonkit database, so
+the benchmarks measure the script itself rather than taxonkit lookups.
+"""
+
+import pandas as pd
+
+LINEAGES = [
+    "cellular organisms;Eukaryota;Opisthokonta;Metazoa;Protostomia;Arthropoda;Insecta;Diptera;Drosophilidae",
+    "cellular organisms;Bacteria;Pseudomonadota;Gammaproteobacteria;Enterobacterales;Erwiniaceae",
+    "Viruses;Riboviria;Orthornavirae;Kitrinoviricota;Alsuviricetes;Martellivirales",
+    "cellular organisms;Eukaryota;Opisthokonta;Fungi;Dikarya;Ascomycota;Erysiphaceae",
+]
+
+
+def lineage(taxids, data_dir=None):
+    return pd.DataFrame({
+        "TaxID": list(taxids),
+        "FullLineage": [LINEAGES[int(t) % len(LINEAGES)] for t in taxids],
+    })
+
+
+def name(taxids, data_dir=None):
+    return pd.DataFrame({
+        "TaxID": list(taxids),
+        "Name": [f"Species {t}" for t in taxids],
+    })
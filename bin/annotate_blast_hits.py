@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Annotate the top blast hits of a sample with their consensus sequence and coverage statistics.
+
+Runs the steps of fasta2table.py and derive_coverage_stats.py on a single
+DataFrame: the top hits selected by select_top_blast_hit.py are read once with
+typed columns, joined with the consensus sequences and flagged in memory, and
+only {sample}_top_blast_with_cov_stats.txt is written. The intermediate
+*_top_hits.txt table of fasta2table.py is only written with --write_intermediates.
+"""
+import argparse
+import os
+
+import pandas as pd
+
+import derive_coverage_stats
+import fasta2table
+import select_top_blast_hit
+from derive_coverage_stats import (add_coverage_stats, add_quality_arguments, coverage_manifest, empty_coverage_stats,
+                                   save_summary)
+from fasta2table import add_consensus, empty_top_hits, read_consensus
+from instrumentation import Metrics, add_profile_argument
+from manifest import add_manifest_argument
+from select_top_blast_hit import TOP_HIT_COLUMNS, load_top_hits
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sample", type=str, required=True, help='Provide sample name')
+    parser.add_argument("--tophits", type=str, required=True, help='Top blast hits written by select_top_blast_hit.py')
+    parser.add_argument("--fasta", type=str, required=True, help='Consensus fasta file')
+    parser.add_argument("--nanostat", type=str, required=True)
+    parser.add_argument("--bed", type=str, required=True)
+    parser.add_argument("--coverage", type=str, required=True)
+    parser.add_argument("--target_size", type=str, required=True)
+    parser.add_argument("--read_lengths", type=str,
+                        help="Table of the mapped reads and their lengths written by mapped_reads.py")
+    parser.add_argument("--contig_seqids", type=str, help="Path to mapping file (without --read_lengths)")
+    parser.add_argument("--reads_fasta", type=str, help="Reads fasta file (without --read_lengths)")
+    parser.add_argument("--consensus", type=str, help="Fasta file of the consensus segments matching their top hit")
+    parser.add_argument("--mapping_quality", type=str, required=True)
+    add_quality_arguments(parser)
+    parser.add_argument("--write_intermediates", action="store_true",
+                        help="Also write the *_top_hits.txt table of the consensus sequences and their top hits")
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    code = [__file__, derive_coverage_stats.__file__, fasta2table.__file__, select_top_blast_hit.__file__]
+    manifest = coverage_manifest(args, "annotate_blast_hits", code)
+    manifest.inputs.update(tophits=args.tophits, fasta=args.fasta)
+    manifest.params["write_intermediates"] = args.write_intermediates
+    outputs = [f"{args.sample}_top_blast_with_cov_stats.txt"]
+    if args.write_intermediates:
+        outputs.append(os.path.basename(args.tophits).replace("_top_hits_tmp.txt", "_top_hits.txt"))
+    with Metrics("annotate_blast_hits", args.sample, args.profile) as metrics:
+        with metrics.span("manifest"):
+            if manifest.restore(outputs):
+                print(f"Inputs unchanged, restored {', '.join(outputs)}")
+                return
+        # EXTRACT_BLAST_HITS leaves an empty top hits file when blast found no hits
+        has_hits = os.path.getsize(args.tophits) > 0
+        with metrics.span("parse"):
+            if has_hits:
+                top_hits = load_top_hits(args.tophits)
+                fasta_df = read_consensus(args.fasta)
+            else:
+                top_hits = pd.DataFrame(columns=TOP_HIT_COLUMNS)
+                fasta_df = pd.DataFrame(columns=["qseqid", "consensus_seq"])
+        metrics.rows("top_hits", len(top_hits))
+        metrics.rows("consensus", len(fasta_df))
+
+        with metrics.span("merge"):
+            if has_hits:
+                blast_df = add_consensus(fasta_df, top_hits, args.sample)
+            else:
+                blast_df = empty_top_hits(fasta_df)
+        if args.write_intermediates:
+            blast_df.to_csv(outputs[1], index=None, sep="\t")
+
+        if blast_df['sgi'].isna().all():
+            empty_coverage_stats(blast_df).to_csv(f"{args.sample}_top_blast_with_cov_stats.txt", index=None, sep="\t")
+        else:
+            flagged_df = add_coverage_stats(
+                blast_df, args.nanostat, args.coverage, args.bed, args.mapping_quality, args.contig_seqids,
+                args.reads_fasta, args.consensus, args.target_size, metrics, args.consensus_fastq, args.pileup,
+                args.read_lengths
+            )
+            with metrics.span("write"):
+                save_summary(flagged_df, args.sample)
+            metrics.rows("summary", len(flagged_df))
+        manifest.save(outputs)
+
+
+if __name__ == "__main__":
+    main()
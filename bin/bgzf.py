@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Compress and decompress BGZF files on several threads.
+
+BGZF, the format written by bgzip and htslib, is a series of gzip members
+of at most 64 kB each, so any gzip reader can read it while blocks can be
+compressed and inflated independently. zlib releases the GIL, so blocks are
+(de)compressed in a thread pool and written back in order. With --index a
+bgzip-compatible .gzi index of the block offsets is written alongside the
+output, e.g.:
+
+    chopper ... | ont_amplicon bgzf --threads 4 --index -o sample_filtered.fastq.gz
+    ont_amplicon bgzf -d --threads 4 sample_filtered.fastq.gz | head
+"""
+import argparse
+import struct
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Uncompressed bytes per block, as bgzip, so that a block never exceeds 64 kB
+BLOCK_SIZE = 0xff00
+# Blocks inflated per task when reading, i.e. ~4 MB chunks
+BLOCKS_PER_CHUNK = 64
+# gzip header with the BC extra subfield holding the block size - 1
+HEADER = struct.Struct("<4BI2BH2BHH")
+TRAILER = struct.Struct("<2I")
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", help="Input file (default: stdin)")
+    parser.add_argument("-o", "--output", type=str, help="Output file (default: stdout)")
+    parser.add_argument("-d", "--decompress", action="store_true", help="Decompress a BGZF file")
+    parser.add_argument("-@", "--threads", type=int, default=1, help="Number of threads (default: 1)")
+    parser.add_argument("-l", "--level", type=int, default=6, help="Compression level (default: 6)")
+    parser.add_argument("-i", "--index", action="store_true",
+                        help="Write a .gzi index of the output blocks (requires --output)")
+    args = parser.parse_args()
+    if args.index and not args.output:
+        parser.error("--index requires --output")
+    return args
+
+
+def compress_block(data, level=6):
+    """Return one BGZF block holding data (at most BLOCK_SIZE bytes)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    block_size = HEADER.size + len(cdata) + TRAILER.size
+    header = HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+    return header + cdata + TRAILER.pack(zlib.crc32(data), len(data))
+
+
+def decompress_block(block):
+    """Return the uncompressed data of one BGZF block."""
+    data = zlib.decompress(block[HEADER.size:-TRAILER.size], -15)
+    crc, size = TRAILER.unpack(block[-TRAILER.size:])
+    if size != len(data) or crc != zlib.crc32(data):
+        raise ValueError("BGZF block failed its CRC check")
+    return data
+
+
+def decompress_blocks(blocks):
+    return b"".join(decompress_block(block) for block in blocks)
+
+
+def block_size(header):
+    """Return the size of a block from its header, or None if it is not BGZF."""
+    if len(header) < HEADER.size or header[:4] != b"\x1f\x8b\x08\x04":
+        return None
+    fields = HEADER.unpack(header[:HEADER.size])
+    # XLEN == 6 with a single BC subfield of length 2, as written by bgzip and htslib
+    if fields[7:11] != (6, 66, 67, 2):
+        return None
+    return fields[11] + 1
+
+
+def is_bgzf(path):
+    with open(path, "rb") as f:
+        return block_size(f.read(HEADER.size)) is not None
+
+
+def iter_blocks(f):
+    """Yield the raw BGZF blocks of a binary file object."""
+    while header := f.read(HEADER.size):
+        size = block_size(header)
+        if size is None:
+            raise ValueError("Not a BGZF file, or corrupt block header")
+        block = header + f.read(size - HEADER.size)
+        if len(block) != size:
+            raise ValueError("Truncated BGZF block")
+        yield block
+
+
+def _ordered(pool, tasks, threads):
+    """Submit tasks to the pool and yield their results in order.
+
+    At most 2 * threads tasks are in flight, which bounds memory use when
+    reading or writing files of any size.
+    """
+    pending = deque()
+    for func, *args in tasks:
+        pending.append(pool.submit(func, *args))
+        if len(pending) >= 2 * threads:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _batches(blocks, size):
+    batch = []
+    for block in blocks:
+        batch.append(block)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_chunks(path, threads=1, blocks_per_chunk=BLOCKS_PER_CHUNK):
+    """Yield the decompressed data of a BGZF file in chunks, in file order."""
+    with open(path, "rb") as f, ThreadPoolExecutor(threads) as pool:
+        tasks = ((decompress_blocks, batch) for batch in _batches(iter_blocks(f), blocks_per_chunk))
+        for chunk in _ordered(pool, tasks, threads):
+            if chunk:
+                yield chunk
+
+
+def write_index(offsets, path):
+    """Write (compressed, uncompressed) block end offsets in the bgzip .gzi layout."""
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(offsets)))
+        for compressed, uncompressed in offsets:
+            f.write(struct.pack("<2Q", compressed, uncompressed))
+
+
+def read_index(path):
+    """Return the (compressed, uncompressed) offsets of a .gzi index."""
+    with open(path, "rb") as f:
+        (count,) = struct.unpack("<Q", f.read(8))
+        return [struct.unpack("<2Q", f.read(16)) for _ in range(count)]
+
+
+class BgzfWriter:
+    """Write data as BGZF, compressing blocks on a pool of threads.
+
+    Used as a context manager; the EOF marker block and, given an
+    index_path, the .gzi index are written on close.
+    """
+
+    def __init__(self, out, threads=1, level=6, index_path=None):
+        self.out = out
+        self.threads = threads
+        self.level = level
+        self.index_path = index_path
+        self.offsets = []
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(threads)
+        self._compressed = 0
+        self._uncompressed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) < BLOCK_SIZE:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        view = memoryview(data)
+        start = 0
+        while len(view) - start >= BLOCK_SIZE:
+            self._submit(bytes(view[start:start + BLOCK_SIZE]))
+            start += BLOCK_SIZE
+        self._buffer += view[start:]
+
+    def _submit(self, data):
+        self._pending.append((self._pool.submit(compress_block, data, self.level), len(data)))
+        if len(self._pending) >= 2 * self.threads:
+            self._write_next()
+
+    def _write_next(self):
+        future, size = self._pending.popleft()
+        block = future.result()
+        self.out.write(block)
+        self._compressed += len(block)
+        self._uncompressed += size
+        self.offsets.append((self._compressed, self._uncompressed))
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._write_next()
+        self._pool.shutdown()
+        self.out.write(EOF_BLOCK)
+        self.out.flush()
+        if self.index_path:
+            # the end of the last block is the start of the EOF block, as in bgzip
+            write_index(self.offsets, self.index_path)
+
+
+def main():
+    args = parse_args()
+    src = open(args.input, "rb") if args.input else sys.stdin.buffer
+    dest = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        if args.decompress:
+            if not args.input:
+                sys.exit("ont_amplicon bgzf: --decompress needs an input file")
+            for chunk in iter_chunks(args.input, args.threads):
+                dest.write(chunk)
+        else:
+            index_path = f"{args.output}.gzi" if args.index else None
+            with BgzfWriter(dest, args.threads, args.level, index_path) as writer:
+                while data := src.read(BLOCK_SIZE * BLOCKS_PER_CHUNK):
+                    writer.write(data)
+    finally:
+        if args.input:
+            src.close()
+        if args.output:
+            dest.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,10 @@
 
 import argparse
 
-from report import report
+from instrumentation import Metrics, add_profile_argument
+from manifest import add_manifest_argument
+
+from report import report, server
 from report.utils import existing_path
 
 
@@ -48,17 +51,62 @@ def main():
         help="The directory containing the output data.",
     )
 
-    args = parser.parse_args()
-    report.render(
-        args.result_dir,
-        args.samplesheet,
-        args.default_params_file,
-        args.params_file,
-        args.versions,
-        args.analyst,
-        args.facility,
+    parser.add_argument(
+        '--trace',
+        type=existing_path,
+        help=("The Nextflow trace file of the run, to report the resources"
+              " used by the tasks of the sample (default: an"
+              " execution_trace*.txt file of the result directory)."),
+    )
+
+    parser.add_argument(
+        '--bam_viewer',
+        choices=['inline', 'served'],
+        default='inline',
+        help=("'inline' embeds the BAM, BAI and FASTA files in the BAM viewer;"
+              " 'served' loads them by HTTP range requests, which requires"
+              " opening the viewer through `ont_amplicon serve-report`."),
+    )
+    parser.add_argument(
+        '--bam_data_url',
+        default='',
+        help=("URL of the BAM, BAI and FASTA files relative to the BAM viewer,"
+              " with --bam_viewer served (default: the same directory)."),
+    )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help="Serve the result directory once the report is built.",
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8000,
+        help="Port of the server started by --serve (default: 8000).",
     )
 
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
+
+    args = parser.parse_args()
+    with Metrics("build_report", profile=args.profile) as metrics:
+        report.render(
+            args.result_dir,
+            args.samplesheet,
+            args.default_params_file,
+            args.params_file,
+            args.versions,
+            args.analyst,
+            args.facility,
+            metrics=metrics,
+            bam_viewer=args.bam_viewer,
+            bam_data_url=args.bam_data_url,
+            manifest_dir=args.manifest_dir,
+            trace_file=args.trace,
+        )
+    if args.serve:
+        server.serve(args.result_dir, args.port)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Bin the read depth along each consensus into a fixed number of bins.
+
+The per-base depth written by mosdepth (SampleName.per-base.bed[.gz], runs
+of positions of equal depth) is read in chunks, and for each consensus the
+mean and the minimum depth of BINS bins of equal width are derived. Both are
+written to SampleName_depth_profile.npz, a few kB per sample:
+
+    contigs     names of the consensus sequences
+    lengths     length of each consensus
+    mean_depth  float32 array of shape (contigs, bins)
+    min_depth   uint32 array of shape (contigs, bins)
+
+which the HTML report draws as a sparkline next to each consensus, so that
+coverage dropouts can be spotted without opening the BAM viewer.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import Metrics, add_profile_argument
+
+BINS = 100
+PER_BASE_CHUNK_SIZE = 500_000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sample", type=str, required=True, help="Provide sample name")
+    parser.add_argument("--per_base", type=str, required=True,
+                        help="Per-base depth of mosdepth (SampleName.per-base.bed[.gz])")
+    parser.add_argument("--bins", type=int, default=BINS, help=f"Number of bins per consensus (default: {BINS})")
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+
+def read_per_base(path, chunksize=PER_BASE_CHUNK_SIZE):
+    """Return the (start, end, depth) arrays of the depth runs of each consensus, in file order."""
+    runs = {}
+    if os.path.getsize(path) == 0:
+        return runs
+    chunks = pd.read_csv(
+        path, sep="\t", header=None, names=["contig", "start", "end", "depth"],
+        dtype={"contig": str, "start": "int64", "end": "int64", "depth": "int64"}, chunksize=chunksize,
+    )
+    for chunk in chunks:
+        for contig, group in chunk.groupby("contig", sort=False):
+            runs.setdefault(contig, []).append(group[["start", "end", "depth"]].to_numpy())
+    return {contig: np.concatenate(parts) for contig, parts in runs.items()}
+
+
+def bin_depth(starts, ends, depths, bins=BINS):
+    """Return the mean and minimum depth of bins of equal width along a consensus.
+
+    The runs of equal depth cover the consensus from 0 to its length, so the
+    cumulative depth is piecewise linear between the run ends and the mean
+    depth of a bin is exact, whatever the bin width.
+    """
+    length = ends[-1]
+    edges = np.linspace(0, length, bins + 1)
+    cumulative = np.concatenate([[0], np.cumsum(depths * (ends - starts))])
+    integral = np.interp(edges, np.concatenate([[starts[0]], ends]), cumulative)
+    mean_depth = np.diff(integral) / np.diff(edges)
+    # Runs overlapping each bin: from the run holding its start to the run holding its end
+    first = np.searchsorted(ends, edges[:-1], side="right")
+    last = np.minimum(np.searchsorted(ends, edges[1:], side="left"), len(ends) - 1)
+    min_depth = np.minimum(np.minimum.reduceat(depths, first), depths[last])
+    return mean_depth.astype(np.float32), min_depth.astype(np.uint32)
+
+
+def depth_profiles(runs, bins=BINS):
+    """Return the contig names, lengths, mean and minimum depth of the binned profiles."""
+    contigs = list(runs)
+    mean_depth = np.zeros((len(contigs), bins), dtype=np.float32)
+    min_depth = np.zeros((len(contigs), bins), dtype=np.uint32)
+    lengths = np.zeros(len(contigs), dtype=np.int64)
+    for i, contig in enumerate(contigs):
+        starts, ends, depths = runs[contig].T
+        lengths[i] = ends[-1]
+        mean_depth[i], min_depth[i] = bin_depth(starts, ends, depths, bins)
+    return np.array(contigs, dtype=str), lengths, mean_depth, min_depth
+
+
+def main():
+    args = parse_args()
+    with Metrics("depth_profile", args.sample, args.profile) as metrics:
+        with metrics.span("parse"):
+            runs = read_per_base(args.per_base)
+        metrics.rows("contigs", len(runs))
+        with metrics.span("bin"):
+            contigs, lengths, mean_depth, min_depth = depth_profiles(runs, args.bins)
+        with metrics.span("write"):
+            np.savez_compressed(
+                f"{args.sample}_depth_profile.npz",
+                contigs=contigs, lengths=lengths, mean_depth=mean_depth, min_depth=min_depth,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,63 @@
 #!/usr/bin/env python
 import argparse
+import os
 import pandas as pd
 import numpy as np
-from functools import reduce
-from Bio import SeqIO
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import collections
+import math
+
+from instrumentation import Metrics, add_profile_argument
+from manifest import Manifest, add_manifest_argument
+
+# Coverage statistics of a consensus missing from one of the coverage inputs
+COVERAGE_DEFAULTS = {
+    'query_match_length': 0,
+    'qseq_mapping_read_count': 0,
+    'qseq_mean_depth': 0.0,
+    'qseq_pc_mapping_read': 0.0,
+    'qseq_pc_cov_30X': 0.0,
+    'mean_MQ': 0.0,
+    'num_passing_90': 0,
+    'pc_read_length_passes_90_5': False,
+}
+COVERAGE_DTYPES = {
+    'query_match_length': 'Int64',
+    'qseq_mapping_read_count': 'Int64',
+    'qseq_mean_depth': 'Float64',
+    'qseq_pc_mapping_read': 'Float64',
+    'qseq_pc_cov_30X': 'Float64',
+    'mean_MQ': 'Float64',
+    'num_passing_90': 'Int64',
+    'pc_read_length_passes_90_5': 'boolean',
+}
+
+# Consensus quality metrics of a consensus missing from the consensus fastq or pileup
+QUALITY_DEFAULTS = {
+    'mean_consensus_quality': 0.0,
+    'pc_ambiguous_positions': 100.0,
+    'pc_low_agreement_positions': 100.0,
+    'longest_low_quality_run': 0,
+}
+QUALITY_DTYPES = {
+    'mean_consensus_quality': 'Float64',
+    'pc_ambiguous_positions': 'Float64',
+    'pc_low_agreement_positions': 'Float64',
+    'longest_low_quality_run': 'Int64',
+}
+# Consensus base quality below which a position is low quality
+LOW_QUALITY = 20
+# Fraction of the reads agreeing with the consensus below which a position is low agreement
+LOW_AGREEMENT = 0.8
+PILEUP_CHUNK_SIZE = 500_000
+# Rows of the mapped read table of mapped_reads.py read at a time
+READ_LENGTH_CHUNK_SIZE = 1_000_000
+
+COVERAGE_STATS_COLUMNS = [
+    'query_match_length', 'qseq_mapping_read_count', 'qseq_mean_depth', 'qseq_pc_mapping_read', 'qseq_pc_cov_30X',
+    'mean_MQ', 'num_passing_90', '30X_COVERAGE_FLAG', 'MAPPED_READ_COUNT_FLAG', 'MEAN_COVERAGE_FLAG',
+    'TARGET_ORGANISM_FLAG', 'TARGET_SIZE_FLAG', 'READ_LENGTH_FLAG', 'MEAN_MQ_FLAG', 'TOTAL_CONF_SCORE',
+    'NORMALISED_CONF_SCORE'
+]
 
 
 def parse_args():
@@ -18,13 +68,27 @@ def parse_args():
     parser.add_argument("--bed", type=str, required=True)
     parser.add_argument("--coverage", type=str, required=True)
     parser.add_argument("--target_size", type=str, required=True)
-    parser.add_argument("--contig_seqids", type=str, help="Path to mapping file")
-    parser.add_argument("--reads_fasta", type=str, help="Reads fasta file")
+    parser.add_argument("--read_lengths", type=str,
+                        help="Table of the mapped reads and their lengths written by mapped_reads.py")
+    parser.add_argument("--contig_seqids", type=str, help="Path to mapping file (without --read_lengths)")
+    parser.add_argument("--reads_fasta", type=str, help="Reads fasta file (without --read_lengths)")
     parser.add_argument("--consensus", type=str, help="Reads fasta file")
     parser.add_argument("--mapping_quality", type=str, required=True)
+    add_quality_arguments(parser)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
     return parser.parse_args()
 
 
+def add_quality_arguments(parser):
+    """Add the optional samtools consensus fastq and mpileup inputs of the consensus quality metrics."""
+    parser.add_argument("--consensus_fastq", type=str,
+                        help="samtools consensus fastq of the consensus matches, for the consensus quality metrics")
+    parser.add_argument("--pileup", type=str,
+                        help="samtools mpileup of the reads against the consensus matches, for the consensus quality metrics")
+    return parser
+
+
 def read_filtered_read_count(nanostat_path):
     with open(nanostat_path) as f:
         for line in f:
@@ -59,14 +123,38 @@ def load_and_prepare_data(coverage_path, bed_path, mapping_quality, filtered_rea
     return samtools_cov, mosdepth[["qseqid", "qseq_pc_cov_30X"]],mq
 
 
-def merge_dataframes(blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5):
-    return reduce(
-        lambda left, right: pd.merge(left, right, on="qseqid", how='outer').fillna(0),
-        [blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5]
+def merge_dataframes(blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5, quality_df=None):
+    """Align all tables on qseqid and concatenate them in a single pass.
+
+    Consensus missing from the coverage inputs get the typed defaults of
+    COVERAGE_DEFAULTS (and QUALITY_DEFAULTS); the blast columns of consensus
+    without a hit stay empty.
+    """
+    dfs = (blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5)
+    defaults = COVERAGE_DEFAULTS
+    if quality_df is not None:
+        dfs += (quality_df,)
+        defaults = {**COVERAGE_DEFAULTS, **QUALITY_DEFAULTS}
+    merged_df = pd.concat(
+        [df.set_index("qseqid") for df in dfs],
+        axis=1,
+        join="outer",
+        sort=True,
     )
+    # Missing values are filled on nullable types so that no column goes through object dtype,
+    # and only the coverage columns are touched
+    dtypes = {**COVERAGE_DTYPES, **QUALITY_DTYPES}
+    for col, value in defaults.items():
+        merged_df[col] = merged_df[col].astype(dtypes[col]).fillna(value).astype(type(value))
+    # Put qseqid back where blast_df has it
+    merged_df.insert(blast_df.columns.get_loc("qseqid"), "qseqid", merged_df.index)
+    return merged_df.reset_index(drop=True)
 
 
 def apply_qc_flags(df, target_size):
+    # Consensus without a blast hit have no accession and are flagged GREY
+    has_hit = df['sacc'].notna() & ~df['sacc'].isin([0, '', '0', '-'])
+
     #######30X_DEPTH_FLAG#######
     #Conditions:
     #GREEN: If sgi != 0 and the qseq_pc_cov_30X is >=90
@@ -76,10 +164,10 @@ def apply_qc_flags(df, target_size):
 
     df['30X_COVERAGE_FLAG'] = np.select(
         [
-            (df['sacc'] != 0) & (df['qseq_pc_cov_30X'] >= 90),
-            (df['sacc'] != 0) & (df['qseq_pc_cov_30X'] >= 75) & (df['qseq_pc_cov_30X'] < 90),
-            (df['sacc'] != 0) & (df['qseq_pc_cov_30X'] < 75),
-            (df['sacc'].isin([0, None, '', '0', '-']))
+            has_hit & (df['qseq_pc_cov_30X'] >= 90),
+            has_hit & (df['qseq_pc_cov_30X'] >= 75) & (df['qseq_pc_cov_30X'] < 90),
+            has_hit & (df['qseq_pc_cov_30X'] < 75),
+            ~has_hit
         ],
         ['GREEN', 'ORANGE', 'RED', 'GREY'],
         default=""
@@ -93,10 +181,10 @@ def apply_qc_flags(df, target_size):
     #GREY: If sgi == 0.
     df['MAPPED_READ_COUNT_FLAG'] = np.select(
         [
-            (df['sacc'] != 0) & (df['qseq_mapping_read_count'] >= 1000),
-            (df['sacc'] != 0) & (df['qseq_mapping_read_count'] >= 200) & (df['qseq_mapping_read_count'] < 1000),
-            (df['sacc'] != 0) & (df['qseq_mapping_read_count'] < 200),
-            (df['sacc'].isin([0, None, '', '0', '-']))
+            has_hit & (df['qseq_mapping_read_count'] >= 1000),
+            has_hit & (df['qseq_mapping_read_count'] >= 200) & (df['qseq_mapping_read_count'] < 1000),
+            has_hit & (df['qseq_mapping_read_count'] < 200),
+            ~has_hit
         ],
         ['GREEN', 'ORANGE', 'RED', 'GREY'],
         default=""
@@ -105,10 +193,10 @@ def apply_qc_flags(df, target_size):
     # Mean coverage flag
     df['MEAN_COVERAGE_FLAG'] = np.select(
         [
-            (df['sacc'] != 0) & (df['qseq_mean_depth'] >= 500),
-            (df['sacc'] != 0) & (df['qseq_mean_depth'] >= 100) & (df['qseq_mean_depth'] < 500),
-            (df['sacc'] != 0) & (df['qseq_mean_depth'] < 100),
-            (df['sacc'].isin([0, None, '', '0', '-']))
+            has_hit & (df['qseq_mean_depth'] >= 500),
+            has_hit & (df['qseq_mean_depth'] >= 100) & (df['qseq_mean_depth'] < 500),
+            has_hit & (df['qseq_mean_depth'] < 100),
+            ~has_hit
         ],
         ['GREEN', 'ORANGE', 'RED', 'GREY'],
         default=""
@@ -121,10 +209,10 @@ def apply_qc_flags(df, target_size):
     #GREY: If sgi == 0.
     df['TARGET_ORGANISM_FLAG'] = np.select(
         [
-            (df['sacc'] != 0) & (df['target_organism_match'] == 'Y') & (df['pident'] >= 90),
-            (df['sacc'] != 0) & (df['target_organism_match'] == 'Y') & (df['pident'] < 90),
-            (df['sacc'] != 0) & (df['target_organism_match'] == 'N'),
-            (df['sacc'].isin([0, None, '', '0', '-']))
+            has_hit & (df['target_organism_match'] == 'Y') & (df['pident'] >= 90),
+            has_hit & (df['target_organism_match'] == 'Y') & (df['pident'] < 90),
+            has_hit & (df['target_organism_match'] == 'N'),
+            ~has_hit
         ],
         ['GREEN', 'ORANGE', 'RED', 'GREY'],
         default=""
@@ -141,31 +229,31 @@ def apply_qc_flags(df, target_size):
     target_size = float(target_size)
     df['TARGET_SIZE_FLAG'] = np.select(
         [
-            (df['sacc'] != 0) &
+            has_hit &
             (df['query_match_length'].between(target_size * 0.8, target_size * 1.2)),
-            (df['sacc'] != 0) &
+            has_hit &
             (df['query_match_length'].between(target_size * 0.6, target_size * 0.8)) |
             (df['query_match_length'].between(target_size * 1.2, target_size * 1.4)),
-            (df['sacc'] != 0) &
+            has_hit &
             ((df['query_match_length'] < target_size * 0.6) |
              (df['query_match_length'] > target_size * 1.4)),
-            (df['sacc'].isin([0, None, '', '0', '-']))
+            ~has_hit
         ],
         ['GREEN', 'ORANGE', 'RED', 'GREY'],
         default=""
     )
     df['READ_LENGTH_FLAG'] = np.where(
-        (df['sacc'] != 0) & 
+        has_hit & 
         (df['num_passing_90'] >= 200),
         "GREEN",
-        np.where((df['sacc'] != 0) & 
+        np.where(has_hit & 
                 (df['num_passing_90'] < 200) & 
                 (df['num_passing_90'] >= 50),
                 "ORANGE",
-            np.where((df['sacc'] != 0) &
+            np.where(has_hit &
                 (df['num_passing_90'] < 50), 
                 "RED",
-                np.where(df['sacc'].isin([0, None, '', '0', '-']),
+                np.where(~has_hit,
                     "GREY",
                     ""
                 )
@@ -174,17 +262,17 @@ def apply_qc_flags(df, target_size):
     )
     # Mean mapping quality flag
     df['MEAN_MQ_FLAG'] = np.where(
-        (df['sacc'] != 0) & 
+        has_hit & 
         (df['mean_MQ'] >= 30),
         "GREEN",
-        np.where((df['sacc'] != 0) & 
+        np.where(has_hit & 
                 (df['mean_MQ'] < 30) & 
                 (df['mean_MQ'] >= 10),
                 "ORANGE",
-            np.where((df['sacc'] != 0) &
+            np.where(has_hit &
                 (df['mean_MQ'] < 10),
                 "RED",
-                np.where(df['sacc'].isin([0, None, '', '0', '-']),
+                np.where(~has_hit,
                     "GREY",
                     ""
                 )
@@ -192,13 +280,13 @@ def apply_qc_flags(df, target_size):
         )
     )
 
-    flag_score_map = {
-        'GREEN': 2,
-        'ORANGE': 1,
-        'RED': 0,
-        'GREY': 0
-    }
-    
+    #######CONSENSUS_QUALITY_FLAG#######
+    #Only derived when the consensus fastq and pileup are provided.
+    #Conditions:
+    #GREEN: If sgi != 0, <1% of ambiguous positions, <5% of low agreement positions and no low quality run >=10 bases
+    #ORANGE: If sgi != 0, <5% of ambiguous positions, <20% of low agreement positions and no low quality run >=50 bases
+    #RED: If sgi != 0 otherwise.
+    #GREY: If sgi == 0.
     flag_columns = [
         '30X_COVERAGE_FLAG',
         'MAPPED_READ_COUNT_FLAG',
@@ -207,6 +295,27 @@ def apply_qc_flags(df, target_size):
         'READ_LENGTH_FLAG',
         'MEAN_MQ_FLAG'
     ]
+    if 'mean_consensus_quality' in df.columns:
+        df['CONSENSUS_QUALITY_FLAG'] = np.select(
+            [
+                has_hit & (df['pc_ambiguous_positions'] < 1) & (df['pc_low_agreement_positions'] < 5) &
+                (df['longest_low_quality_run'] < 10),
+                has_hit & (df['pc_ambiguous_positions'] < 5) & (df['pc_low_agreement_positions'] < 20) &
+                (df['longest_low_quality_run'] < 50),
+                has_hit,
+                ~has_hit
+            ],
+            ['GREEN', 'ORANGE', 'RED', 'GREY'],
+            default=""
+        )
+        flag_columns.append('CONSENSUS_QUALITY_FLAG')
+
+    flag_score_map = {
+        'GREEN': 2,
+        'ORANGE': 1,
+        'RED': 0,
+        'GREY': 0
+    }
 
     # Convert flag values to scores
     for col in flag_columns:
@@ -215,7 +324,7 @@ def apply_qc_flags(df, target_size):
     # Total score for each cluster
     df['TOTAL_CONF_SCORE'] = df[[col + '_SCORE' for col in flag_columns]].sum(axis=1)
 
-    # Optionally normalize: score out of 12 (6 flags × max score of 2)
+    # Optionally normalize: score out of 12 (6 flags × max score of 2), or 14 with the consensus quality flag
     df['NORMALISED_CONF_SCORE'] = df['TOTAL_CONF_SCORE'] / (2 * len(flag_columns))  # Result: 0 to 1 scale
 
      #df['qseq_pc_mapping_read'] = df['qseq_pc_mapping_read'].round(1)
@@ -228,12 +337,7 @@ def apply_qc_flags(df, target_size):
 def save_summary(df, sample_name):
     df = df.sort_values(["qseq_pc_mapping_read", "target_organism_match"], ascending=[False, False])
     df.drop("pc_read_length_passes_90_5" , axis=1, inplace=True)
-    df.drop("30X_COVERAGE_FLAG_SCORE" , axis=1, inplace=True)
-    df.drop("MAPPED_READ_COUNT_FLAG_SCORE" , axis=1, inplace=True)
-    df.drop("MEAN_COVERAGE_FLAG_SCORE" , axis=1, inplace=True)
-    df.drop("TARGET_SIZE_FLAG_SCORE" , axis=1, inplace=True)
-    df.drop("READ_LENGTH_FLAG_SCORE" , axis=1, inplace=True)
-    df.drop("MEAN_MQ_FLAG_SCORE" , axis=1, inplace=True)
+    df.drop([col for col in df.columns if col.endswith("_FLAG_SCORE")], axis=1, inplace=True)
 
     output_file = f"{sample_name}_top_blast_with_cov_stats.txt"
     df.to_csv(output_file, index=False, sep="\t")
@@ -252,6 +356,8 @@ def parse_mapping_file(mapping_path):
 
 def get_read_lengths(fasta_path):
     """Return dictionary of read_id: length from fasta file."""
+    from Bio import SeqIO
+
     read_lengths = {}
     for record in SeqIO.parse(fasta_path, "fasta"):
         read_lengths[record.id] = len(record.seq)
@@ -259,6 +365,8 @@ def get_read_lengths(fasta_path):
 
 def get_reference_lengths(fasta_path):
     """Return dictionary of reference_id: length from consensus fasta."""
+    from Bio import SeqIO
+
     ref_lengths = {}
     for record in SeqIO.parse(fasta_path, "fasta"):
         ref_lengths[record.id] = len(record.seq)
@@ -276,10 +384,76 @@ def group_lengths_by_reference(mapping, read_lengths):
     #print(reference_lengths)
     return reference_lengths
 
+def _warn_missing_references(references):
+    for ref in references:
+        print(f"Warning: {ref} not found in consensus fasta.")
+
+def length_histograms(grouped_read_lengths, reference_lengths):
+    """Return reference: histogram of the read lengths, from reference: list of lengths.
+
+    See read_length_histograms() for the layout of the histograms.
+    """
+    _warn_missing_references(ref for ref in grouped_read_lengths if ref not in reference_lengths)
+    return {
+        ref: np.bincount(np.minimum(lengths, reference_lengths[ref]), minlength=reference_lengths[ref] + 1)
+        for ref, lengths in grouped_read_lengths.items() if ref in reference_lengths
+    }
+
+def read_length_histograms(table_path, reference_lengths, chunksize=READ_LENGTH_CHUNK_SIZE):
+    """Return reference: histogram of the read lengths, from the table of mapped_reads.py.
+
+    Bin i of the histogram of a reference counts its reads of length i, and
+    the last bin the reads at least as long as the reference, so that the
+    number of reads above any fraction of the reference length is exact
+    while the memory used only depends on the reference lengths. The table
+    is memory-mapped and read in chunks of rows; it is sorted by read and
+    reference, so only the first reference of a read, in sorted order as in
+    the sorted mapping file, is counted.
+    """
+    table = np.load(table_path, mmap_mode='r')
+    names = sorted(reference_lengths)
+    encoded_names = np.array([name.encode() for name in names])
+    ref_lens = np.array([reference_lengths[name] for name in names], dtype=np.int64)
+    # All histograms in a single array, the one of reference i starting at offsets[i]
+    offsets = np.concatenate([[0], np.cumsum(ref_lens + 1)])
+    counts = np.zeros(offsets[-1], dtype=np.int64)
+    missing = set()
+    previous_read = None
+    for start in range(0, len(table), chunksize):
+        chunk = table[start:start + chunksize]
+        read_ids = chunk['read_id']
+        first = np.ones(len(chunk), dtype=bool)
+        first[1:] = read_ids[1:] != read_ids[:-1]
+        if previous_read is not None:
+            first[0] = read_ids[0] != previous_read
+        previous_read = read_ids[-1]
+        contigs = chunk['contig'][first]
+        lengths = chunk['length'][first].astype(np.int64)
+        if len(encoded_names):
+            index = np.minimum(np.searchsorted(encoded_names, contigs), len(names) - 1)
+            known = encoded_names[index] == contigs
+        else:
+            index = np.zeros(len(contigs), dtype=np.int64)
+            known = np.zeros(len(contigs), dtype=bool)
+        missing.update(contig.decode() for contig in np.unique(contigs[~known]))
+        keep = known & (lengths > 0)
+        index = index[keep]
+        counts += np.bincount(offsets[index] + np.minimum(lengths[keep], ref_lens[index]), minlength=len(counts))
+    _warn_missing_references(sorted(missing))
+    return {
+        name: counts[offsets[i]:offsets[i + 1]]
+        for i, name in enumerate(names) if counts[offsets[i]:offsets[i + 1]].any()
+    }
+
 def plot_coverage_bar(results_dict, output_path="ref_coverage_bar.png"):
     """
     Bar plot showing % of reads ≥80% reference length for each reference.
     """
+    # matplotlib is only needed for this optional plot, so it is imported here
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     refs = list(results_dict.keys())
     fractions = [v["fraction"] for v in results_dict.values()]
 
@@ -299,14 +473,14 @@ def plot_coverage_bar(results_dict, output_path="ref_coverage_bar.png"):
     plt.close()
     print(f"Bar chart saved as {output_path}")
 
-def analyze_read_lengths_against_reference(reference_lengths, grouped_read_lengths, crl, rpc):
+def analyze_read_lengths_against_reference(reference_lengths, histograms, crl, rpc):
     """
     Analyze read lengths to determine if >=rpc% of reads are >=crl% of the reference length.
     For each reference, check if 5% of reads are ≥80% of reference length
     Parameters:
-        read_lengths (dict): read_id -> length of read
         reference_lengths (dict): reference name -> reference length
-        crl (int): cutoff percent of reference length
+        histograms (dict): reference name -> histogram of the read lengths
+        crl (int): cutoff percent of reference length, at most 100
         rpc (int): required percent of reads passing
 
     Returns:
@@ -314,16 +488,13 @@ def analyze_read_lengths_against_reference(reference_lengths, grouped_read_lengt
     """
     
     results = {}
-    for ref, lengths in grouped_read_lengths.items():
-        if ref not in reference_lengths:
-            print(f"Warning: {ref} not found in consensus fasta.")
-            continue
-
-        num_reads = len(lengths)
+    for ref, histogram in histograms.items():
+        num_reads = int(histogram.sum())
         ref_len = reference_lengths[ref]
         threshold = (crl / 100) * ref_len
 
-        num_passing = sum(1 for l in lengths if l >= threshold)
+        # The lengths are integers, so a length is >= threshold when it is >= ceil(threshold)
+        num_passing = int(histogram[math.ceil(threshold):].sum())
         fraction = num_passing / num_reads if num_reads > 0 else 0
         passes = fraction >= (rpc / 100)
 
@@ -343,43 +514,179 @@ def analyze_read_lengths_against_reference(reference_lengths, grouped_read_lengt
     df = pd.DataFrame([
     { "qseqid": ref, f"num_passing_{crl}": res["num_passing"], f"pc_read_length_passes_{crl}_{rpc}": res["passes"] }
     for ref, res in results.items()
-    ])
+    ], columns=["qseqid", f"num_passing_{crl}", f"pc_read_length_passes_{crl}_{rpc}"])
     print(df)
     return df
 
-def main():
-    args = parse_args()
-    blast_df = pd.read_csv(args.blastn_results, sep="\t", header=0)
-    
-    if blast_df['sgi'].isna().all():
-        for col in ['query_match_length', 'qseq_mapping_read_count', 'qseq_mean_depth', 'qseq_pc_mapping_read', 'qseq_pc_cov_30X', 'mean_MQ', 'num_passing_90', 
-                    '30X_COVERAGE_FLAG', 'MAPPED_READ_COUNT_FLAG', 'MEAN_COVERAGE_FLAG', 'TARGET_ORGANISM_FLAG', 'TARGET_SIZE_FLAG', 'READ_LENGTH_FLAG', 
-                    'MEAN_MQ_FLAG', 'TOTAL_CONF_SCORE', 'NORMALISED_CONF_SCORE']:
-            if col not in blast_df.columns:
-                blast_df[col] = None
-        blast_df.to_csv(f"{args.sample}_top_blast_with_cov_stats.txt", index=None, sep="\t")
-    else:
-        filtered_read_counts = read_filtered_read_count(args.nanostat)
-        blast_df.rename(columns={"length": "alignment_length"}, inplace=True)
+def longest_run(mask):
+    """Return the length of the longest run of True values of a boolean array."""
+    if not mask.any():
+        return 0
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return int((np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)).max())
+
+
+def read_consensus_fastq(fastq_path):
+    """Yield (qseqid, sequence, qualities) of a samtools consensus fastq, whose records may span several lines."""
+    with open(fastq_path, 'rb') as f:
+        line = f.readline()
+        while line:
+            qseqid = line[1:].split()[0].decode()
+            seq = []
+            while (line := f.readline()) and not line.startswith(b'+'):
+                seq.append(line.strip())
+            seq = b''.join(seq)
+            qual = []
+            n_qual = 0
+            while n_qual < len(seq) and (line := f.readline()):
+                qual.append(line.strip())
+                n_qual += len(qual[-1])
+            yield qseqid, seq, b''.join(qual)
+            line = f.readline()
+
+
+def consensus_quality_stats(fastq_path):
+    """Return the mean base quality, % of ambiguous bases and longest low quality run of each consensus."""
+    rows = []
+    for qseqid, seq, qual in read_consensus_fastq(fastq_path):
+        bases = np.frombuffer(seq.upper(), dtype=np.uint8)
+        quals = np.frombuffer(qual, dtype=np.uint8).astype(np.int16) - 33
+        ambiguous = ~np.isin(bases, np.frombuffer(b'ACGT', dtype=np.uint8))
+        rows.append({
+            "qseqid": qseqid,
+            "mean_consensus_quality": round(float(quals.mean()), 1) if len(quals) else 0.0,
+            "pc_ambiguous_positions": round(float(ambiguous.mean()) * 100, 2) if len(bases) else 100.0,
+            "longest_low_quality_run": longest_run(quals < LOW_QUALITY),
+        })
+    return pd.DataFrame(rows, columns=["qseqid", "mean_consensus_quality", "pc_ambiguous_positions",
+                                       "longest_low_quality_run"])
+
+
+def pileup_agreement_stats(pileup_path, chunksize=PILEUP_CHUNK_SIZE):
+    """Return the % of positions of each consensus where few reads agree with it.
+
+    The samtools mpileup file (with the consensus as reference) is read in
+    chunks of positions; for each position the read bases matching the
+    consensus ('.' and ',') are counted once the read start markers (^ and
+    their mapping quality character) are removed. Positions without reads
+    count as low agreement.
+    """
+    low_agreement = pd.Series(dtype="int64")
+    positions = pd.Series(dtype="int64")
+    if os.path.getsize(pileup_path) == 0:
+        return pd.DataFrame(columns=["qseqid", "pc_low_agreement_positions"])
+    chunks = pd.read_csv(
+        pileup_path, sep="\t", header=None, usecols=[0, 3, 4], names=["qseqid", "depth", "bases"],
+        dtype={"qseqid": str, "depth": "int64", "bases": str}, quoting=3, keep_default_na=False,
+        chunksize=chunksize,
+    )
+    for chunk in chunks:
+        matches = chunk["bases"].str.replace(r"\^.", "", regex=True).str.count(r"[.,]").to_numpy()
+        depth = chunk["depth"].to_numpy()
+        is_low = (depth == 0) | (matches < LOW_AGREEMENT * depth)
+        grouped = pd.Series(is_low, index=chunk["qseqid"]).groupby(level=0)
+        low_agreement = low_agreement.add(grouped.sum(), fill_value=0)
+        positions = positions.add(grouped.size(), fill_value=0)
+    pc_low = (low_agreement / positions * 100).round(2)
+    return pd.DataFrame({"qseqid": pc_low.index, "pc_low_agreement_positions": pc_low.to_numpy()})
+
+
+def load_consensus_quality(consensus_fastq, pileup):
+    """Return the consensus quality metrics of each consensus, from the samtools consensus fastq and mpileup."""
+    quality_df = consensus_quality_stats(consensus_fastq)
+    agreement_df = pileup_agreement_stats(pileup)
+    return quality_df.merge(agreement_df, on="qseqid", how="outer")[["qseqid", *QUALITY_DEFAULTS]]
+
+
+def empty_coverage_stats(blast_df):
+    """Add the coverage statistics columns, left empty, to the table of a sample without blast hits."""
+    for col in COVERAGE_STATS_COLUMNS:
+        if col not in blast_df.columns:
+            blast_df[col] = None
+    return blast_df
+
+
+def add_coverage_stats(blast_df, nanostat, coverage, bed, mapping_quality, contig_seqids, reads_fasta,
+                       consensus, target_size, metrics, consensus_fastq=None, pileup=None, read_lengths=None):
+    """Merge the coverage statistics with the top blast hits and derive the QC flags.
+
+    The read lengths are taken from the read_lengths table when given, from
+    the contig_seqids mapping file and the reads fasta otherwise. The
+    consensus quality metrics and flag are only added when both the
+    consensus fastq and the pileup are given.
+    """
+    with metrics.span("parse_coverage"):
+        filtered_read_counts = read_filtered_read_count(nanostat)
+        blast_df = blast_df.rename(columns={"length": "alignment_length"})
         samtools_cov, mosdepth_df, mq_df = load_and_prepare_data(
-            args.coverage,
-            args.bed,
-            args.mapping_quality,
+            coverage,
+            bed,
+            mapping_quality,
             filtered_read_counts
         )
-        mapping = parse_mapping_file(args.contig_seqids)
-        read_lengths = get_read_lengths(args.reads_fasta)
-        reference_lengths = get_reference_lengths(args.consensus)
-        grouped_read_lengths = group_lengths_by_reference(mapping, read_lengths)
-        
-        #df_passes_70_15 = analyze_read_lengths_against_reference(reference_lengths, grouped_read_lengths, 70, 15)
-        df_passes_90_5 = analyze_read_lengths_against_reference(reference_lengths, grouped_read_lengths, 90, 5)
-
-        #df_passes_70_15.to_csv("rpc_read_length_passes_70_15.csv", index=False)
-        #df_passes_90_5.to_csv("rpc_read_length_passes_80_5.csv", index=False)
-        merged_df = merge_dataframes(blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5)
-        flagged_df = apply_qc_flags(merged_df, args.target_size)
-        save_summary(flagged_df, args.sample)
+    with metrics.span("read_lengths"):
+        reference_lengths = get_reference_lengths(consensus)
+        if read_lengths:
+            histograms = read_length_histograms(read_lengths, reference_lengths)
+        else:
+            mapping = parse_mapping_file(contig_seqids)
+            grouped_read_lengths = group_lengths_by_reference(mapping, get_read_lengths(reads_fasta))
+            histograms = length_histograms(grouped_read_lengths, reference_lengths)
+
+        #df_passes_70_15 = analyze_read_lengths_against_reference(reference_lengths, histograms, 70, 15)
+        df_passes_90_5 = analyze_read_lengths_against_reference(reference_lengths, histograms, 90, 5)
+    metrics.rows("reads", sum(int(histogram.sum()) for histogram in histograms.values()))
+
+    #df_passes_70_15.to_csv("rpc_read_length_passes_70_15.csv", index=False)
+    #df_passes_90_5.to_csv("rpc_read_length_passes_80_5.csv", index=False)
+    quality_df = None
+    if consensus_fastq and pileup:
+        with metrics.span("consensus_quality"):
+            quality_df = load_consensus_quality(consensus_fastq, pileup)
+        metrics.rows("consensus_quality", len(quality_df))
+    with metrics.span("merge"):
+        merged_df = merge_dataframes(blast_df, samtools_cov, mosdepth_df, mq_df, df_passes_90_5, quality_df)
+    with metrics.span("flagging"):
+        return apply_qc_flags(merged_df, target_size)
+
+
+def coverage_manifest(args, stage, code):
+    """Return the manifest of the coverage stats of a sample, from the arguments shared by both entry points."""
+    inputs = {
+        name: getattr(args, name)
+        for name in ("nanostat", "bed", "coverage", "read_lengths", "contig_seqids", "reads_fasta", "consensus",
+                     "mapping_quality", "consensus_fastq", "pileup")
+    }
+    return Manifest(args.manifest_dir, f"{args.sample}_{stage}", inputs,
+                    params={"target_size": args.target_size}, code=code)
+
+
+def main():
+    args = parse_args()
+    manifest = coverage_manifest(args, "derive_coverage_stats", [__file__])
+    manifest.inputs["blastn_results"] = args.blastn_results
+    output = f"{args.sample}_top_blast_with_cov_stats.txt"
+    with Metrics("derive_coverage_stats", args.sample, args.profile) as metrics:
+        with metrics.span("manifest"):
+            if manifest.restore([output]):
+                print(f"Inputs unchanged, restored {output}")
+                return
+        with metrics.span("parse"):
+            blast_df = pd.read_csv(args.blastn_results, sep="\t", header=0)
+        metrics.rows("blast_hits", len(blast_df))
+
+        if blast_df['sgi'].isna().all():
+            empty_coverage_stats(blast_df).to_csv(f"{args.sample}_top_blast_with_cov_stats.txt", index=None, sep="\t")
+        else:
+            flagged_df = add_coverage_stats(
+                blast_df, args.nanostat, args.coverage, args.bed, args.mapping_quality, args.contig_seqids,
+                args.reads_fasta, args.consensus, args.target_size, metrics, args.consensus_fastq, args.pileup,
+                args.read_lengths
+            )
+            with metrics.span("write"):
+                save_summary(flagged_df, args.sample)
+            metrics.rows("summary", len(flagged_df))
+        manifest.save([output])
 
 if __name__ == "__main__":
     main()
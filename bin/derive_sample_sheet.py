@@ -1,6 +1,13 @@
 import os
 import argparse
 import csv
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# ONT run layouts place the reads at most a few levels below the run directory,
+# e.g. <run>/<sample>/<flowcell_run>/fastq_pass/barcodeNN/*.fastq.gz
+MAX_SCAN_DEPTH = 4
+SKIPPED_DIRS = ("fastq_fail", "fastq_skip", "pod5", "pod5_fail", "pod5_pass", "pod5_skip", "fast5", "fast5_fail", "fast5_pass", "fast5_skip")
 
 def find_fastq_dirs(base_dir, single=False, extension=".fastq.gz"):
     fastq_entries = []
@@ -26,11 +33,115 @@ def find_fastq_dirs(base_dir, single=False, extension=".fastq.gz"):
 
     return sorted(fastq_entries)
 
+def scan_sample_dir(path, extension=".fastq.gz"):
+    """Return (fastq file count, total bytes, subdirectories) of a directory."""
+    file_count = 0
+    total_bytes = 0
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in SKIPPED_DIRS:
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(extension):
+                file_count += 1
+                total_bytes += entry.stat().st_size
+    return file_count, total_bytes, subdirs
+
+def scan_tree(path, depth, max_depth=MAX_SCAN_DEPTH, extension=".fastq.gz"):
+    """Return (sample_dir, file count, total bytes) of directories holding fastq files.
+
+    The walk stops at directories which contain fastq files (i.e. barcode
+    directories) and never goes deeper than max_depth below the run directory.
+    """
+    file_count, total_bytes, subdirs = scan_sample_dir(path, extension)
+    if file_count:
+        return [(path, file_count, total_bytes)]
+    if depth >= max_depth:
+        return []
+    found = []
+    for subdir in subdirs:
+        found.extend(scan_tree(subdir, depth + 1, max_depth, extension))
+    return found
+
+def scan_single_files(path, depth, max_depth=MAX_SCAN_DEPTH, extension=".fastq.gz"):
+    """Return (sample, fastq file, 1, bytes) of the fastq files of a directory and its subdirectories.
+
+    Each fastq file is a sample named after the file, and the walk never goes
+    deeper than max_depth below the run directory.
+    """
+    found = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in SKIPPED_DIRS:
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(extension):
+                found.append((entry.name[:-len(extension)], entry.path, 1, entry.stat().st_size))
+    if depth < max_depth:
+        for subdir in subdirs:
+            found.extend(scan_single_files(subdir, depth + 1, max_depth, extension))
+    return found
+
+def scan_fastq_dirs(base_dir, single=False, extension=".fastq.gz", threads=8, max_depth=MAX_SCAN_DEPTH):
+    """Discover samples concurrently and record their file count and size.
+
+    Each top-level directory of the run is walked in its own thread with
+    os.scandir, which is latency bound on network storage. As in
+    find_fastq_dirs, a sample is named after the top-level directory holding
+    its fastq files, or after its fastq file with --single.
+    Returns sorted (sample, path, file_count, total_bytes) tuples.
+    """
+    _, _, subdirs = scan_sample_dir(base_dir, extension)
+    if single:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = pool.map(lambda d: scan_single_files(d, 1, max_depth, extension), subdirs)
+            fastq_entries = scan_single_files(base_dir, max_depth, max_depth, extension)
+            fastq_entries += [found for result in results for found in result]
+        return sorted(fastq_entries)
+
+    file_count, total_bytes, _ = scan_sample_dir(base_dir, extension)
+    if file_count:
+        return [(os.path.basename(base_dir), base_dir, file_count, total_bytes)]
+
+    def scan_top_level(subdir):
+        sample = os.path.basename(subdir)
+        return [(sample, path, count, size) for path, count, size in scan_tree(subdir, 1, max_depth, extension)]
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = pool.map(scan_top_level, subdirs)
+        return sorted(found for result in results for found in result)
+
+def duplicated_samples(fastq_entries):
+    """Return the sample names given to more than one fastq path."""
+    counts = Counter(entry[0] for entry in fastq_entries)
+    return sorted(sample for sample, count in counts.items() if count > 1)
+
+def write_sized_sample_sheet(fastq_entries, output_path, single=False):
+    """Write the samplesheet with the file_count and total_bytes of each sample."""
+    if not fastq_entries:
+        print("No .fastq.gz files found in any subdirectories.")
+        return
+    duplicated = duplicated_samples(fastq_entries)
+    if duplicated:
+        # e.g. several barcode directories below the same top-level directory
+        print(f"Warning: sample names found for more than one fastq path, rename them in the samplesheet: {', '.join(duplicated)}")
+    with open(output_path, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["sampleid","fastq_path","target_organism","target_gene","target_size","fwd_primer","rev_primer","test","method","file_count","total_bytes"])
+        for sample, path, file_count, total_bytes in fastq_entries:
+            fastq_path = path if single else f"{path}/*fastq.gz"
+            writer.writerow([sample, fastq_path, "", "", "", "", "", "", "", file_count, total_bytes])
+    print(f"Found {len(fastq_entries)} samples ({sum(e[3] for e in fastq_entries)} bytes). Output written to: {output_path}")
+
 def main():
     parser = argparse.ArgumentParser(description="Find directories or subdirectories containing FASTQ files.")
     parser.add_argument("-d",  "--directory", help="Path to base directory to search")
     parser.add_argument("-o", "--output", default="index.csv", help="Output csv file to save the directory paths")
     parser.add_argument("-s", "--single", help="Specify whether there is only a single fastq.gz file per sample", action="store_true")
+    parser.add_argument("-p", "--parallel", help="Scan barcode directories concurrently and record the number and size of fastq.gz files per sample", action="store_true")
+    parser.add_argument("-t", "--threads", type=int, default=8, help="Number of directories scanned concurrently with --parallel")
 
     args = parser.parse_args()
 
@@ -42,6 +153,11 @@ def main():
         print(f"Error: '{base_dir}' is not a valid directory.")
         return
 
+    if args.parallel:
+        fastq_entries = scan_fastq_dirs(base_dir, args.single, threads=args.threads)
+        write_sized_sample_sheet(fastq_entries, output_path, args.single)
+        return
+
     fastq_entries = find_fastq_dirs(base_dir, args.single)
 
     if fastq_entries:
@@ -2,7 +2,19 @@
 import argparse
 import pandas as pd
 import os.path
-from Bio import SeqIO
+import re
+
+from instrumentation import Metrics, add_profile_argument
+
+# CLUSTER2FASTA names each consensus after its RATTLE cluster and read count, e.g. cluster_0_RC1105
+CLUSTER_SIZE = re.compile(r"_RC(\d+)")
+
+TOP_HIT_COLUMNS = ['sgi', 'sacc', 'length', 'nident', 'pident', 'mismatch',
+                   'gaps', 'gapopen', 'qstart', 'qend', 'qlen', 'sstart',
+                   'send', 'slen', 'sstrand', 'evalue', 'bitscore',
+                   'qcovhsp', 'stitle', 'staxids', 'qseq', 'sseq',
+                   'sseqid', 'qcovs', 'qframe', 'sframe', 'species',
+                   'broad_taxonomic_category', 'FullLineage', 'target_organism_match', 'n_read_cont_cluster']
 
 
 def main():
@@ -11,52 +23,99 @@ def main():
     parser.add_argument("--fasta", type=str, required=True, help='provide fasta file')
     parser.add_argument("--sample", type=str, required=True, help='provide sample name')
     parser.add_argument("--tophits", type=str, required=True, help='provide blast top hits')
+    add_profile_argument(parser)
     args = parser.parse_args()
     fasta_file = args.fasta
     sample_name = args.sample
     blast = args.tophits
-    if os.path.getsize(blast) > 0:
-        fasta_df = fasta_to_dataframe(fasta_file)
-    else:
-        fasta_df = pd.DataFrame(columns=["qseqid", "consensus_seq"])
-
-    if os.path.getsize(blast) > 0:
-        blastn_results = pd.read_csv(blast, sep="\t", header=0)
-        blastn_results.drop(['sample_name'], axis=1, inplace=True)
-        merged_df = pd.merge(fasta_df, blastn_results, on = ['qseqid'], how = 'outer')
-        merged_df.insert(0, "sample_name", sample_name)
-        merged_df['n_read_cont_cluster'] = merged_df['qseqid'].str.split('_').str[2]
-        merged_df['n_read_cont_cluster'] = merged_df['n_read_cont_cluster'].str.replace("RC","").astype(int)
-        merged_df = merged_df.sort_values(["n_read_cont_cluster"], ascending=[False])
-
-        # merged_df.to_csv(str(sample_name) + "_blastn_top_hits.txt", index=None, sep="\t")
-        merged_df.to_csv(os.path.basename(blast).replace("_top_hits_tmp.txt", "_top_hits.txt"), index=None, sep="\t")
-
-    else:
-        print("DataFrame is empty!")
-        for col in ['sgi', 'sgi', 'sacc', 'length', 'nident', 'pident', 'mismatch', 
-                    'gaps', 'gapopen', 'qstart', 'qend', 'qlen', 'sstart', 
-                    'send', 'slen', 'sstrand', 'evalue', 'bitscore', 
-                    'qcovhsp', 'stitle', 'staxids', 'qseq', 'sseq', 
-                    'sseqid', 'qcovs', 'qframe', 'sframe', 'species', 
-                    'broad_taxonomic_category', 'FullLineage', 'target_organism_match', 'n_read_cont_cluster']:
-            if col not in fasta_df.columns:
-                fasta_df[col] = None
-                fasta_df.to_csv(os.path.basename(blast).replace("_top_hits_tmp.txt", "_top_hits.txt"), index=None, sep="\t")
-# Function to convert FASTA file to DataFrame
-def fasta_to_dataframe(fasta_file):
-    records = SeqIO.parse(fasta_file, "fasta")
-    
-    # List to hold the sequence data
-    data = []
-    
-    for record in records:
-        # Append ID and sequence to the list
-        data.append([record.id, str(record.seq)])
-    
-    # Create a DataFrame
-    df = pd.DataFrame(data, columns=["qseqid", "consensus_seq"])
-    return df
+    out_file = os.path.basename(blast).replace("_top_hits_tmp.txt", "_top_hits.txt")
+    with Metrics("fasta2table", sample_name, args.profile) as metrics:
+        with metrics.span("parse"):
+            if os.path.getsize(blast) > 0:
+                fasta_df = read_consensus(fasta_file)
+            else:
+                fasta_df = pd.DataFrame(columns=["qseqid", "consensus_seq"])
+        metrics.rows("consensus", len(fasta_df))
+
+        if os.path.getsize(blast) > 0:
+            with metrics.span("merge"):
+                blastn_results = pd.read_csv(blast, sep="\t", header=0)
+                merged_df = add_consensus(fasta_df, blastn_results, sample_name)
+
+            # merged_df.to_csv(str(sample_name) + "_blastn_top_hits.txt", index=None, sep="\t")
+            with metrics.span("write"):
+                merged_df.to_csv(out_file, index=None, sep="\t")
+            metrics.rows("output", len(merged_df))
+
+        else:
+            print("DataFrame is empty!")
+            empty_top_hits(fasta_df).to_csv(out_file, index=None, sep="\t")
+
+
+def add_consensus(fasta_df, blastn_results, sample_name):
+    """Join the top blast hits to the consensus sequences, largest clusters first.
+
+    fasta_df comes from read_consensus(), already sorted by cluster size, so
+    the left hash join keeps its order. Hits for a consensus missing from the
+    fasta file are appended, as the previous outer join did.
+    """
+    blastn_results = blastn_results.drop(['sample_name'], axis=1)
+    merged_df = fasta_df.merge(blastn_results, on='qseqid', how='left', sort=False)
+    missing = blastn_results[~blastn_results['qseqid'].isin(fasta_df['qseqid'])]
+    if len(missing):
+        missing = missing.assign(n_read_cont_cluster=[cluster_size(qseqid) for qseqid in missing['qseqid']])
+        merged_df = pd.concat([merged_df, missing], ignore_index=True).sort_values(
+            "n_read_cont_cluster", ascending=False, kind="stable")
+    merged_df.insert(0, "sample_name", sample_name)
+    # n_read_cont_cluster is the last column of the table
+    merged_df['n_read_cont_cluster'] = merged_df.pop('n_read_cont_cluster')
+    return merged_df
+
+
+def empty_top_hits(fasta_df):
+    """Add the blast hit columns, left empty, to the consensus table of a sample without hits."""
+    for col in TOP_HIT_COLUMNS:
+        if col not in fasta_df.columns:
+            fasta_df[col] = None
+    return fasta_df
+
+
+def cluster_size(qseqid):
+    """Return the number of reads of a RATTLE cluster from its _RC<n> name suffix."""
+    match = CLUSTER_SIZE.search(qseqid)
+    if match is None:
+        raise ValueError(f"No read count (_RC<n>) in consensus name: {qseqid}")
+    return int(match.group(1))
+
+
+def read_consensus(fasta_file):
+    """Read the consensus fasta into a table sorted by decreasing cluster size.
+
+    The file is streamed line by line and the cluster size written by
+    CLUSTER2FASTA in each header is parsed as the record is read.
+    """
+    qseqids, seqs, sizes = [], [], []
+    seq_lines = []
+    with open(fasta_file) as f:
+        for line in f:
+            if line.startswith(">"):
+                if qseqids:
+                    seqs.append("".join(seq_lines))
+                    seq_lines = []
+                qseqid = line[1:].split(None, 1)[0]
+                qseqids.append(qseqid)
+                sizes.append(cluster_size(qseqid))
+            else:
+                seq_lines.append(line.strip())
+    if qseqids:
+        seqs.append("".join(seq_lines))
+
+    df = pd.DataFrame({
+        "qseqid": pd.Series(qseqids, dtype="str"),
+        "consensus_seq": pd.Series(seqs, dtype="str"),
+        "n_read_cont_cluster": pd.Series(sizes, dtype="int64"),
+    })
+    return df.sort_values("n_read_cont_cluster", ascending=False, kind="stable", ignore_index=True)
 
 
 if __name__ == "__main__":
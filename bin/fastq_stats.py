@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""Derive NanoStats-compatible read statistics from a (gzipped) FASTQ file.
+
+The file is streamed once: compressed blocks are inflated in fixed-size
+chunks and read lengths and mean qualities are accumulated in NumPy arrays,
+so the read counts needed by the QC report are available without running
+the full NanoPlot plotting tool. BGZF files (e.g. written by bgzip or
+`ont_amplicon bgzf`) are inflated on --threads threads.
+"""
+import argparse
+import zlib
+
+import numpy as np
+
+import bgzf
+
+CHUNK_SIZE = 4 * 1024 * 1024
+PHRED_OFFSET = 33
+# Error probability for each possible quality byte value
+ERROR_PROBS = 10 ** (-(np.arange(256, dtype=np.float64) - PHRED_OFFSET).clip(0) / 10)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fastq", type=str, required=True, help="FASTQ file, optionally gzipped")
+    parser.add_argument("--prefix", type=str, required=True, help="Output prefix, e.g. {sampleid}_raw_")
+    parser.add_argument("--bin_width", type=int, default=50, help="Read length histogram bin width")
+    parser.add_argument("--threads", type=int, default=1, help="Threads used to inflate BGZF input")
+    return parser.parse_args()
+
+
+def iter_chunks(path, chunk_size=CHUNK_SIZE, threads=1):
+    """Yield decompressed blocks of a FASTQ file.
+
+    BGZF files are inflated block-wise on a thread pool. Other multi-member
+    gzip files (e.g. concatenated fastq.gz files) are handled by restarting
+    the decompressor on any unused trailing data.
+    """
+    if threads > 1 and bgzf.is_bgzf(path):
+        yield from bgzf.iter_chunks(path, threads)
+        return
+
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+        f.seek(0)
+        if magic != b'\x1f\x8b':
+            while chunk := f.read(chunk_size):
+                yield chunk
+            return
+
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        while raw := f.read(chunk_size):
+            while raw:
+                chunk = decompressor.decompress(raw)
+                if chunk:
+                    yield chunk
+                raw = decompressor.unused_data
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                else:
+                    break
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+def iter_line_blocks(chunks):
+    """Yield lists of the lines of complete FASTQ records, four per record."""
+    remainder = b''
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        n_complete = len(lines) - len(lines) % 4
+        if n_complete:
+            yield lines[:n_complete]
+        remainder = b'\n'.join(lines[n_complete:] + [remainder])
+    lines = remainder.split(b'\n')
+    n_complete = len(lines) - len(lines) % 4
+    if n_complete:
+        yield lines[:n_complete]
+
+
+def iter_record_blocks(chunks):
+    """Yield (sequences, qualities) lists of complete FASTQ records."""
+    for lines in iter_line_blocks(chunks):
+        yield lines[1::4], lines[3::4]
+
+
+def block_stats(seqs, quals):
+    """Return read lengths and per-read mean qualities for a block of reads.
+
+    The mean quality of a read is computed in error-probability space, as
+    NanoPlot does, rather than as the arithmetic mean of Phred scores.
+    """
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    qual_bytes = np.frombuffer(b''.join(quals), dtype=np.uint8)
+    qual_lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+    mean_quals = np.zeros(len(quals), dtype=np.float64)
+    has_qual = qual_lengths > 0
+    if has_qual.any():
+        offsets = np.concatenate(([0], np.cumsum(qual_lengths)[:-1]))[has_qual]
+        error_sums = np.add.reduceat(ERROR_PROBS[qual_bytes], offsets)
+        mean_quals[has_qual] = -10 * np.log10(error_sums / qual_lengths[has_qual])
+    return lengths, mean_quals
+
+
+def collect_stats(path, chunk_size=CHUNK_SIZE, threads=1):
+    """Return arrays of read lengths and per-read mean qualities."""
+    lengths, quals = [], []
+    for seqs, qual_lines in iter_record_blocks(iter_chunks(path, chunk_size, threads)):
+        block_lengths, block_quals = block_stats(seqs, qual_lines)
+        lengths.append(block_lengths)
+        quals.append(block_quals)
+    if not lengths:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    return np.concatenate(lengths), np.concatenate(quals)
+
+
+def n50(lengths):
+    """Return the read length at which half of the bases are in longer reads."""
+    if not len(lengths):
+        return 0
+    sorted_lengths = np.sort(lengths)[::-1]
+    cumulative = np.cumsum(sorted_lengths)
+    return int(sorted_lengths[np.searchsorted(cumulative, cumulative[-1] / 2)])
+
+
+def summarise(lengths, quals):
+    """Return an ordered dict of NanoStats metrics."""
+    if not len(lengths):
+        return {"number_of_reads": 0}
+    return {
+        "number_of_reads": int(len(lengths)),
+        "number_of_bases": float(lengths.sum()),
+        "median_read_length": float(np.median(lengths)),
+        "mean_read_length": round(float(lengths.mean()), 1),
+        "read_length_stdev": round(float(lengths.std()), 1),
+        "n50": float(n50(lengths)),
+        "mean_qual": round(float(quals.mean()), 1),
+        "median_qual": round(float(np.median(quals)), 1),
+    }
+
+
+def length_histogram(lengths, bin_width=50):
+    """Return (bin_start, read_count) arrays for a fixed-width length histogram."""
+    if not len(lengths):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    counts = np.bincount(lengths // bin_width)
+    starts = np.arange(len(counts), dtype=np.int64) * bin_width
+    return starts, counts
+
+
+def write_nanostats(stats, path):
+    """Write metrics in the NanoPlot --tsv_stats layout."""
+    with open(path, 'w') as f:
+        f.write("Metrics\tdataset\n")
+        for metric, value in stats.items():
+            f.write(f"{metric}\t{value}\n")
+
+
+def write_histogram(starts, counts, bin_width, path):
+    with open(path, 'w') as f:
+        f.write("bin_start\tbin_end\tread_count\n")
+        for start, count in zip(starts, counts):
+            f.write(f"{start}\t{start + bin_width - 1}\t{count}\n")
+
+
+def read_nanostats(path):
+    """Return the metrics of a NanoStats file as a dict of floats."""
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().split("\t")
+            if len(fields) != 2:
+                continue
+            try:
+                stats[fields[0]] = float(fields[1])
+            except ValueError:
+                continue
+    return stats
+
+
+def main():
+    args = parse_args()
+    lengths, quals = collect_stats(args.fastq, threads=args.threads)
+    stats = summarise(lengths, quals)
+    write_nanostats(stats, f"{args.prefix}NanoStats.txt")
+    starts, counts = length_histogram(lengths, args.bin_width)
+    write_histogram(starts, counts, args.bin_width, f"{args.prefix}LengthHistogram.txt")
+    print(f"{args.fastq}: {stats['number_of_reads']} reads")
+
+
+if __name__ == "__main__":
+    main()
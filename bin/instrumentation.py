@@ -0,0 +1,130 @@
+"""Record where the time and memory of a pipeline script goes.
+
+Each script opens a Metrics context for its stage, wraps its main steps in
+named spans and records the number of rows it handled. On exit a small
+JSON file ``{sample}_{stage}_metrics.json`` is written to the working
+directory, e.g.:
+
+    with Metrics("derive_coverage_stats", args.sample, args.profile) as metrics:
+        with metrics.span("parse"):
+            df = pd.read_csv(...)
+        metrics.rows("blast_hits", len(df))
+
+With profile=True (the --profile switch added by add_profile_argument),
+cProfile and tracemalloc are also enabled and their output is dumped to
+``{sample}_{stage}.prof`` and ``{sample}_{stage}_tracemalloc.txt``.
+"""
+
+import cProfile
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+TRACEMALLOC_TOP = 25
+
+
+def add_profile_argument(parser):
+    """Add the opt-in --profile switch to a script's argument parser."""
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Dump cProfile and tracemalloc output alongside the metrics file",
+    )
+    return parser
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kB on Linux
+    if sys.platform == "darwin":
+        return round(peak / 1024 ** 2, 1)
+    return round(peak / 1024, 1)
+
+
+class Metrics:
+    """Collect named spans, peak RSS and row counts of a pipeline stage."""
+
+    def __init__(self, stage, sample=None, profile=False):
+        self.stage = stage
+        self.sample = sample
+        self.profile = profile
+        self.spans = []
+        self.row_counts = {}
+        self._profiler = None
+        self._start = None
+        self._started_at = None
+
+    @property
+    def prefix(self):
+        if self.sample:
+            return f"{self.sample}_{self.stage}"
+        return self.stage
+
+    def __enter__(self):
+        self._started_at = datetime.now().isoformat(timespec="seconds")
+        self._start = time.perf_counter()
+        if self.profile:
+            tracemalloc.start()
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._profiler:
+            self._profiler.disable()
+        self.write(failed=exc_type is not None)
+        if self.profile:
+            self._write_profile()
+        return False
+
+    @contextmanager
+    def span(self, name):
+        """Time a named step of the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append({
+                "name": name,
+                "seconds": round(time.perf_counter() - start, 3),
+                "peak_rss_mb": peak_rss_mb(),
+            })
+
+    def rows(self, name, count):
+        """Record the number of rows of a table handled by the stage."""
+        self.row_counts[name] = int(count)
+
+    def to_json(self):
+        return {
+            "stage": self.stage,
+            "sample": self.sample,
+            "started": self._started_at,
+            "wall_seconds": round(time.perf_counter() - self._start, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "spans": self.spans,
+            "rows": self.row_counts,
+        }
+
+    def write(self, failed=False):
+        data = self.to_json()
+        data["failed"] = failed
+        path = f"{self.prefix}_metrics.json"
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+        return path
+
+    def _write_profile(self):
+        self._profiler.dump_stats(f"{self.prefix}.prof")
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(f"{self.prefix}_tracemalloc.txt", "w") as f:
+            f.write(f"current: {current / 1024 ** 2:.1f} MB,"
+                    f" peak: {peak / 1024 ** 2:.1f} MB\n")
+            for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                f.write(f"{stat}\n")
@@ -0,0 +1,152 @@
+"""Skip a Python stage when its inputs, parameters and code are unchanged.
+
+Nextflow's -resume is invalidated as soon as a script changes, so after a
+change to e.g. the report styling every Python stage of the plate reparses
+its inputs. With a manifest directory, a stage records for each of its
+outputs a manifest of what it was computed from:
+
+    manifest = Manifest(args.manifest_dir, f"{sample}_derive_coverage_stats",
+                        inputs={"coverage": args.coverage, ...},
+                        params={"target_size": args.target_size},
+                        code=[__file__])
+    if not manifest.restore(outputs):
+        ...compute the outputs...
+        manifest.save(outputs)
+
+and keeps a copy of the outputs next to the manifest. When the inputs
+(hashed while streaming them, or by size and mtime above LARGE_FILE_SIZE,
+e.g. BAM files), the parameters and the source files of the stage all
+match, restore() copies the kept outputs back instead. Without a manifest
+directory restore() always returns False and save() does nothing.
+
+A stage with independent parts, such as the report page and the BAM
+viewer of build_report.py, uses one manifest per part, so that only the
+parts whose inputs changed are recomputed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from functools import cached_property
+from pathlib import Path
+
+# Files above this size are identified by their size and mtime instead of their content
+LARGE_FILE_SIZE = 256 * 1024 ** 2
+CHUNK_SIZE = 1024 ** 2
+MANIFEST_VERSION = 1
+
+
+def file_digest(path, large_file_size=LARGE_FILE_SIZE):
+    """Return a digest of a file (or directory), None if it does not exist."""
+    if path is None:
+        return None
+    path = Path(path)
+    if path.is_dir():
+        # Identify a directory (e.g. a database) by the names, sizes and mtimes of its files
+        h = hashlib.sha256()
+        for child in sorted(p for p in path.rglob("*") if p.is_file()):
+            stat = child.stat()
+            h.update(f"{child.relative_to(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return "dir:" + h.hexdigest()
+    if not path.is_file():
+        return None
+    stat = path.stat()
+    if stat.st_size > large_file_size:
+        return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return "sha256:" + h.hexdigest()
+
+
+def code_digest(paths):
+    """Return a digest of the content of the source files (or directories) of a stage."""
+    h = hashlib.sha256()
+    for path in paths:
+        path = Path(path)
+        files = sorted(p for p in path.rglob("*") if p.is_file() and "__pycache__" not in p.parts) \
+            if path.is_dir() else [path]
+        for child in files:
+            h.update(child.name.encode() + b"\0")
+            h.update(child.read_bytes())
+    return h.hexdigest()
+
+
+class Manifest:
+    """Manifest of the inputs, parameters and code of (a part of) a stage."""
+
+    def __init__(self, directory, name, inputs, params=None, code=()):
+        self.directory = Path(directory) if directory else None
+        self.name = name
+        self.inputs = inputs
+        self.params = params or {}
+        self.code = code
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    @property
+    def path(self):
+        return self.directory / f"{self.name}_manifest.json"
+
+    @property
+    def output_dir(self):
+        return self.directory / self.name
+
+    @cached_property
+    def key(self):
+        """What the outputs are computed from."""
+        return {
+            "version": MANIFEST_VERSION,
+            "inputs": {name: file_digest(path) for name, path in sorted(self.inputs.items())},
+            "params": {name: str(value) for name, value in sorted(self.params.items())},
+            "code": code_digest(self.code),
+        }
+
+    def restore(self, outputs):
+        """Copy the kept outputs back to their paths if nothing changed, return whether they were."""
+        if not self.enabled or not self.path.is_file():
+            return False
+        with self.path.open() as f:
+            recorded = json.load(f)
+        kept = [self.output_dir / Path(output).name for output in outputs]
+        if recorded.get("key") != self.key or not all(path.is_file() for path in kept):
+            return False
+        if recorded.get("outputs") != {path.name: file_digest(path) for path in kept}:
+            return False
+        for path, output in zip(kept, outputs):
+            shutil.copyfile(path, output)
+        return True
+
+    def save(self, outputs):
+        """Keep a copy of the outputs and record the manifest they were computed from."""
+        if not self.enabled:
+            return
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        kept = []
+        for output in outputs:
+            path = self.output_dir / Path(output).name
+            shutil.copyfile(output, path)
+            kept.append(path)
+        manifest = {
+            "key": self.key,
+            "outputs": {path.name: file_digest(path) for path in kept},
+        }
+        # Written last and atomically, so that an interrupted save is never taken as current
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def add_manifest_argument(parser):
+    """Add the opt-in --manifest_dir option to a script's argument parser."""
+    parser.add_argument(
+        "--manifest_dir",
+        type=str,
+        help="Directory of the manifests and kept outputs used to skip this stage when nothing changed",
+    )
+    return parser
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Extract the reads mapped to each consensus from a sorted BAM file.
+
+The BAM file of the reads mapped back to the consensus sequences
+(SampleName_aln.sorted.bam) is read in a single streaming pass, its BGZF
+blocks inflated on several threads, and a table of the mapped reads is
+written to SampleName_read_lengths.npy:
+
+    read_id  name of the read
+    contig   consensus the read is mapped to, one row per read and consensus
+    length   length of the read, hard clips included
+
+sorted by read and consensus. It is a plain NumPy structured array, which
+derive_coverage_stats.py memory-maps instead of rescanning the reads. The
+length of a read is its length in the primary record, or the longest one of
+its records, as secondary records usually leave the sequence out and
+supplementary records may be hard clipped. With --fasta the reads are also
+written to a FASTA file, from their primary record and on their original
+strand.
+"""
+import argparse
+import struct
+
+import numpy as np
+
+from bgzf import iter_chunks
+from instrumentation import Metrics, add_profile_argument
+
+BAM_MAGIC = b"BAM\x01"
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+RECORD = struct.Struct("<iiBBHHHiiii")
+INT32 = struct.Struct("<i")
+FLAG_UNMAPPED = 0x4
+FLAG_REVERSE = 0x10
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+CIGAR_HARD_CLIP = 5
+# M, I, S, =, X and H: the CIGAR operations that consume the read
+READ_OPS = np.zeros(16, dtype=bool)
+READ_OPS[[0, 1, 4, 7, 8, CIGAR_HARD_CLIP]] = True
+SEQ_CODES = np.frombuffer(b"=ACMGRSVTWYHKDBN", dtype=np.uint8)
+COMPLEMENT = bytes.maketrans(b"ACGTMRWSYKVHDBN=", b"TGCAKYWSRMBDHVN=")
+FASTA_LINE_WIDTH = 60
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sample", type=str, required=True, help="Provide sample name")
+    parser.add_argument("--bam", type=str, required=True, help="Sorted BAM file of the reads mapped to the consensus")
+    parser.add_argument("--fasta", type=str, help="Also write the mapped reads to this FASTA file")
+    parser.add_argument("-@", "--threads", type=int, default=1, help="Number of threads (default: 1)")
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+
+def _read_header(data):
+    """Return the reference names of a BAM header and the offset of the first record, None if incomplete."""
+    if len(data) < 12:
+        return None
+    if data[:4] != BAM_MAGIC:
+        raise ValueError("Not a BAM file")
+    offset = 8 + INT32.unpack_from(data, 4)[0]
+    if len(data) < offset + 4:
+        return None
+    n_ref = INT32.unpack_from(data, offset)[0]
+    offset += 4
+    references = []
+    for _ in range(n_ref):
+        if len(data) < offset + 4:
+            return None
+        l_name = INT32.unpack_from(data, offset)[0]
+        if len(data) < offset + 8 + l_name:
+            return None
+        references.append(bytes(data[offset + 4:offset + 3 + l_name]))
+        offset += 8 + l_name
+    return references, offset
+
+
+def read_length(data, cigar_offset, n_cigar_op, l_seq):
+    """Return the length of a read from the CIGAR and sequence length of one of its records."""
+    if n_cigar_op == 0:
+        return l_seq
+    if l_seq:
+        # Hard clips are only found at either end of the CIGAR
+        first, last = struct.unpack_from("<I", data, cigar_offset)[0], \
+            struct.unpack_from("<I", data, cigar_offset + 4 * (n_cigar_op - 1))[0]
+        clipped = (first >> 4 if first & 0xf == CIGAR_HARD_CLIP else 0) \
+            + (last >> 4 if last & 0xf == CIGAR_HARD_CLIP and n_cigar_op > 1 else 0)
+        return l_seq + clipped
+    cigar = np.frombuffer(data, dtype="<u4", count=n_cigar_op, offset=cigar_offset)
+    return int((cigar >> 4)[READ_OPS[cigar & 0xf]].sum())
+
+
+def decode_sequence(data, offset, l_seq, reverse=False):
+    """Return the sequence of a record, on the original strand of the read if reverse."""
+    packed = np.frombuffer(data, dtype=np.uint8, count=(l_seq + 1) // 2, offset=offset)
+    codes = np.empty(2 * len(packed), dtype=np.uint8)
+    codes[0::2] = packed >> 4
+    codes[1::2] = packed & 0xf
+    seq = SEQ_CODES[codes[:l_seq]].tobytes()
+    return seq.translate(COMPLEMENT)[::-1] if reverse else seq
+
+
+def iter_records(path, threads=1):
+    """Yield the reference names of a BAM file, then (read, reference, length, sequence) per mapped record.
+
+    The sequence is only decoded for the primary records, None otherwise.
+    """
+    buffer = b""
+    references = None
+    for chunk in iter_chunks(path, threads):
+        data = buffer + chunk
+        offset = 0
+        if references is None:
+            header = _read_header(data)
+            if header is None:
+                buffer = data
+                continue
+            references, offset = header
+            yield references
+        end = len(data)
+        while offset + 4 <= end:
+            block_size = INT32.unpack_from(data, offset)[0]
+            if offset + 4 + block_size > end:
+                break
+            ref_id, _, l_read_name, _, _, n_cigar_op, flag, l_seq, _, _, _ = RECORD.unpack_from(data, offset + 4)
+            next_offset = offset + 4 + block_size
+            if ref_id >= 0 and not flag & FLAG_UNMAPPED:
+                name_offset = offset + 4 + RECORD.size
+                cigar_offset = name_offset + l_read_name
+                read_id = data[name_offset:cigar_offset - 1]
+                sequence = None
+                if l_seq and not flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY):
+                    sequence = decode_sequence(data, cigar_offset + 4 * n_cigar_op, l_seq, flag & FLAG_REVERSE)
+                yield read_id, ref_id, read_length(data, cigar_offset, n_cigar_op, l_seq), sequence
+            offset = next_offset
+        buffer = data[offset:]
+    if buffer and references is not None:
+        raise ValueError(f"{path} ends with a truncated BAM record")
+
+
+def mapped_reads(path, threads=1, fasta=None):
+    """Return the table of the reads mapped to each consensus, writing their sequences to fasta if given."""
+    records = iter_records(path, threads)
+    references = next(records, [])
+    pairs = set()
+    lengths = {}
+    for read_id, ref_id, length, sequence in records:
+        pairs.add((read_id, ref_id))
+        lengths[read_id] = max(length, lengths.get(read_id, 0))
+        if fasta is not None and sequence is not None:
+            fasta.write(b">" + read_id + b"\n")
+            for i in range(0, len(sequence), FASTA_LINE_WIDTH):
+                fasta.write(sequence[i:i + FASTA_LINE_WIDTH] + b"\n")
+    rows = sorted((read_id, references[ref_id]) for read_id, ref_id in pairs)
+    dtype = [
+        ("read_id", f"S{max((len(read_id) for read_id, _ in rows), default=1)}"),
+        ("contig", f"S{max((len(contig) for _, contig in rows), default=1)}"),
+        ("length", "<u4"),
+    ]
+    return np.array([(read_id, contig, lengths[read_id]) for read_id, contig in rows], dtype=dtype)
+
+
+def main():
+    args = parse_args()
+    with Metrics("mapped_reads", args.sample, args.profile) as metrics:
+        with metrics.span("parse"):
+            if args.fasta:
+                with open(args.fasta, "wb") as fasta:
+                    table = mapped_reads(args.bam, args.threads, fasta)
+            else:
+                table = mapped_reads(args.bam, args.threads)
+        metrics.rows("reads", len(np.unique(table["read_id"])))
+        metrics.rows("mappings", len(table))
+        with metrics.span("write"):
+            np.save(f"{args.sample}_read_lengths.npy", table)
+
+
+if __name__ == "__main__":
+    main()
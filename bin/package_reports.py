@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""Package the reports and consensus sequences of a run for download.
+
+The HTML reports, run QC reports, BAM viewers and consensus FASTA files of
+every sample, and the run summary page, are streamed straight from the
+result directory into reports.zip, without staging copies:
+
+    reports/run_summary.html
+    reports/SampleName/SampleName_report.html
+    reports/SampleName/run_qc_report.html
+    reports/SampleName/SampleName_bam-alignment.html
+    reports/SampleName/SampleName_final_polished_consensus.fasta
+
+Each member is deflated in CHUNK_SIZE chunks on a pool of threads (zlib
+releases the GIL), as pigz does: every chunk but the last ends on a sync
+flush and is primed with the end of the previous chunk, so the chunks join
+into a single deflate stream. Members that are already compressed (by
+extension, or if their first chunk does not shrink) are stored as they
+are. With --volume_size, the members are split over several archives of
+at most that size (reports_part01.zip, ...), each of which can be opened on
+its own, unless a single member is larger than the volume size.
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ARCHIVE_NAME = "reports"
+# Uncompressed bytes deflated per task
+CHUNK_SIZE = 1024 ** 2
+# Bytes of the previous chunk used as the dictionary of the next one, the deflate window
+DICT_SIZE = 32 * 1024
+# Members stored without compression
+COMPRESSED_SUFFIXES = {".gz", ".bgz", ".bz2", ".xz", ".zst", ".zip", ".bam", ".bai", ".png", ".jpg", ".jpeg"}
+# Members whose first chunk deflates to more than this ratio are stored
+MIN_COMPRESSION_RATIO = 0.95
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+UTF8_FLAG = 0x800
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", required=True, type=str, help="Result directory of the run")
+    parser.add_argument("--output", type=str,
+                        help=f"Archive to write (default: {ARCHIVE_NAME}.zip in the result directory)")
+    parser.add_argument("-@", "--threads", type=int, default=4, help="Number of threads (default: 4)")
+    parser.add_argument("-l", "--level", type=int, default=6, help="Compression level (default: 6)")
+    parser.add_argument("--volume_size", type=int,
+                        help="Split the archive into volumes of at most this size (MB)")
+    return parser.parse_args()
+
+
+def report_members(result_dir):
+    """Return the (path, name in the archive) of the files to package."""
+    result_dir = Path(result_dir)
+    members = []
+    run_summary = result_dir / "00_run_summary" / "run_summary.html"
+    if run_summary.is_file():
+        members.append((run_summary, f"{ARCHIVE_NAME}/run_summary.html"))
+    for sample_dir in sorted(p for p in result_dir.iterdir() if p.is_dir()):
+        report_dir = sample_dir / "07_html_report"
+        if not report_dir.is_dir():
+            continue
+        paths = (
+            sorted(report_dir.glob("*_report.html"))
+            + sorted(report_dir.glob("*_bam-alignment.html"))
+            + sorted((sample_dir / "03_polishing").glob("*_final_polished_consensus.fasta"))
+        )
+        # run_qc_report.html also matches *_report.html
+        for path in paths:
+            members.append((path, f"{ARCHIVE_NAME}/{sample_dir.name}/{path.name}"))
+    return members
+
+
+def split_volumes(members, volume_size):
+    """Group the members in order into volumes of at most volume_size bytes.
+
+    The size of a member is bounded by its uncompressed size, so a volume
+    only exceeds volume_size when it holds a single larger member.
+    """
+    if not volume_size:
+        return [members]
+    volumes, volume, size = [], [], 0
+    for member in members:
+        member_size = os.path.getsize(member[0]) + 2 * (LOCAL_HEADER.size + len(member[1]) + 64)
+        if volume and size + member_size > volume_size:
+            volumes.append(volume)
+            volume, size = [], 0
+        volume.append(member)
+        size += member_size
+    if volume:
+        volumes.append(volume)
+    return volumes
+
+
+def deflate_chunk(data, zdict, level, last):
+    """Deflate one chunk of a member, primed with the end of the previous chunk."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict) if zdict \
+        else zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def is_compressible(path, chunk):
+    """Return whether a member is worth deflating."""
+    if path.suffix.lower() in COMPRESSED_SUFFIXES:
+        return False
+    if not chunk:
+        return True
+    return len(zlib.compress(chunk, 1)) < MIN_COMPRESSION_RATIO * len(chunk)
+
+
+def _dos_datetime(path):
+    t = time.localtime(os.path.getmtime(path))
+    year = max(t.tm_year, 1980)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipWriter:
+    """Write a zip archive whose members are deflated on a pool of threads.
+
+    The local header of a member is written first and its CRC and sizes are
+    filled in once the member is written, so the output must be seekable.
+    ZIP64 records are used for members, offsets and counts beyond the limits
+    of the zip format.
+    """
+
+    def __init__(self, out, pool, threads=1, level=6):
+        self.out = out
+        self.pool = pool
+        self.threads = threads
+        self.level = level
+        self.entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def add(self, path, name):
+        """Stream the file at path into the archive as name."""
+        path = Path(path)
+        file_size = path.stat().st_size
+        offset = self.out.tell()
+        with path.open("rb") as f:
+            chunk = f.read(CHUNK_SIZE)
+            method = ZIP_DEFLATED if is_compressible(path, chunk) else ZIP_STORED
+            # A local ZIP64 extra field is needed up front if the member may exceed 4 GB
+            zip64 = file_size + file_size // 100 + 1024 >= ZIP64_LIMIT
+            dos_time, dos_date = _dos_datetime(path)
+            name_bytes = name.encode("utf-8")
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0) if zip64 else b""
+            self.out.write(LOCAL_HEADER.pack(
+                0x04034b50, 45 if zip64 else 20, UTF8_FLAG, method, dos_time, dos_date,
+                0, ZIP64_LIMIT if zip64 else 0, ZIP64_LIMIT if zip64 else 0, len(name_bytes), len(extra),
+            ) + name_bytes + extra)
+            crc, compressed_size, size = self._write_data(f, chunk, method)
+        end = self.out.tell()
+        if not zip64 and (size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT):
+            raise ValueError(f"{path} changed size while it was being packaged")
+        # Fill in the CRC and sizes of the local header
+        self.out.seek(offset + 14)
+        if zip64:
+            self.out.write(struct.pack("<I", crc))
+            self.out.seek(offset + LOCAL_HEADER.size + len(name_bytes) + 4)
+            self.out.write(struct.pack("<QQ", size, compressed_size))
+        else:
+            self.out.write(struct.pack("<III", crc, compressed_size, size))
+        self.out.seek(end)
+        self.entries.append((name_bytes, method, dos_time, dos_date, crc, compressed_size, size, offset))
+
+    def _write_data(self, f, chunk, method):
+        """Write the (deflated) data of a member, return its CRC and sizes."""
+        crc, compressed_size, size = 0, 0, 0
+        pending = deque()
+        zdict = b""
+        while True:
+            next_chunk = f.read(CHUNK_SIZE) if chunk else b""
+            last = not next_chunk
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if method == ZIP_STORED:
+                self.out.write(chunk)
+                compressed_size += len(chunk)
+            else:
+                pending.append(self.pool.submit(deflate_chunk, chunk, zdict, self.level, last))
+                zdict = chunk[-DICT_SIZE:]
+                # At most 2 * threads chunks in flight, which bounds memory use for members of any size
+                while pending and (last or len(pending) >= 2 * self.threads):
+                    data = pending.popleft().result()
+                    self.out.write(data)
+                    compressed_size += len(data)
+            if last:
+                return crc, compressed_size, size
+            chunk = next_chunk
+
+    def close(self):
+        """Write the central directory and the end records."""
+        start = self.out.tell()
+        for name_bytes, method, dos_time, dos_date, crc, compressed_size, size, offset in self.entries:
+            zip64_fields = [value for value in (size, compressed_size, offset) if value >= ZIP64_LIMIT]
+            extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields) \
+                if zip64_fields else b""
+            self.out.write(CENTRAL_HEADER.pack(
+                0x02014b50, (3 << 8) | 45, 45 if zip64_fields else 20, UTF8_FLAG, method,
+                dos_time, dos_date, crc,
+                min(compressed_size, ZIP64_LIMIT), min(size, ZIP64_LIMIT),
+                len(name_bytes), len(extra), 0, 0, 0, 0o100644 << 16, min(offset, ZIP64_LIMIT),
+            ) + name_bytes + extra)
+        end = self.out.tell()
+        count = len(self.entries)
+        if count >= ZIP64_COUNT_LIMIT or start >= ZIP64_LIMIT or end - start >= ZIP64_LIMIT:
+            self.out.write(ZIP64_END_RECORD.pack(
+                0x06064b50, ZIP64_END_RECORD.size - 12, 45, 45, 0, 0, count, count, end - start, start,
+            ))
+            self.out.write(ZIP64_END_LOCATOR.pack(0x07064b50, 0, end, 1))
+        self.out.write(END_RECORD.pack(
+            0x06054b50, 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+            min(end - start, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0,
+        ))
+
+
+def write_archive(path, members, pool, threads=1, level=6):
+    """Write the members to a new archive, renamed into place once complete."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as out, ZipWriter(out, pool, threads, level) as archive:
+        for member_path, name in members:
+            archive.add(member_path, name)
+    os.replace(tmp_path, path)
+
+
+def main():
+    args = parse_args()
+    members = report_members(args.dir)
+    if not members:
+        print(f"No reports found in {args.dir}", file=sys.stderr)
+        return 1
+    output = Path(args.output) if args.output else Path(args.dir) / f"{ARCHIVE_NAME}.zip"
+    volumes = split_volumes(members, args.volume_size * 1024 ** 2 if args.volume_size else None)
+    if len(volumes) == 1:
+        paths = [output]
+    else:
+        paths = [output.with_name(f"{output.stem}_part{i:02d}{output.suffix}") for i in range(1, len(volumes) + 1)]
+    with ThreadPoolExecutor(args.threads) as pool:
+        for path, volume in zip(paths, volumes):
+            write_archive(path, volume, pool, args.threads, args.level)
+
+    print("Primary workflow outputs have been zipped")
+    names = " / ".join(f'"{path.name}"' for path in paths)
+    print(f'You can download all workflow reports and sequences by clicking on {names} under the "Results" tab.')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Drop off-target reads and orient the remaining reads before clustering.
+
+Reads are streamed once. A read is dropped if its length is outside
+target_size +/- --length_tolerance, or, when primers are given, if neither
+primer is found at the expected end of the read. Reads carrying the primers
+of the reverse strand are reverse complemented, so that all the reads given
+to RATTLE are on the strand of the forward primer.
+
+Primers are found with a precomputed k-mer index: every k-mer of the forward
+primer, the reverse primer and their reverse complements (degenerate bases
+expanded) is flagged in a lookup table of all 4^k k-mers. The k-mers of the
+first and last --window bases of each read are looked up for a whole block
+of reads at once, and a primer is considered present when enough of its
+k-mers are found. A primer of length L with up to m mismatches still shares
+at least L - k + 1 - m * k k-mers with the read.
+
+The counts of kept, flipped and dropped reads are written to
+{sample}_prefilter.log.
+"""
+import argparse
+from itertools import product
+
+import numpy as np
+
+from bgzf import BgzfWriter
+from fastq_stats import iter_chunks, iter_line_blocks
+from instrumentation import Metrics, add_profile_argument
+
+IUPAC = {
+    "A": "A", "C": "C", "G": "G", "T": "T", "U": "T",
+    "R": "AG", "Y": "CT", "S": "CG", "W": "AT", "K": "GT", "M": "AC",
+    "B": "CGT", "D": "AGT", "H": "ACT", "V": "ACG", "N": "ACGT",
+}
+COMPLEMENT = bytes.maketrans(b"ACGTRYKMBVDHNacgtrykmbvdhn", b"TGCAYRMKVBHDNtgcayrmkvbhdn")
+# 2-bit code of each base, 4 for anything that is not A, C, G or T
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+# Bits of the primer lookup table
+FWD, REV, FWD_RC, REV_RC = 1, 2, 4, 8
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fastq", type=str, required=True, help="FASTQ file, optionally gzipped")
+    parser.add_argument("--sample", type=str, required=True, help="Provide sample name")
+    parser.add_argument("--target_size", type=int, required=True, help="Expected amplicon size")
+    parser.add_argument("--fwd_primer", type=str, help="Forward primer sequence")
+    parser.add_argument("--rev_primer", type=str, help="Reverse primer sequence")
+    parser.add_argument("--length_tolerance", type=float, default=0.2,
+                        help="Keep reads within target_size +/- this fraction (default: 0.2)")
+    parser.add_argument("--max_mismatches", type=int, default=2, help="Mismatches allowed in a primer (default: 2)")
+    parser.add_argument("--kmer", type=int, default=7, help="K-mer size of the primer index (default: 7)")
+    parser.add_argument("--window", type=int, default=100,
+                        help="Number of bases searched for a primer at each end of a read (default: 100)")
+    parser.add_argument("--threads", type=int, default=1, help="Threads used to inflate and compress BGZF")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if bool(args.fwd_primer) != bool(args.rev_primer):
+        parser.error("--fwd_primer and --rev_primer must be given together")
+    return args
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def primer_kmers(primer, k):
+    """Return the sets of codes of the k-mers of a primer, one set per primer position."""
+    kmers = []
+    for start in range(len(primer) - k + 1):
+        codes = set()
+        for kmer in product(*(IUPAC[base] for base in primer[start:start + k].upper())):
+            code = 0
+            for base in kmer:
+                code = (code << 2) | int(BASE_CODES[ord(base)])
+            codes.add(code)
+        kmers.append(codes)
+    return kmers
+
+
+class PrimerIndex:
+    """Lookup table of the k-mers of both primers, in both orientations."""
+
+    def __init__(self, fwd_primer, rev_primer, k=7, max_mismatches=2):
+        if min(len(fwd_primer), len(rev_primer)) < k:
+            raise ValueError(f"Primers must be at least {k} bases long")
+        self.k = k
+        self.table = np.zeros(4 ** k, dtype=np.uint8)
+        self.min_hits = {}
+        for bit, primer in ((FWD, fwd_primer), (REV, rev_primer),
+                            (FWD_RC, reverse_complement(fwd_primer)),
+                            (REV_RC, reverse_complement(rev_primer))):
+            kmers = primer_kmers(primer, k)
+            for codes in kmers:
+                self.table[list(codes)] |= bit
+            self.min_hits[bit] = max(1, len(kmers) - max_mismatches * k)
+
+    def kmer_codes(self, windows):
+        """Return the k-mer codes of an (n_reads, window) array of base codes, -1 where invalid."""
+        n_kmers = windows.shape[1] - self.k + 1
+        codes = np.zeros((windows.shape[0], n_kmers), dtype=np.int64)
+        invalid = np.zeros((windows.shape[0], n_kmers), dtype=bool)
+        for i in range(self.k):
+            column = windows[:, i:i + n_kmers]
+            codes = (codes << 2) | (column & 3)
+            invalid |= column > 3
+        codes[invalid] = -1
+        return codes
+
+    def hits(self, windows, bit):
+        """Return the number of k-mers of a primer found in each window."""
+        codes = self.kmer_codes(windows)
+        flags = np.where(codes >= 0, self.table[codes.clip(0)], 0)
+        return ((flags & bit) > 0).sum(axis=1)
+
+    def orient(self, starts, ends):
+        """Return +1 (forward strand), -1 (reverse strand) or 0 (no primer) for each read."""
+        fwd = ((self.hits(starts, FWD) >= self.min_hits[FWD]).astype(int)
+               + (self.hits(ends, REV_RC) >= self.min_hits[REV_RC]))
+        rev = ((self.hits(starts, REV) >= self.min_hits[REV]).astype(int)
+               + (self.hits(ends, FWD_RC) >= self.min_hits[FWD_RC]))
+        return np.where(fwd >= rev, (fwd > 0).astype(int), -1)
+
+
+def end_windows(seqs, window):
+    """Return the base codes of the first and last window bases of each read."""
+    starts = b"".join(seq[:window].ljust(window, b"N") for seq in seqs)
+    ends = b"".join(seq[-window:].rjust(window, b"N") for seq in seqs)
+    shape = (len(seqs), window)
+    return (BASE_CODES[np.frombuffer(starts, dtype=np.uint8)].reshape(shape),
+            BASE_CODES[np.frombuffer(ends, dtype=np.uint8)].reshape(shape))
+
+
+def prefilter(path, writer, target_size, index=None, length_tolerance=0.2, window=100, threads=1):
+    """Write the kept reads of a FASTQ file and return the read counts."""
+    min_length = target_size * (1 - length_tolerance)
+    max_length = target_size * (1 + length_tolerance)
+    counts = {"reads": 0, "kept": 0, "flipped": 0, "dropped_length": 0, "dropped_no_primer": 0}
+    for lines in iter_line_blocks(iter_chunks(path, threads=threads)):
+        seqs = lines[1::4]
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        on_target = (lengths >= min_length) & (lengths <= max_length)
+        strands = np.ones(len(seqs), dtype=int)
+        if index is not None:
+            strands[on_target] = index.orient(*end_windows([s for s, keep in zip(seqs, on_target) if keep], window))
+        counts["reads"] += len(seqs)
+        counts["dropped_length"] += int((~on_target).sum())
+        counts["dropped_no_primer"] += int((on_target & (strands == 0)).sum())
+
+        for i in np.flatnonzero(on_target & (strands != 0)):
+            header, seq, plus, qual = lines[4 * i:4 * i + 4]
+            if strands[i] < 0:
+                seq, qual = reverse_complement(seq), qual[::-1]
+                counts["flipped"] += 1
+            writer.write(b"\n".join((header, seq, plus, qual)) + b"\n")
+            counts["kept"] += 1
+    return counts
+
+
+def write_log(counts, path):
+    with open(path, "w") as f:
+        for name, count in counts.items():
+            f.write(f"{name}\t{count}\n")
+
+
+def main():
+    args = parse_args()
+    with Metrics("primer_prefilter", args.sample, args.profile) as metrics:
+        index = None
+        if args.fwd_primer:
+            index = PrimerIndex(args.fwd_primer, args.rev_primer, args.kmer, args.max_mismatches)
+        with metrics.span("prefilter"):
+            with open(f"{args.sample}_prefiltered.fastq.gz", "wb") as f, BgzfWriter(f, args.threads) as writer:
+                counts = prefilter(args.fastq, writer, args.target_size, index, args.length_tolerance,
+                                   args.window, args.threads)
+        for name, count in counts.items():
+            metrics.rows(name, count)
+        write_log(counts, f"{args.sample}_prefilter.log")
+    print(f"{args.fastq}: kept {counts['kept']} of {counts['reads']} reads ({counts['flipped']} flipped)")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,18 +19,26 @@ def file_to_js_array(path):
     return "[" + ",".join(str(b) for b in byte_array) + "]"
 
 
-def render_bam_html():
+def render_bam_html(served=False, data_url=''):
+    """Render the BAM viewer of the sample.
+
+    By default the BAM, BAI and FASTA files are inlined in the page. If
+    ``served``, IGV loads them from ``data_url`` + their file name instead,
+    which requires the page to be opened through report.server.
+    """
     j2 = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
     template = j2.get_template(TEMPLATE_NAME)
-    context = {
-        k: file_to_js_array(v)
-        for k, v in [
-            ('bam_binary_arr', config.bam_path),
-            ('bai_binary_arr', config.bai_path),
-            ('fasta_binary_arr', config.consensus_match_fasta_path),
-        ]
-    }
+    files = [
+        ('bam', config.bam_path),
+        ('bai', config.bai_path),
+        ('fasta', config.consensus_match_fasta_path),
+    ]
+    if served:
+        context = {f'{k}_url': data_url + v.name for k, v in files}
+    else:
+        context = {f'{k}_binary_arr': file_to_js_array(v) for k, v in files}
     context.update({
+        'served': served,
         'sample_id': config.sample_id,
         'loading_svg': (STATIC_DIR / 'img/spinner.svg').read_text(),
         'igv_js': (STATIC_DIR / 'js/igv-3.3.0.min.js').read_text(),
@@ -18,6 +18,9 @@ REPO_URL = 'https://github.com/maelyg/ont_amplicon'
 class Config:
 
     TIMESTAMP_FILE = '*_start_timestamp.txt'
+    RUN_STORE_FILE = 'run_qc_report.sqlite'
+    TRACE_FILE = 'execution_trace*.txt'
+    DEPTH_PROFILE_FILE = '*_depth_profile.npz'
     VERSIONS_PATH = ROOT_DIR / 'versions.yml'
     DEFAULT_PARAMS_PATH = ROOT_DIR / 'params/default_params.yml'
     FLAGS_CSV = ROOT_DIR / 'flags.csv'
@@ -39,6 +42,9 @@ class Config:
     class CRITERIA:
         MIN_RAW_READS = 2500
         MIN_FILTERED_READS = 200
+        # Peak RSS of a task relative to the memory requested by its label
+        MIN_MEMORY_USAGE = 0.2
+        MAX_MEMORY_USAGE = 0.9
 
     @property
     def default_params(self) -> dict[str, str]:
@@ -71,12 +77,30 @@ class Config:
 
     @property
     def run_qc_path(self) -> Path:
-        return self._get_file_by_pattern('run_qc_report_*.txt')
+        return self._get_file_by_pattern('run_qc_report.txt')
 
     @property
     def run_qc_html_file(self) -> str:
         return self._get_file_by_pattern('run_qc_report.html').name
 
+    @property
+    def run_store_path(self) -> Path:
+        """The indexed run QC and samplesheet store, None if absent."""
+        path = self.result_dir / self.RUN_STORE_FILE
+        return path if path.is_file() else None
+
+    @property
+    def depth_profile_path(self) -> Path:
+        """The binned depth profiles of the consensus sequences, None if absent."""
+        paths = list(self.result_dir.glob(self.DEPTH_PROFILE_FILE))
+        return paths[0] if paths else None
+
+    @property
+    def trace_path(self) -> Path:
+        """The Nextflow trace file of the run, None if absent."""
+        paths = sorted(self.result_dir.glob(self.TRACE_FILE))
+        return paths[-1] if paths else None
+
     @property
     def nanoplot_raw_html_path(self) -> Path:
         return self._get_file_by_pattern('*raw_nanoplot-report.html')
@@ -110,10 +134,18 @@ class Config:
         return self._get_file_by_pattern(
             "*polished_consensus_rc_megablast_top_10_hits.txt")
 
+    @property
+    def blast_status_path(self) -> Path:
+        return self._get_file_by_pattern("*_blast_status.txt")
+
+    @property
+    def rattle_status_path(self) -> Path:
+        return self._get_file_by_pattern("*_rattle_status.txt")
+
     @property
     def blast_passed(self) -> bool:
         """Check if BLAST was successful."""
-        path = self._get_file_by_pattern("*_blast_status.txt")
+        path = self.blast_status_path
         if not path.exists():
             return True  # If no file written, assume it passed
         return 'fail' not in path.read_text().lower()
@@ -121,7 +153,7 @@ class Config:
     @property
     def rattle_passed(self) -> bool:
         """Check if clustering was successful."""
-        path = self._get_file_by_pattern("*_rattle_status.txt")
+        path = self.rattle_status_path
         if not path.exists():
             return True  # If no file written, assume it passed
         return 'fail' not in path.read_text().lower()
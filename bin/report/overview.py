@@ -0,0 +1,38 @@
+"""Render the cross-sample overview page of a run."""
+
+import json
+import logging
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemLoader
+
+from .config import Config
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+TEMPLATE_DIR = Path(__file__).parent / 'templates'
+STATIC_DIR = Path(__file__).parent / 'static'
+TEMPLATE_NAME = "run-summary.html"
+
+
+def render_overview(summary: dict, path):
+    """Render the run summary slice to a standalone HTML page.
+
+    The slice is embedded as JSON and rendered as a table in the browser,
+    where it can be filtered by sample, species, confidence score and flag.
+    """
+    j2 = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    template = j2.get_template(TEMPLATE_NAME)
+    # Compact JSON, safe to embed in a <script> element
+    summary_json = json.dumps(summary, separators=(',', ':')).replace('</', '<\\/')
+    rendered_html = template.render(
+        title="Run summary",
+        subtitle_html=Config.REPORT.SUBTITLE,
+        summary_json=summary_json,
+        n_samples=len(summary['samples']),
+        bootstrap_css=(STATIC_DIR / 'css/bootstrap.min.css').read_text(),
+        main_css=(STATIC_DIR / 'css/main.css').read_text(),
+    )
+    Path(path).write_text(rendered_html)
+    logger.info(f"Run summary HTML generated: {path}")
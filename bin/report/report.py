@@ -4,19 +4,28 @@ import csv
 import json
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import yaml
 from jinja2 import Environment, FileSystemLoader
+from manifest import Manifest
+from run_store import read_row
 
 from . import config
 from .bam import render_bam_html
 from .results import (
     BlastHits,
     ConsensusFASTA,
+    DepthProfiles,
     Metadata,
+    PipelineTrace,
     RunQC,
+    html_to_base64,
 )
 from .utils import get_img_src, serialize
 
@@ -26,6 +35,14 @@ config = config.Config()
 
 TEMPLATE_DIR = Path(__file__).parent / 'templates'
 STATIC_DIR = Path(__file__).parent / 'static'
+BIN_DIR = Path(__file__).parent.parent
+# Sections of the report page specific to a run of the workflow, rendered
+# again when the rest of the page is restored by its manifest
+RUN_SECTIONS = {
+    'walltime': 'components/walltime.html',
+    'performance': 'components/performance-section.html',
+}
+RUN_SECTION_PATTERN = '<!-- run-section:{name} -->(.*?)<!-- /run-section:{name} -->'
 
 
 def render(
@@ -35,35 +52,228 @@ def render(
     params_file: Path,
     versions: Path,
     analyst_name: str = None,
-    facility: str = None
+    facility: str = None,
+    metrics=None,
+    bam_viewer: str = 'inline',
+    bam_data_url: str = '',
+    manifest_dir: Path = None,
+    trace_file: Path = None,
 ):
-    """Render to HTML report to the configured output directory."""
+    """Render to HTML report to the configured output directory.
+
+    If given, ``metrics`` (an instrumentation.Metrics) records the time spent
+    building the context and rendering the templates. With ``bam_viewer``
+    'served', the BAM viewer loads the alignments from ``bam_data_url``
+    through report.server instead of inlining them.
+
+    The tasks of the sample in the Nextflow ``trace_file`` (by default an
+    execution_trace*.txt file of the result directory) are reported in the
+    pipeline performance section.
+
+    With a ``manifest_dir``, the report page and the BAM viewer are each
+    restored from the copy kept by the previous build if none of their
+    inputs changed (see manifest.Manifest). The start and end time and the
+    pipeline performance of a restored page are rendered again, as they
+    belong to the current run.
+    """
     config.load(result_dir)
+    if metrics:
+        metrics.sample = config.sample_id
+    trace_file = trace_file or config.trace_path
+    context_path = config.result_dir / 'example_report_context.json'
+    report_outputs = [config.report_path, context_path]
+    report_manifest = Manifest(
+        manifest_dir,
+        f'{config.sample_id}_report',
+        inputs={
+            **_get_report_inputs(),
+            'samplesheet': samplesheet_file,
+            'default_params': default_params_file,
+            'params': params_file,
+            'versions': versions,
+        },
+        params={'analyst_name': analyst_name, 'facility': facility},
+        code=[Path(__file__).parent, BIN_DIR / 'run_store.py'],
+    )
+    with _span(metrics, 'manifest'):
+        restored = report_manifest.restore(report_outputs)
+    if restored:
+        logger.info(f"Inputs unchanged, restored {config.report_path}")
+        with _span(metrics, 'render_run_sections'):
+            has_blast_hits = _refresh_run_sections(
+                context_path, analyst_name, facility, trace_file, metrics)
+    else:
+        has_blast_hits = _render_report(
+            context_path,
+            samplesheet_file,
+            default_params_file,
+            params_file,
+            versions,
+            analyst_name,
+            facility,
+            trace_file,
+            metrics,
+        )
+        report_manifest.save(report_outputs)
+
+    if has_blast_hits:
+        bam_manifest = Manifest(
+            manifest_dir,
+            f'{config.sample_id}_bam_viewer',
+            inputs={
+                'bam': config.bam_path,
+                'bai': config.bai_path,
+                'fasta': config.consensus_match_fasta_path,
+            },
+            params={'bam_viewer': bam_viewer, 'bam_data_url': bam_data_url},
+            code=[Path(__file__).parent / 'bam.py', TEMPLATE_DIR, STATIC_DIR],
+        )
+        with _span(metrics, 'manifest'):
+            restored = bam_manifest.restore([config.bam_html_path])
+        if restored:
+            logger.info(f"Inputs unchanged, restored {config.bam_html_path}")
+        else:
+            with _span(metrics, 'render_bam'):
+                render_bam_html(bam_viewer == 'served', bam_data_url)
+            bam_manifest.save([config.bam_html_path])
+
+
+def _render_report(
+    context_path: Path,
+    samplesheet_file: Path,
+    default_params_file: Path,
+    params_file: Path,
+    versions: Path,
+    analyst_name: str,
+    facility: str,
+    trace_file: Path = None,
+    metrics=None,
+) -> bool:
+    """Render the report page, return whether the sample has blast hits."""
     j2 = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
     template = j2.get_template('index.html')
-    context = _get_report_context(
-        samplesheet_file,
-        default_params_file,
-        params_file,
-        versions,
-        analyst_name,
-        facility,
-    )
-    path = config.result_dir / 'example_report_context.json'
-    with path.open('w') as f:
-        logger.info(f"Writing report context to {path}")
+    with _span(metrics, 'context'):
+        context = _get_report_context(
+            samplesheet_file,
+            default_params_file,
+            params_file,
+            versions,
+            analyst_name,
+            facility,
+            trace_file,
+            metrics,
+        )
+    if metrics:
+        metrics.rows('blast_hits', len(context['consensus_blast_hits']))
+    with context_path.open('w') as f:
+        logger.info(f"Writing report context to {context_path}")
         json.dump(context, f, indent=2, default=serialize)
 
-    static_files = _get_static_file_contents()
-    rendered_html = template.render(**context, **static_files)
+    with _span(metrics, 'render'):
+        static_files = _get_static_file_contents()
+        rendered_html = template.render(**context, **static_files)
+
+        path = config.report_path
+        with open(path, 'w') as f:
+            f.write(rendered_html)
+        logger.info(f"HTML document written to {path}")
+
+    return bool(len(context['consensus_blast_hits']))
+
+
+def _span(metrics, name):
+    """Return a timing span of the given metrics, or a no-op context."""
+    return metrics.span(name) if metrics else nullcontext()
+
+
+def _optional_path(name: str) -> Path:
+    """Return the path of a configured result file, None if absent."""
+    try:
+        return getattr(config, name)
+    except FileNotFoundError:
+        return None
+
+
+def _get_report_inputs() -> dict:
+    """Return the result files the report page is built from, by name.
+
+    The start timestamp and the trace file, which change on every run, are
+    left out: the sections built from them are rendered again on restore.
+    """
+    inputs = {
+        name: _optional_path(f'{name}_path')
+        for name in (
+            'nanoplot_raw_html',
+            'nanoplot_filtered_html',
+            'consensus_fasta',
+            'consensus_match_fasta',
+            'blast_hits',
+            'run_qc',
+            'run_store',
+            'depth_profile',
+            'blast_status',
+            'rattle_status',
+        )
+    }
+    inputs['flags'] = config.FLAGS_CSV
+    return inputs
+
+
+def _get_run_context(
+    analyst_name: str,
+    facility: str,
+    trace_file: Path = None,
+    metrics=None,
+) -> dict:
+    """Return the context of the sections specific to the current run."""
+    with _span(metrics, 'load_pipeline_trace'):
+        pipeline_trace = _get_pipeline_trace(trace_file)
+    return {
+        'analyst_name': analyst_name or '-',
+        'facility': facility or '-',
+        'start_time': _get_start_time(),
+        'end_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'wall_time': _get_walltime(),
+        'pipeline_trace': pipeline_trace,
+    }
+
+
+def _render_run_sections(context: dict) -> dict:
+    """Return the HTML of each run section of the report page."""
+    j2 = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    return {
+        name: j2.get_template(template).render(**context)
+        for name, template in RUN_SECTIONS.items()
+    }
 
-    path = config.report_path
-    with open(path, 'w') as f:
-        f.write(rendered_html)
-    logger.info(f"HTML document written to {path}")
 
-    if len(context['consensus_blast_hits']):
-        render_bam_html()
+def _refresh_run_sections(
+    context_path: Path,
+    analyst_name: str,
+    facility: str,
+    trace_file: Path = None,
+    metrics=None,
+) -> bool:
+    """Render the run sections of a restored report page again.
+
+    Return whether the sample has blast hits.
+    """
+    run_context = _get_run_context(
+        analyst_name, facility, trace_file, metrics)
+    sections = _render_run_sections(run_context)
+    html = config.report_path.read_text()
+    for name, section in sections.items():
+        pattern = RUN_SECTION_PATTERN.format(name=name)
+        replacement = pattern.replace('(.*?)', section)
+        html = re.sub(pattern, lambda _: replacement, html, flags=re.S)
+    config.report_path.write_text(html)
+
+    with context_path.open() as f:
+        context = json.load(f)
+    context.update(json.loads(json.dumps(run_context, default=serialize)))
+    with context_path.open('w') as f:
+        json.dump(context, f, indent=2)
+    return bool(len(context['consensus_blast_hits']))
 
 
 def _get_static_file_contents():
@@ -96,38 +306,84 @@ def _get_report_context(
     versions: Path,
     analyst_name: str,
     facility: str,
+    trace_file: Path = None,
+    metrics=None,
 ) -> dict:
-    """Build the context for the report template."""
-    blast_hits = _get_blast_hits()
-    consensus_fasta = ConsensusFASTA(config.consensus_fasta_path)
-    consensus_match_fasta = ConsensusFASTA(config.consensus_match_fasta_path)
+    """Build the context for the report template.
+
+    The input files are independent of each other, so they are read on a
+    thread pool and the context takes about as long to build as its slowest
+    input. Each loader is timed as a ``load_<name>`` span of ``metrics``.
+    """
+    loaders = {
+        'versions': partial(_get_versions, versions),
+        'metadata': partial(_get_metadata, samplesheet_file),
+        'parameters': partial(
+            _get_parameters, default_params_file, params_file),
+        'run_qc': _get_run_qc,
+        'nanoplot_raw_html_base64': lambda: html_to_base64(
+            config.nanoplot_raw_html_path),
+        'nanoplot_filtered_html_base64': lambda: html_to_base64(
+            config.nanoplot_filtered_html_path),
+        'consensus_blast_hits': _get_blast_hits,
+        'consensus_fasta': lambda: ConsensusFASTA(
+            config.consensus_fasta_path),
+        'consensus_match_fasta': lambda: ConsensusFASTA(
+            config.consensus_match_fasta_path),
+        'flags': lambda: config.flags,
+        'depth_profiles': _get_depth_profiles,
+    }
+    loaded = _run_loaders(loaders, metrics)
+
+    # Seed the cached NanoPlot pages of the run QC read above
+    run_qc = loaded['run_qc']
+    for name in ('nanoplot_raw_html_base64', 'nanoplot_filtered_html_base64'):
+        value = loaded.pop(name)
+        if isinstance(run_qc, RunQC):
+            setattr(run_qc, name, value)
+
     return {
         'title': config.REPORT.TITLE,
         'subtitle_html': config.REPORT.SUBTITLE,
         'sample_id': config.sample_id,
-        'analyst_name': analyst_name or '-',
-        'facility': facility or '-',
-        'versions': _get_versions(versions),
-        'start_time': _get_start_time(),
-        'end_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'wall_time': _get_walltime(),
-        'metadata': _get_metadata(samplesheet_file),
-        'parameters': _get_parameters(default_params_file, params_file),
-        'run_qc': _get_run_qc(),
+        **_get_run_context(analyst_name, facility, trace_file, metrics),
+        'versions': loaded['versions'],
+        'metadata': loaded['metadata'],
+        'parameters': loaded['parameters'],
+        'run_qc': run_qc,
         'bam_html_file': config.bam_html_path.name,
-        'consensus_blast_hits': blast_hits,
+        'consensus_blast_hits': loaded['consensus_blast_hits'],
         'consensus_blast_stats': _calculate_blast_stats(
-            blast_hits,
-            consensus_fasta,
+            loaded['consensus_blast_hits'],
+            loaded['consensus_fasta'],
         ),
-        'consensus_fasta': consensus_fasta,
-        'consensus_match_fasta': consensus_match_fasta,
-        'flags': config.flags,
+        'consensus_fasta': loaded['consensus_fasta'],
+        'consensus_match_fasta': loaded['consensus_match_fasta'],
+        'flags': loaded['flags'],
         'blast_passed': config.blast_passed,
         'rattle_passed': config.rattle_passed,
+        'depth_profiles': loaded['depth_profiles'],
     }
 
 
+def _run_loaders(loaders: dict, metrics=None) -> dict:
+    """Run the loaders concurrently and return their results by name.
+
+    The first exception raised by a loader is raised again once all of
+    them have finished.
+    """
+    def _load(name, loader):
+        with _span(metrics, f'load_{name}'):
+            return loader()
+
+    with ThreadPoolExecutor(max_workers=len(loaders)) as pool:
+        futures = {
+            name: pool.submit(_load, name, loader)
+            for name, loader in loaders.items()
+        }
+    return {name: future.result() for name, future in futures.items()}
+
+
 def _get_start_time():
     if not config.start_time:
         return None
@@ -150,13 +406,28 @@ def _get_walltime():
     }
 
 
+def _get_depth_profiles():
+    """Return the binned depth profiles of the consensus, None if absent."""
+    if not config.depth_profile_path:
+        return None
+    return DepthProfiles(config.depth_profile_path)
+
+
+def _get_pipeline_trace(trace_file: Path):
+    """Return the Nextflow tasks of the sample, None without a trace file."""
+    if not trace_file or not Path(trace_file).is_file():
+        return None
+    return PipelineTrace(trace_file, config.sample_id)
+
+
 def _get_metadata(samplesheet_file: Path):
     """Return the metadata as a dict."""
-    with open(samplesheet_file) as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['sampleid'] == config.sample_id:
-                return Metadata(row)
+    row = read_row(
+        config.run_store_path, 'samplesheet', config.sample_id,
+        samplesheet_file,
+    )
+    if row is not None:
+        return Metadata(row)
 
 
 def _get_default_parameters(default_params_file: Path) -> dict[str, str]:
@@ -202,11 +473,12 @@ def _get_run_qc() -> dict:
     - raw_reads_flag
     - qfiltered_flag
     """
-    with config.run_qc_path.open() as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            if row['Sample'] == config.sample_id:
-                return RunQC(row)
+    row = read_row(
+        config.run_store_path, 'run_qc', config.sample_id,
+        config.run_qc_path, delimiter='\t',
+    )
+    if row is not None:
+        return RunQC(row)
     return {}
 
 
@@ -2,8 +2,12 @@
 
 import base64
 import csv
+import re
+from functools import cached_property
+from html import escape
 from typing import Optional, Union, get_args, get_origin
 
+import numpy as np
 from Bio import SeqIO
 
 from .config import Config
@@ -34,6 +38,11 @@ def _csv_to_dict(csv_path, index_col='colname'):
         }
 
 
+def html_to_base64(path):
+    """Return the base64 encoded content of an HTML file, to embed it as a data URL."""
+    return base64.b64encode(path.read_bytes()).decode()
+
+
 class FLAGS:
     SUCCESS = 'success'
     WARNING = 'warning'
@@ -59,7 +68,7 @@ class AbstractDataRow:
                         t for t in get_args(_type)
                         if t is not type(None)
                     ]
-                    if allowed_types:
+                    if allowed_types and raw_value.strip():
                         value = allowed_types[0](raw_value.strip())
                     else:
                         value = None
@@ -94,16 +103,16 @@ class RunQC(AbstractDataRow):
     """Report the quality control outcomes."""
 
     COLUMNS = [
-        ('raw_reads', int),
-        ('processed_reads', int),
-        ('percent_processed', float),
+        ('raw_reads', Optional[int]),
+        ('processed_reads', Optional[int]),
+        ('percent_processed', Optional[float]),
         ('raw_reads_flag', str),
         ('processed_flag', str),
     ]
 
     @property
     def flag(self):
-        raw_threshold = self.raw_reads > config.CRITERIA.MIN_RAW_READS
+        raw_threshold = (self.raw_reads or 0) > config.CRITERIA.MIN_RAW_READS
         qfiltered_threshold = (
             (self.processed_reads or 0)
             > config.CRITERIA.MIN_FILTERED_READS)
@@ -113,15 +122,13 @@ class RunQC(AbstractDataRow):
             return FLAGS.WARNING
         return FLAGS.DANGER
 
-    @property
+    @cached_property
     def nanoplot_raw_html_base64(self):
-        content_bytes = config.nanoplot_raw_html_path.read_bytes()
-        return base64.b64encode(content_bytes).decode()
+        return html_to_base64(config.nanoplot_raw_html_path)
 
-    @property
+    @cached_property
     def nanoplot_filtered_html_base64(self):
-        content_bytes = config.nanoplot_filtered_html_path.read_bytes()
-        return base64.b64encode(content_bytes).decode()
+        return html_to_base64(config.nanoplot_filtered_html_path)
 
     @property
     def html_file(self):
@@ -161,7 +168,8 @@ class AbstractResultRows:
         ]
 
     def _cast(self, value, type_str):
-        if not type_str:
+        # Blast columns are left empty for consensus without a hit
+        if not type_str or not value:
             return value
         if type_str == 'int':
             num = int(float(value))
@@ -229,7 +237,7 @@ class BlastHits(AbstractResultRows):
         """Set rows with no hits to have a null value."""
         for row in self.rows:
             if not row['sacc'] or row['sacc'] == '0':
-                for colname in self.COLUMNS[3:41] + self.COLUMNS[49:50]:
+                for colname in self.COLUMNS[3:41] + self.COLUMNS[48:52]:
                     row[colname] = '-'
 
 
@@ -301,3 +309,245 @@ class ConsensusFASTA:
             seq.id: str(seq.seq)
             for seq in self.records
         }
+
+
+
+def _runs(values):
+    """Yield the (start, end, value) of the runs of equal consecutive values."""
+    start = 0
+    for i in range(1, len(values) + 1):
+        if i == len(values) or values[i] != values[start]:
+            yield start, i, values[start]
+            start = i
+
+
+class DepthProfiles:
+    """Report the binned read depth along each consensus as SVG sparklines.
+
+    The profiles are written by depth_profile.py; each is drawn as the mean
+    depth of its bins, with the bins where some positions have no reads
+    marked in red and the 30X depth threshold as a dashed line.
+    """
+
+    WIDTH = 160
+    HEIGHT = 32
+    DEPTH_THRESHOLD = 30
+
+    def __init__(self, npz_path):
+        with np.load(npz_path, allow_pickle=False) as data:
+            self.profiles = {
+                str(contig): (int(length), mean_depth, min_depth)
+                for contig, length, mean_depth, min_depth in zip(
+                    data['contigs'], data['lengths'],
+                    data['mean_depth'], data['min_depth'],
+                )
+            }
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def __contains__(self, contig):
+        return contig in self.profiles
+
+    def svg(self, contig):
+        """Return the inline SVG sparkline of a consensus, '' if absent."""
+        if contig not in self.profiles:
+            return ''
+        length, mean_depth, min_depth = self.profiles[contig]
+        bins = len(mean_depth)
+        top = max(float(mean_depth.max()), self.DEPTH_THRESHOLD)
+        x_step = self.WIDTH / bins
+
+        def y(depth):
+            return round(self.HEIGHT - float(depth) / top * (self.HEIGHT - 2), 1)
+
+        # One step per run of bins drawn at the same height
+        heights = [y(depth) for depth in mean_depth]
+        points = ' '.join(
+            f'{round(start * x_step, 1)},{height} {round(end * x_step, 1)},{height}'
+            for start, end, height in _runs(heights)
+        )
+        dropouts = ''.join(
+            f'<rect x="{round(start * x_step, 1)}" y="{self.HEIGHT - 3}"'
+            f' width="{round((end - start) * x_step, 1)}" height="3" fill="#dc3545"/>'
+            for start, end, uncovered in _runs(list(min_depth == 0)) if uncovered
+        )
+        n_dropouts = int((min_depth == 0).sum())
+        title = (
+            f'{contig}: {length:,} nt, mean depth'
+            f' {float(mean_depth.min()):.0f}-{float(mean_depth.max()):.0f}X'
+            f' over {bins} bins'
+            + (f', {n_dropouts} bins with uncovered positions' if n_dropouts else '')
+        )
+        return (
+            f'<svg class="depth-profile" width="{self.WIDTH}" height="{self.HEIGHT}"'
+            f' viewBox="0 0 {self.WIDTH} {self.HEIGHT}" role="img">'
+            f'<title>{escape(title)}</title>'
+            f'<polygon points="0,{self.HEIGHT} {points} {self.WIDTH},{self.HEIGHT}"'
+            ' fill="#9ec5fe" stroke="#0d6efd" stroke-width="0.8"/>'
+            f'<line x1="0" x2="{self.WIDTH}" y1="{y(self.DEPTH_THRESHOLD)}"'
+            f' y2="{y(self.DEPTH_THRESHOLD)}" stroke="gray" stroke-dasharray="2,2"'
+            ' stroke-width="0.6"/>'
+            f'{dropouts}</svg>'
+        )
+
+    def to_json(self):
+        return {
+            contig: {
+                'length': length,
+                'mean_depth': [round(float(d), 1) for d in mean_depth],
+                'min_depth': min_depth.tolist(),
+            }
+            for contig, (length, mean_depth, min_depth) in self.profiles.items()
+        }
+
+# Units of the human readable values of a Nextflow trace file
+DURATION_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+MEMORY_UNITS = {
+    'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3,
+    'TB': 1024 ** 4, 'PB': 1024 ** 5,
+}
+
+
+def _parse_duration(value):
+    """Return a trace duration (e.g. '1h 2m 3s', or ms if raw) in seconds."""
+    if not value or value == '-':
+        return None
+    if value.replace('.', '', 1).isdigit():
+        return float(value) / 1000
+    parts = re.findall(r'([\d.]+)\s*(ms|d|h|m|s)', value)
+    return sum(float(n) * DURATION_UNITS[unit] for n, unit in parts)
+
+
+def _parse_memory(value):
+    """Return a trace memory size (e.g. '1.2 GB', or bytes if raw) in bytes."""
+    if not value or value == '-':
+        return None
+    number, _, unit = value.strip().partition(' ')
+    return int(float(number) * MEMORY_UNITS.get(unit.upper() or 'B', 1))
+
+
+def _parse_percent(value):
+    if not value or value == '-':
+        return None
+    return float(value.rstrip('%'))
+
+
+def format_duration(seconds):
+    """Return a duration in seconds as e.g. '1h 02m 03s'."""
+    if seconds is None:
+        return '-'
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}h {minutes:02d}m {seconds:02d}s'
+    return f'{minutes}m {seconds:02d}s'
+
+
+class TaskTrace:
+    """Report the resources used by one Nextflow task of the sample."""
+
+    def __init__(self, row):
+        self.process = row.get('process') or row['name'].split(' (')[0]
+        self.status = row.get('status')
+        self.exit = row.get('exit')
+        self.attempt = row.get('attempt')
+        self.realtime = _parse_duration(row.get('realtime'))
+        self.cpu_percent = _parse_percent(row.get('%cpu'))
+        self.cpus = row.get('cpus')
+        self.peak_rss = _parse_memory(row.get('peak_rss'))
+        self.memory = _parse_memory(row.get('memory'))
+        self.read_bytes = _parse_memory(row.get('rchar'))
+        self.written_bytes = _parse_memory(row.get('wchar'))
+
+    @property
+    def realtime_str(self):
+        return format_duration(self.realtime)
+
+    @property
+    def memory_usage(self):
+        """Peak RSS as a fraction of the memory requested for the task."""
+        if not self.peak_rss or not self.memory:
+            return None
+        return self.peak_rss / self.memory
+
+    @property
+    def memory_flag(self):
+        usage = self.memory_usage
+        if usage is None:
+            return FLAGS.NONE
+        if usage > config.CRITERIA.MAX_MEMORY_USAGE:
+            return FLAGS.DANGER
+        if usage < config.CRITERIA.MIN_MEMORY_USAGE:
+            return FLAGS.WARNING
+        return FLAGS.SUCCESS
+
+    @property
+    def memory_note(self):
+        flag = self.memory_flag
+        if flag == FLAGS.DANGER:
+            return 'Close to or above the memory of its label'
+        if flag == FLAGS.WARNING:
+            return 'Far below the memory of its label'
+        return ''
+
+    def to_json(self):
+        return {
+            'process': self.process,
+            'status': self.status,
+            'exit': self.exit,
+            'attempt': self.attempt,
+            'realtime': self.realtime,
+            'cpu_percent': self.cpu_percent,
+            'cpus': self.cpus,
+            'peak_rss': self.peak_rss,
+            'memory': self.memory,
+            'read_bytes': self.read_bytes,
+            'written_bytes': self.written_bytes,
+            'memory_flag': self.memory_flag,
+        }
+
+
+class PipelineTrace:
+    """Report the Nextflow tasks of the sample, from the trace file of the run.
+
+    The trace file holds the tasks of every sample of the run, so it is
+    read line by line and only the tasks tagged with the sample are kept.
+    """
+
+    def __init__(self, trace_path, sample_id):
+        self.trace_path = trace_path
+        self.tasks = list(self._parse(trace_path, sample_id))
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __bool__(self):
+        return bool(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    @staticmethod
+    def _parse(trace_path, sample_id):
+        with open(trace_path, newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                tag = row.get('tag')
+                if tag is None or tag == '-':
+                    # Older trace files without a tag column: "PROCESS (tag)"
+                    tag = row['name'].partition(' (')[2].rstrip(')')
+                if tag == sample_id:
+                    yield TaskTrace(row)
+
+    @property
+    def total_realtime(self):
+        return sum(task.realtime or 0 for task in self.tasks)
+
+    @property
+    def total_realtime_str(self):
+        return format_duration(self.total_realtime)
+
+    def to_json(self):
+        return [task.to_json() for task in self.tasks]
@@ -0,0 +1,139 @@
+"""Serve a result directory over HTTP with byte range support.
+
+The BAM viewer rendered with ``--bam_viewer served`` points IGV at the BAM,
+BAI and FASTA files by URL instead of inlining them, so that IGV only
+fetches the BAM index and the alignments of the region on screen through
+HTTP Range requests. Browsers do not allow such requests on file:// pages,
+so the viewer has to be opened through this server, e.g.:
+
+    ont_amplicon serve-report results/sample1
+    # then open http://127.0.0.1:8000/07_html_report/sample1_bam-alignment.html
+"""
+
+import argparse
+import logging
+import os
+import re
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from .utils import existing_path
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# A single byte range, the only form IGV requests
+RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler answering single byte range requests with 206.
+
+    Other Range forms (e.g. several ranges) are ignored and answered with
+    the whole file, as allowed by RFC 9110. CORS headers are added to every
+    response so that a viewer served from another origin can read the files.
+    """
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Headers", "Range")
+        self.send_header("Access-Control-Expose-Headers", "Accept-Ranges, Content-Length, Content-Range")
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        self.send_response(HTTPStatus.NO_CONTENT)
+        self.send_header("Access-Control-Allow-Methods", "GET, HEAD, OPTIONS")
+        self.end_headers()
+
+    def send_head(self):
+        self.byte_range = None
+        header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if header is None or not os.path.isfile(path):
+            return super().send_head()
+        match = RANGE.match(header.strip())
+        if not match or match.groups() == ("", ""):
+            return super().send_head()
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        stat = os.fstat(f.fileno())
+        start, end = _resolve_range(*match.groups(), stat.st_size)
+        if start is None:
+            f.close()
+            return super().send_head()
+        if start >= stat.st_size or end < start:
+            f.close()
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{stat.st_size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+        self.end_headers()
+        f.seek(start)
+        self.byte_range = (start, end)
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.byte_range is None:
+            return super().copyfile(source, outputfile)
+        remaining = self.byte_range[1] - self.byte_range[0] + 1
+        while remaining > 0:
+            data = source.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            outputfile.write(data)
+            remaining -= len(data)
+
+
+def _resolve_range(first, last, size):
+    """Return the (start, end) bytes of a range, or (None, None) if it is malformed."""
+    if not first:
+        # suffix range: the last bytes of the file
+        length = int(last)
+        return (max(size - length, 0), size - 1) if length else (size, size - 1)
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None, None
+    return start, end
+
+
+def serve(directory: Path, port: int = 8000, bind: str = "127.0.0.1"):
+    """Serve a directory until interrupted."""
+    handler = partial(RangeRequestHandler, directory=str(directory))
+    with ThreadingHTTPServer((bind, port), handler) as httpd:
+        host, port = httpd.server_address[:2]
+        logger.info(f"Serving {directory} at http://{host}:{port}/ (Ctrl-C to stop)")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", type=existing_path, help="The result directory to serve.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on (default: 8000).")
+    parser.add_argument("--bind", default="127.0.0.1",
+                        help="Address to listen on (default: 127.0.0.1, i.e. this workstation only).")
+    args = parser.parse_args()
+    serve(args.directory, args.port, args.bind)
+
+
+if __name__ == "__main__":
+    main()
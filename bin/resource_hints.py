@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Derive per-sample CPU and memory hints from the preprocessing read statistics.
+
+The hints are written as a small CSV (one row per process) that the
+workflow reads to set the cpus and memory directives of the processes whose
+footprint scales with the number of reads.
+"""
+import argparse
+import csv
+import math
+
+from fastq_stats import read_nanostats
+
+# For each process: minimum memory (GB), additional memory per million reads
+# and per 100 Mb of sequence, and the read counts above which more CPUs are used.
+PROCESS_MODELS = {
+    "rattle": {
+        "base_memory_gb": 4,
+        "memory_gb_per_million_reads": 8,
+        "memory_gb_per_100mb": 4,
+        "cpu_tiers": [(0, 2), (50_000, 4), (250_000, 8)],
+    },
+    "medaka": {
+        "base_memory_gb": 4,
+        "memory_gb_per_million_reads": 4,
+        "memory_gb_per_100mb": 2,
+        "cpu_tiers": [(0, 2), (100_000, 4)],
+    },
+    "covstats": {
+        "base_memory_gb": 1,
+        "memory_gb_per_million_reads": 2,
+        "memory_gb_per_100mb": 0,
+        "cpu_tiers": [(0, 1)],
+    },
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sample", type=str, required=True, help="Provide sample name")
+    parser.add_argument("--nanostat", type=str, required=True, help="NanoStats file of the preprocessed reads")
+    parser.add_argument("--max_cpus", type=int, default=8, help="Upper bound of the CPU hints")
+    parser.add_argument("--max_memory", type=int, default=64, help="Upper bound of the memory hints (GB)")
+    return parser.parse_args()
+
+
+def estimate_resources(n_reads, n_bases, model, max_cpus, max_memory):
+    """Return (cpus, memory_gb) for a process given the size of a sample."""
+    memory = (
+        model["base_memory_gb"]
+        + model["memory_gb_per_million_reads"] * n_reads / 1e6
+        + model["memory_gb_per_100mb"] * n_bases / 1e8
+    )
+    cpus = max(cpu for min_reads, cpu in model["cpu_tiers"] if n_reads >= min_reads)
+    return min(cpus, max_cpus), min(math.ceil(memory), max_memory)
+
+
+def main():
+    args = parse_args()
+    stats = read_nanostats(args.nanostat)
+    n_reads = int(stats.get("number_of_reads", 0))
+    n_bases = int(stats.get("number_of_bases", 0))
+
+    output_file = f"{args.sample}_resources.csv"
+    with open(output_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["process", "cpus", "memory_gb"])
+        for process, model in PROCESS_MODELS.items():
+            cpus, memory = estimate_resources(n_reads, n_bases, model, args.max_cpus, args.max_memory)
+            writer.writerow([process, cpus, memory])
+            print(f"{args.sample} {process}: {n_reads} reads, {n_bases} bases -> {cpus} CPUs, {memory} GB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,104 @@
 #!/usr/bin/env python
+"""Reverse complement the consensus sequences that are on the minus strand.
+
+The ids to reverse complement are either given with --ids_to_rc (e.g. the
+minus strand hits of BLASTN_COI) or, in orientation mode (--orient_index),
+derived in-process from a k-mer index of the COI reference sequences:
+
+    # build the index once (or load it if it is already cached)
+    reverse_complement.py --orient_reference MetaCOXI_Seqs.fasta --orient_index coi.npy
+    # classify the consensus sequences of a sample
+    reverse_complement.py --sample S1 --fasta S1_final_polished_consensus.fasta --orient_index coi.npy
+
+The index holds the sorted minimizers of the forward strand of the reference
+sequences, after a header with the k-mer and window sizes, and is
+memory-mapped rather than read. The minimizers of each consensus and of its
+reverse complement are looked up, and a consensus is reverse complemented
+when its reverse complement has at least --min_ratio times more hits. Consensus sequences
+without enough hits on either strand are written to
+{sample}_ambiguous_orientation.fasta so that they can be checked with blast.
+"""
 import argparse
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from instrumentation import Metrics, add_profile_argument
+from primer_prefilter import BASE_CODES
+
+KMER = 15
+WINDOW = 10
+# Bases of reference sequence hashed at once when building the index
+BUILD_BATCH = 8 * 1024 * 1024
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+INVALID = np.iinfo(np.uint64).max
+# First value of a saved index, so that an index built with other sizes is rebuilt
+INDEX_HEADER = np.uint64(KMER << 8 | WINDOW)
+
 
 def main():
     ################################################################################
-    parser = argparse.ArgumentParser(description="Load blast results")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     
     # All the required arguments #
-    parser.add_argument("--ids_to_rc", type=str)
+    parser.add_argument("--ids_to_rc", type=str, nargs="+", help="Files of ids to reverse complement")
     parser.add_argument("--sample", type=str)
     parser.add_argument("--fasta", type=str)
+    parser.add_argument("--orient_index", type=str, help="Minimizer index of the COI reference sequences (.npy)")
+    parser.add_argument("--orient_reference", type=str,
+                        help="COI reference fasta, used to build --orient_index if it does not exist yet")
+    parser.add_argument("--min_hits", type=int, default=3,
+                        help="Minimizer hits needed to decide the orientation of a consensus (default: 3)")
+    parser.add_argument("--min_ratio", type=float, default=3,
+                        help="Ratio of hits between the two strands needed to decide the orientation (default: 3)")
+    add_profile_argument(parser)
     args = parser.parse_args()
 
+    if args.orient_index:
+        orient(args)
+        return
+
     ids_to_rc = args.ids_to_rc
     sample = args.sample
     fasta = args.fasta
 
 
-    
-    #raw_data = pd.read_csv(results_path, header=0, sep="\t",index_col=None)
-    with open(ids_to_rc, 'r') as f:
-        lines = []
-        for line in f:
-            lines.append(line.strip())
-    
+    with Metrics("reverse_complement", sample, args.profile) as metrics:
+        #raw_data = pd.read_csv(results_path, header=0, sep="\t",index_col=None)
+        with metrics.span("parse"):
+            lines = []
+            for path in ids_to_rc:
+                with open(path, 'r') as f:
+                    for line in f:
+                        lines.append(line.strip())
 
-    contig_dict = {}
-    with open(fasta) as file:
-         
-         for line in file:
-            if line.startswith(">"):
-                header = line.strip().replace(">","")
-                seq_fasta = next(file).strip()
+        contig_dict = {}
+        with metrics.span("reverse_complement"):
+            with open(fasta) as file:
 
-                if header in lines:
-                    contig_dict[header] = reverse_complement(seq_fasta)
-                else:
-                    contig_dict[header] = seq_fasta
+                for line in file:
+                    if line.startswith(">"):
+                        header = line.strip().replace(">","")
+                        seq_fasta = next(file).strip()
 
-    ofile =  open(sample + "_final_polished_consensus_rc.fasta", "w")
-    
-    for seq_id,fasta in contig_dict.items():
-        identifier_line = ">" + seq_id + "\n"
-        ofile.write(identifier_line)
-        sequence_line = fasta + "\n"
-        ofile.write(sequence_line)
+                        if header in lines:
+                            contig_dict[header] = reverse_complement(seq_fasta)
+                        else:
+                            contig_dict[header] = seq_fasta
+        metrics.rows("contigs", len(contig_dict))
+        metrics.rows("reverse_complemented", len(lines))
+
+        with metrics.span("write"):
+            ofile =  open(sample + "_final_polished_consensus_rc.fasta", "w")
 
-    ofile.close()
+            for seq_id,fasta in contig_dict.items():
+                identifier_line = ">" + seq_id + "\n"
+                ofile.write(identifier_line)
+                sequence_line = fasta + "\n"
+                ofile.write(sequence_line)
+
+            ofile.close()
 
 
 def reverse_complement(seq):
@@ -90,5 +143,122 @@ def reverse_complement(seq):
         bases = bases.replace(v,k)
     return bases
 
+def orient(args):
+    """Classify the orientation of each consensus with the minimizer index."""
+    with Metrics("orient_consensus", args.sample, args.profile) as metrics:
+        with metrics.span("load_index"):
+            index = load_or_build_index(args.orient_index, args.orient_reference)
+        metrics.rows("index_minimizers", len(index))
+        if not args.fasta:
+            return
+
+        with metrics.span("classify"):
+            records = read_fasta(args.fasta)
+            to_rc, ambiguous = [], []
+            for header, seq in records:
+                forward, reverse = strand_hits(seq, index)
+                if max(forward, reverse) < args.min_hits or (
+                        max(forward, reverse) < args.min_ratio * min(forward, reverse)):
+                    ambiguous.append((header, seq))
+                elif reverse > forward:
+                    to_rc.append(header)
+        metrics.rows("consensus", len(records))
+        metrics.rows("reverse_complemented", len(to_rc))
+        metrics.rows("ambiguous", len(ambiguous))
+
+        with open(f"{args.sample}_kmer_ids_to_reverse_complement.txt", "w") as f:
+            f.writelines(f"{header}\n" for header in to_rc)
+        with open(f"{args.sample}_ambiguous_orientation.fasta", "w") as f:
+            f.writelines(f">{header}\n{seq}\n" for header, seq in ambiguous)
+
+
+def read_fasta(path):
+    """Return the (header, sequence) pairs of a fasta file."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                records.append([line[1:], []])
+            elif records:
+                records[-1][1].append(line)
+    return [(header, "".join(seq)) for header, seq in records]
+
+
+def minimizers(seq, k=KMER, w=WINDOW):
+    """Return the unique minimizer k-mer codes of a sequence (bytes).
+
+    k-mers spanning a base other than A, C, G or T (e.g. the N separating
+    sequences when the index is built) are never selected.
+    """
+    bases = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n_kmers = len(bases) - k + 1
+    if n_kmers < 1:
+        return np.zeros(0, dtype=np.uint64)
+    codes = np.zeros(n_kmers, dtype=np.uint64)
+    for i in range(k):
+        codes = (codes << np.uint64(2)) | (bases[i:i + n_kmers] & 3).astype(np.uint64)
+    n_invalid = np.concatenate(([0], np.cumsum(bases > 3)))
+    valid = n_invalid[k:] == n_invalid[:-k]
+
+    hashes = codes * HASH_MULTIPLIER
+    hashes ^= hashes >> np.uint64(29)
+    hashes[~valid] = INVALID
+    windows = sliding_window_view(hashes, min(w, n_kmers))
+    positions = np.unique(windows.argmin(axis=1) + np.arange(len(windows)))
+    return np.unique(codes[positions[valid[positions]]])
+
+
+def build_index(reference):
+    """Return the sorted unique minimizers of the sequences of a fasta file."""
+    parts, batch, size = [], [], 0
+    with open(reference, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                batch.append(b"N")
+            else:
+                batch.append(line.strip())
+                size += len(batch[-1])
+            if size >= BUILD_BATCH:
+                parts.append(minimizers(b"".join(batch)))
+                batch, size = [b"N"], 0
+                if len(parts) >= 32:
+                    parts = [np.unique(np.concatenate(parts))]
+    parts.append(minimizers(b"".join(batch)))
+    return np.unique(np.concatenate(parts))
+
+
+def load_or_build_index(path, reference=None):
+    """Memory-map a cached minimizer index, building and saving it first if needed."""
+    if os.path.exists(path):
+        cached = np.load(path, mmap_mode="r")
+        if cached.dtype == np.uint64 and len(cached) and cached[0] == INDEX_HEADER:
+            return cached[1:]
+    if reference is None:
+        raise FileNotFoundError(f"No usable minimizer index at {path} and no --orient_reference to build it")
+    index = build_index(reference)
+    # write to a temporary file first so that concurrent runs never read a partial index
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, np.concatenate(([INDEX_HEADER], index)))
+    os.replace(tmp_path, path)
+    return index
+
+
+def count_hits(query, index):
+    """Return the number of codes of query found in the sorted index."""
+    if not len(index) or not len(query):
+        return 0
+    positions = np.minimum(np.searchsorted(index, query), len(index) - 1)
+    return int((index[positions] == query).sum())
+
+
+def strand_hits(seq, index):
+    """Return the number of minimizers of a sequence and of its reverse complement found in the index."""
+    seq = seq.upper()
+    forward = count_hits(minimizers(seq.encode()), index)
+    reverse = count_hits(minimizers(reverse_complement(seq).encode()), index)
+    return forward, reverse
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,115 @@
+"""Indexed per-sample lookups of the run-level tables.
+
+seq_run_qc_report.py writes the run QC table and the samplesheet of a run
+to a single SQLite file (run_qc_report.sqlite, next to run_qc_report.txt),
+keyed on the sample ID, e.g.:
+
+    row = lookup_row(store_path, "samplesheet", "sample1")
+
+so that the per-sample stages do an indexed lookup instead of scanning the
+whole table once per sample. Values are stored as the text found in the
+tables, so rows are interchangeable with those of csv.DictReader. When the
+store or its table is missing, read_row() falls back to scanning the table.
+"""
+
+import csv
+import os
+import sqlite3
+from contextlib import contextmanager
+
+STORE_SUFFIX = ".sqlite"
+# table: name of its key column
+TABLES = {
+    "run_qc": "Sample",
+    "samplesheet": "sampleid",
+}
+
+
+def quote(name):
+    """Return name quoted as an SQLite identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+@contextmanager
+def new_store(path):
+    """Yield a connection to a new SQLite store at path, committed on exit.
+
+    The store is written to a temporary file first and only moved to path
+    once complete, so that readers never open a partially written store.
+    """
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+def _create_table(conn, table, columns, rows):
+    key = TABLES[table]
+    conn.execute(
+        f"CREATE TABLE {table} ("
+        + ", ".join(f"{quote(col)} TEXT" + (" PRIMARY KEY" if col == key else "") for col in columns)
+        + ")"
+    )
+    # The first row of a duplicated key is kept, as the first match of a scan
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {table} VALUES ({', '.join('?' * len(columns))})",
+        ([row.get(col, "") for col in columns] for row in rows),
+    )
+
+
+def write_run_store(path, run_qc_df, samplesheet=None):
+    """Write the run QC table (and the samplesheet rows, if given) to a new store."""
+    with new_store(path) as conn:
+        text_df = run_qc_df.astype(object).where(run_qc_df.notna(), "")
+        _create_table(
+            conn, "run_qc", list(text_df.columns),
+            ({col: str(value) for col, value in row.items()} for row in text_df.to_dict("records")),
+        )
+        if samplesheet:
+            with open(samplesheet, newline="") as f:
+                reader = csv.DictReader(f)
+                _create_table(conn, "samplesheet", reader.fieldnames, reader)
+
+
+def lookup_row(path, table, key):
+    """Return the row of a store table as a dict, None if the key is absent.
+
+    Raises LookupError if the store or the table does not exist.
+    """
+    if not path or not os.path.isfile(path):
+        raise LookupError(f"No run store at {path}")
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute(
+                f"SELECT * FROM {table} WHERE {quote(TABLES[table])} = ?", (key,)
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            raise LookupError(f"No {table} table in {path}") from e
+    finally:
+        conn.close()
+    return dict(row) if row is not None else None
+
+
+def scan_row(csv_path, key_column, key, delimiter=","):
+    """Return the first row of a CSV table whose key_column is key, None if absent."""
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f, delimiter=delimiter):
+            if row[key_column] == key:
+                return row
+    return None
+
+
+def read_row(store_path, table, key, csv_path, delimiter=","):
+    """Return a row from the store, or from the CSV table when the store cannot be used."""
+    try:
+        return lookup_row(store_path, table, key)
+    except LookupError:
+        return scan_row(csv_path, TABLES[table], key, delimiter)
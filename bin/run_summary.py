@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Aggregate the results of all the samples of a run into a single store and overview page.
+
+The flagged blast hits (*_top_blast_with_cov_stats.txt) of every sample,
+the run QC table and the stage timings of the samples (*_metrics.json) are
+appended to run_summary.sqlite, with indexes on the sample, the species,
+the confidence score and the flags, e.g.:
+
+    SELECT sample_name, qseqid, species FROM detections
+    WHERE species LIKE 'Tomato%' AND NORMALISED_CONF_SCORE > 0.8;
+
+run_summary.html lists the consensus of all samples with their run QC and
+can be filtered in the browser; it embeds a compact JSON slice of the store
+(SUMMARY_COLUMNS), so that no per-sample file has to be opened again.
+"""
+import argparse
+import json
+import os
+
+import pandas as pd
+
+from instrumentation import Metrics, add_profile_argument
+from report.overview import render_overview
+from run_store import new_store, quote
+
+OUTPUT_PREFIX = "run_summary"
+# Columns of the detections embedded in the overview page
+SUMMARY_COLUMNS = [
+    "sample_name", "qseqid", "species", "sacc", "pident", "target_organism_match", "n_read_cont_cluster",
+    "qseq_mean_depth", "qseq_pc_mapping_read", "qseq_pc_cov_30X", "30X_COVERAGE_FLAG", "MAPPED_READ_COUNT_FLAG",
+    "MEAN_COVERAGE_FLAG", "TARGET_ORGANISM_FLAG", "TARGET_SIZE_FLAG", "READ_LENGTH_FLAG", "MEAN_MQ_FLAG",
+    "CONSENSUS_QUALITY_FLAG", "NORMALISED_CONF_SCORE",
+]
+RUN_QC_COLUMNS = ["Sample", "raw_reads", "processed_reads", "percent_processed", "QC_FLAG"]
+INDEXED_COLUMNS = ["sample_name", "species", "target_organism_match", "NORMALISED_CONF_SCORE"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--detections", type=str, nargs="+", required=True,
+                        help="*_top_blast_with_cov_stats.txt files of the samples")
+    parser.add_argument("--run_qc", type=str, help="run_qc_report.txt of the run")
+    parser.add_argument("--metrics", type=str, nargs="*", default=[],
+                        help="*_metrics.json files of the sample stages")
+    parser.add_argument("--output_prefix", type=str, default=OUTPUT_PREFIX,
+                        help="Prefix of the sqlite and html outputs")
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+
+def load_detections(paths):
+    """Concatenate the flagged tables of all samples, samples without any hit included."""
+    tables = [
+        pd.read_csv(path, sep="\t", dtype={"sample_name": str, "qseqid": str})
+        for path in sorted(paths) if os.path.getsize(path) > 0
+    ]
+    # Empty tables are left out of the concat, which would otherwise turn integer columns to float
+    tables = [table for table in tables if len(table)]
+    if not tables:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    return pd.concat(tables, ignore_index=True, sort=False)
+
+
+def load_timings(paths):
+    """Return one row per sample and stage with the wall time and peak memory of the stage."""
+    rows = []
+    for path in sorted(paths):
+        if not path.endswith("_metrics.json"):
+            continue
+        with open(path) as f:
+            data = json.load(f)
+        rows.append({
+            "sample": data.get("sample"),
+            "stage": data["stage"],
+            "started": data.get("started"),
+            "wall_seconds": data.get("wall_seconds"),
+            "peak_rss_mb": data.get("peak_rss_mb"),
+            "failed": bool(data.get("failed")),
+        })
+    return pd.DataFrame(rows, columns=["sample", "stage", "started", "wall_seconds", "peak_rss_mb", "failed"])
+
+
+def write_store(path, detections, run_qc, timings):
+    """Write the run tables and their indexes to a new SQLite store."""
+    with new_store(path) as conn:
+        detections.to_sql("detections", conn, index=False)
+        indexed = INDEXED_COLUMNS + [col for col in detections.columns if col.endswith("_FLAG")]
+        for col in indexed:
+            if col in detections.columns:
+                conn.execute(f"CREATE INDEX {quote('detections_' + col)} ON detections ({quote(col)})")
+        if run_qc is not None:
+            run_qc.to_sql("run_qc", conn, index=False)
+            conn.execute("CREATE UNIQUE INDEX run_qc_sample ON run_qc (Sample)")
+        timings.to_sql("timings", conn, index=False)
+        conn.execute("CREATE INDEX timings_sample ON timings (sample)")
+
+
+def _records(df, columns):
+    """Return the rows of a DataFrame as lists, with None for missing values."""
+    df = df.reindex(columns=columns)
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+
+def summary_slice(detections, run_qc, timings):
+    """Return the compact JSON-ready slice of the store embedded in the overview page."""
+    samples = sorted(set(detections["sample_name"].dropna())
+                     | (set(run_qc["Sample"].dropna()) if run_qc is not None else set()))
+    run_qc_rows = _records(run_qc, RUN_QC_COLUMNS) if run_qc is not None else []
+    wall_seconds = timings.groupby("sample")["wall_seconds"].sum().round(1).to_dict() if len(timings) else {}
+    return {
+        "samples": samples,
+        "detections": {
+            "columns": SUMMARY_COLUMNS,
+            "rows": _records(detections, SUMMARY_COLUMNS),
+        },
+        "run_qc": {
+            "columns": RUN_QC_COLUMNS + ["wall_seconds"],
+            "rows": [row + [wall_seconds.get(row[0])] for row in run_qc_rows],
+        },
+    }
+
+
+def main():
+    args = parse_args()
+    with Metrics("run_summary", profile=args.profile) as metrics:
+        with metrics.span("parse"):
+            detections = load_detections(args.detections)
+            run_qc = pd.read_csv(args.run_qc, sep="\t", dtype={"Sample": str}) if args.run_qc else None
+            timings = load_timings(args.metrics)
+        metrics.rows("detections", len(detections))
+        metrics.rows("timings", len(timings))
+
+        with metrics.span("store"):
+            write_store(args.output_prefix + ".sqlite", detections, run_qc, timings)
+        with metrics.span("render"):
+            render_overview(summary_slice(detections, run_qc, timings), args.output_prefix + ".html")
+
+
+if __name__ == "__main__":
+    main()
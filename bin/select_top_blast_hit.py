@@ -4,10 +4,33 @@ import pandas as pd
 import argparse
 import os
 from functools import reduce
-import pytaxonkit
 import numpy as np
 import re
 
+from instrumentation import Metrics, add_profile_argument
+from manifest import Manifest, add_manifest_argument
+
+BLAST_COLUMNS = ["qseqid", "sgi", "sacc", "length", "nident", "pident", "mismatch", "gaps", "gapopen", "qstart",
+                 "qend", "qlen", "sstart", "send", "slen", "sstrand", "evalue", "bitscore", "qcovhsp", "stitle",
+                 "staxids", "qseq", "sseq", "sseqid", "qcovs", "qframe", "sframe"]
+
+BLAST_DTYPES = {
+    "qseqid": 'str', "sgi": 'str', "sacc": 'str', "length": 'int64', "nident": 'int64',
+    "pident": 'float64', "mismatch": 'int64', "gaps": 'int64', "gapopen": 'int64', "qstart": 'int64',
+    "qend": 'int64', "qlen": 'int64', "sstart": 'int64', "send": 'int64', "slen": 'int64', "sstrand": 'str',
+    "evalue": 'float64', "bitscore": 'float64', "qcovhsp": 'int64', "stitle": 'str', "staxids": 'str',
+    "qseq": 'str', "sseq": 'str', "sseqid": 'str', "qcovs": 'int64', "qframe": 'int64', "sframe": 'int64'
+}
+
+TOP_HIT_COLUMNS = ["sample_name"] + BLAST_COLUMNS + ["species", "broad_taxonomic_category", "FullLineage",
+                                                     "target_organism_match"]
+
+# Types of the top hits table written by this script (staxids is reduced to the first taxid)
+TOP_HIT_DTYPES = {
+    **BLAST_DTYPES, "sample_name": 'str', "staxids": 'int64', "species": 'str',
+    "broad_taxonomic_category": 'str', "FullLineage": 'str', "target_organism_match": 'str'
+}
+
 def parse_arguments():
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(description="Load and enrich BLASTn results.")
@@ -15,6 +38,8 @@ def parse_arguments():
     parser.add_argument("--sample_name", required=True, type=str)
     parser.add_argument("--target_organism", required=True, type=str)
     parser.add_argument("--taxonkit_database_dir", required=True, type=str)
+    add_manifest_argument(parser)
+    add_profile_argument(parser)
     return parser.parse_args()
 
 def load_blast_results(path):
@@ -22,26 +47,20 @@ def load_blast_results(path):
     if not os.path.isfile(path):
         raise FileNotFoundError(f"BLASTn results file not found: {path}")
 
-    columns = ["qseqid", "sgi", "sacc", "length", "nident", "pident", "mismatch", "gaps", "gapopen", "qstart",
-                "qend", "qlen", "sstart", "send", "slen", "sstrand", "evalue", "bitscore", "qcovhsp", "stitle",
-                "staxids", "qseq", "sseq", "sseqid", "qcovs", "qframe", "sframe"]
-
-    dtype = {
-        "qseqid": 'str', "sgi": 'str', "sacc": 'str', "length": 'int64', "nident": 'int64',
-        "pident": 'float64', "mismatch": 'int64', "gaps": 'int64', "gapopen": 'int64', "qstart": 'int64',
-        "qend": 'int64', "qlen": 'int64', "sstart": 'int64', "send": 'int64', "slen": 'int64', "sstrand": 'str',
-        "evalue": 'float64', "bitscore": 'float64', "qcovhsp": 'int64', "stitle": 'str', "staxids": 'str',
-        "qseq": 'str', "sseq": 'str', "sseqid": 'str', "qcovs": 'int64', "qframe": 'int64', "sframe": 'int64'
-    }
-
-    df = pd.read_csv(path, sep="\t", header=0, usecols=columns, dtype=dtype)
+    df = pd.read_csv(path, sep="\t", header=0, usecols=BLAST_COLUMNS, dtype=BLAST_DTYPES)
     df["staxids"] = pd.to_numeric(df["staxids"].str.split(";").str[0], errors='coerce').fillna(0).astype(int)
     top_hit = df.drop_duplicates(subset=["qseqid"], keep="first").copy()
 
     return top_hit
 
+def load_top_hits(path):
+    """Load the top hits table written by this script with typed columns."""
+    return pd.read_csv(path, sep="\t", header=0, dtype=TOP_HIT_DTYPES)
+
 def enrich_with_taxonomy(df, taxonkit_dir):
     """Add taxonomy information to the dataFrame."""
+    import pytaxonkit
+
     #retain unique staxids
     staxids_l = df["staxids"].unique().tolist()
 
@@ -128,13 +147,8 @@ def filter_and_format(df, sample_name, target_organism):
         mask |= exact_broad_match | exact_lineage_match
     df["target_organism_match"] = np.where(mask, "Y", "N")
 
-    
-    final_columns = ["sample_name", "qseqid", "sgi", "sacc", "length", "nident", "pident", "mismatch", "gaps",
-                     "gapopen", "qstart", "qend", "qlen", "sstart", "send", "slen", "sstrand", "evalue", "bitscore",
-                     "qcovhsp", "stitle", "staxids", "qseq", "sseq", "sseqid", "qcovs", "qframe", "sframe",
-                     "species", "broad_taxonomic_category", "FullLineage", "target_organism_match"]
 
-    return df[final_columns]
+    return df[TOP_HIT_COLUMNS]
 
 def main():
     args = parse_arguments()
@@ -152,12 +166,30 @@ def main():
     #    out_file.close()
     #    exit ()
 
-    blastn_results = load_blast_results(blastn_results_path)
-    enriched_dfs = enrich_with_taxonomy(blastn_results, tk_db_dir)
-    merged_df = merge_taxonomy(enriched_dfs)
-    final_df = filter_and_format(merged_df, sample_name, target_organism)
     out_file = os.path.basename(args.blastn_results).replace("_top_10_hits.txt", "_top_hits_tmp.txt")
-    final_df.to_csv(out_file, sep="\t", index=False)
+    manifest = Manifest(
+        args.manifest_dir, f"{sample_name}_select_top_blast_hit",
+        inputs={"blastn_results": blastn_results_path, "taxonkit_database_dir": tk_db_dir},
+        params={"target_organism": target_organism}, code=[__file__],
+    )
+    with Metrics("select_top_blast_hit", sample_name, args.profile) as metrics:
+        with metrics.span("manifest"):
+            if manifest.restore([out_file]):
+                print(f"Inputs unchanged, restored {out_file}")
+                return
+        with metrics.span("parse"):
+            blastn_results = load_blast_results(blastn_results_path)
+        metrics.rows("top_hits", len(blastn_results))
+        with metrics.span("taxonomy_lookup"):
+            enriched_dfs = enrich_with_taxonomy(blastn_results, tk_db_dir)
+        with metrics.span("merge"):
+            merged_df = merge_taxonomy(enriched_dfs)
+        with metrics.span("flagging"):
+            final_df = filter_and_format(merged_df, sample_name, target_organism)
+        with metrics.span("write"):
+            final_df.to_csv(out_file, sep="\t", index=False)
+        metrics.rows("output", len(final_df))
+        manifest.save([out_file])
     print(f"Results saved to {out_file}")
 
 if __name__ == "__main__":
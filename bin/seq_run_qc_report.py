@@ -1,75 +1,118 @@
 #!/usr/bin/env python
 import argparse
-import pandas as pd
-import glob
 import os
-import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
 import numpy as np
 
-def main():
+from fastq_stats import read_nanostats
+from instrumentation import Metrics, add_profile_argument
+from run_store import STORE_SUFFIX, write_run_store
+
+RUN_QC_PREFIX = "run_qc_report"
+RAW_SUFFIX = "_raw_NanoStats.txt"
+FILTERED_SUFFIX = "_filtered_NanoStats.txt"
+COLUMN_TYPES = {
+    "Sample": "string",
+    "raw_reads": "Int64",
+    "processed_reads": "Int64",
+    "percent_processed": "Float64",
+    "raw_reads_flag": "string",
+    "processed_reads_flag": "string",
+    "QC_FLAG": "string",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Summarise raw and processed read counts for all samples of a run")
+    parser.add_argument("--dir", type=str, default=".", help="Directory containing the *_NanoStats.txt files")
+    parser.add_argument("--existing", type=str, help="Existing run QC table to append newly finished samples to")
+    parser.add_argument("--output_prefix", type=str, default=RUN_QC_PREFIX, help="Prefix of the txt and html outputs")
+    parser.add_argument("--threads", type=int, default=4, help="Number of NanoStats files read concurrently")
+    parser.add_argument("--samplesheet", type=str,
+                        help="Samplesheet of the run, also indexed in the run store for the per-sample lookups")
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+
+def find_stats_files(directory):
+    """Return {sample: {"raw": path, "filtered": path}} from a single directory scan."""
+    stats_files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            for kind, suffix in (("raw", RAW_SUFFIX), ("filtered", FILTERED_SUFFIX)):
+                if entry.name.endswith(suffix):
+                    sample = entry.name[:-len(suffix)]
+                    stats_files.setdefault(sample, {})[kind] = entry.path
+    return stats_files
+
+
+def read_sample_counts(sample, paths):
+    """Return the raw and processed read counts of a sample, None if missing."""
+    counts = {"Sample": sample, "raw_reads": None, "processed_reads": None}
+    for kind, column in (("raw", "raw_reads"), ("filtered", "processed_reads")):
+        if kind in paths:
+            number_of_reads = read_nanostats(paths[kind]).get("number_of_reads")
+            if number_of_reads is not None:
+                counts[column] = int(number_of_reads)
+    return counts
+
 
-    timestr = time.strftime("%Y%m%d-%H%M%S")
-    summary_dict = {}
-
-    for raw_read_out in glob.glob("*raw_NanoStats.txt"):
-        raw_reads = ()
-        line_number = 0
-        sample = (os.path.basename(raw_read_out).replace('_raw_NanoStats.txt', ''))
-        with open(raw_read_out, 'r') as f:
-            for line in f:
-                string_to_search = ("number_of_reads")
-                line_number += 1
-                if string_to_search in line:
-                    elements = line.rsplit('\t')
-                    raw_reads = int(elements[1].strip())
-                    print(raw_reads)
-
-        summary_dict[sample] = [raw_reads]
-        print(summary_dict)
-        f.close()
-
-    for qt_read_out in glob.glob("*filtered_NanoStats.txt"):
-        qt_reads = ()
-        line_number = 0 
-        sample = (os.path.basename(qt_read_out).replace('_filtered_NanoStats.txt', ''))
-        with open(qt_read_out, 'r') as f:
-            for line in f:
-                string_to_search = ("number_of_reads")
-                line_number += 1
-                if string_to_search in line:
-                    elements = line.rsplit('\t')
-                    qt_reads = int(elements[1].strip())
-                    print(qt_reads)
-            #first_line = next(f)
-            #qt_reads = int(first_line[0].strip())
-        f.close()
-        summary_dict[sample].append(qt_reads)
-
-    run_data_df = pd.DataFrame([([k] + v) for k, v in summary_dict.items()], columns=['Sample','raw_reads','processed_reads'])
-    run_data_df['percent_processed'] = run_data_df['processed_reads'] / run_data_df['raw_reads'] * 100
-    run_data_df['percent_processed'] = run_data_df['percent_processed'].apply(lambda x: float("{:.2f}".format(x)))
-    run_data_df = run_data_df.sort_values("Sample")
-    run_data_df['raw_reads_flag'] = np.where((run_data_df['raw_reads'] < 2500), "Less than 2500 raw reads", "")
-    run_data_df['processed_reads_flag'] = np.where((run_data_df['processed_reads'] < 200), "Less than 200 processed reads", "")
+def load_run_table(path):
+    """Load an existing run QC table with typed columns."""
+    df = pd.read_csv(path, sep="\t", header=0, dtype=str, keep_default_na=False, na_values=[""])
+    return df.astype({col: dtype for col, dtype in COLUMN_TYPES.items() if col in df.columns})
+
+
+def build_run_table(stats_files, existing=None, threads=4):
+    """Read the stats of every sample not already complete in the existing table."""
+    if existing is not None:
+        complete = existing.dropna(subset=["raw_reads", "processed_reads"])
+        stats_files = {
+            sample: paths for sample, paths in stats_files.items()
+            if sample not in set(complete["Sample"])
+        }
+        existing = existing[~existing["Sample"].isin(stats_files)]
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        rows = list(pool.map(lambda item: read_sample_counts(*item), stats_files.items()))
+
+    new_df = pd.DataFrame(rows, columns=["Sample", "raw_reads", "processed_reads"])
+    new_df = new_df.astype({col: COLUMN_TYPES[col] for col in new_df.columns})
+    if existing is not None and len(existing):
+        new_df = pd.concat([existing[new_df.columns], new_df], ignore_index=True)
+    print(f"Read stats for {len(rows)} samples")
+    return new_df
+
+
+def apply_qc_flags(run_data_df):
+    run_data_df['percent_processed'] = (run_data_df['processed_reads'] / run_data_df['raw_reads'] * 100).round(2)
+    run_data_df = run_data_df.sort_values("Sample").reset_index(drop=True)
+    raw_low = (run_data_df['raw_reads'] < 2500).fillna(False).to_numpy(dtype=bool)
+    processed_low = (run_data_df['processed_reads'] < 200).fillna(False).to_numpy(dtype=bool)
+    raw_ok = (run_data_df['raw_reads'] >= 2500).fillna(False).to_numpy(dtype=bool)
+    processed_ok = (run_data_df['processed_reads'] >= 200).fillna(False).to_numpy(dtype=bool)
+    run_data_df['raw_reads_flag'] = np.where(raw_low, "Less than 2500 raw reads", "")
+    run_data_df['processed_reads_flag'] = np.where(processed_low, "Less than 200 processed reads", "")
     run_data_df["QC_FLAG"] = np.where(
-        (run_data_df['processed_reads'] < 200),
+        processed_low,
         "RED",
         np.where(
-            ((run_data_df['raw_reads'] < 2500) &
-            (run_data_df['processed_reads'] >= 200)),
+            raw_low & processed_ok,
             "ORANGE",
             np.where(
-                ((run_data_df['raw_reads'] >= 2500) &
-                (run_data_df['processed_reads'] >= 200)),
+                raw_ok & processed_ok,
                 "GREEN",
                 ""
             )
         )
     )
+    return run_data_df.astype(COLUMN_TYPES)
 
-    run_data_df.to_csv("run_qc_report_" + timestr + ".txt", index = None, sep="\t")
 
-    summary_table = run_data_df.to_html(index=False).replace('<table border="1" class="dataframe">','<table class="table table-striped">') # use bootstrap styling
+def write_html(run_data_df, path):
+    summary_table = run_data_df.to_html(index=False, na_rep="NA").replace('<table border="1" class="dataframe">','<table class="table table-striped">') # use bootstrap styling
     html_string = '''
     <html>
         <head>
@@ -89,9 +132,30 @@ def main():
         </body>
     </html>'''
 
-    report = open("run_qc_report_" + timestr + ".html", "w")
-    report.write(html_string)
-    report.close()
+    with open(path, "w") as report:
+        report.write(html_string)
+
+
+def main():
+    args = parse_args()
+    with Metrics("seq_run_qc_report", profile=args.profile) as metrics:
+        existing = None
+        with metrics.span("parse"):
+            if args.existing and os.path.isfile(args.existing):
+                existing = load_run_table(args.existing)
+
+            stats_files = find_stats_files(args.dir)
+            run_data_df = build_run_table(stats_files, existing, args.threads)
+        metrics.rows("samples", len(run_data_df))
+        with metrics.span("flagging"):
+            run_data_df = apply_qc_flags(run_data_df)
+
+        with metrics.span("render"):
+            run_data_df.to_csv(args.output_prefix + ".txt", index=None, sep="\t")
+            write_html(run_data_df, args.output_prefix + ".html")
+        with metrics.span("store"):
+            write_run_store(args.output_prefix + STORE_SUFFIX, run_data_df, args.samplesheet)
+    print(run_data_df)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Subsample a (gzipped) FASTQ file to a fixed number of reads in a single pass.
+
+Reads are streamed once and selected by weighted reservoir sampling
+(Efraimidis & Spirakis): each read draws the key log(u) / weight and the
+--n_reads reads with the largest keys are kept, so memory is bounded by the
+reservoir and one block of reads. With --mode uniform every read has the
+same weight, as with `seqkit sample -2 -n`. With --mode length, reads whose
+length is close to --target_size are preferred, so that full-length amplicon
+reads are not crowded out by fragments; --mode quality further weights them
+by their mean quality. Reads far from the target size can still be selected
+when there are not enough reads around it.
+
+The selected reads are written as BGZF in their input order.
+"""
+import argparse
+
+import numpy as np
+
+from bgzf import BgzfWriter
+from fastq_stats import block_stats, iter_chunks, iter_line_blocks
+from instrumentation import Metrics, add_profile_argument
+
+MODES = ("uniform", "length", "quality")
+# Standard deviation of the length weight, as a fraction of the target size
+LENGTH_TOLERANCE = 0.1
+# Mean quality at which the quality weight saturates
+MAX_QUALITY = 40
+# Weight floor of reads far from the target size, or without quality scores
+MIN_WEIGHT = 0.01
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fastq", type=str, required=True, help="FASTQ file, optionally gzipped")
+    parser.add_argument("--sample", type=str, required=True, help="Provide sample name")
+    parser.add_argument("--n_reads", type=int, required=True, help="Number of reads to keep")
+    parser.add_argument("--mode", choices=MODES, default="uniform", help="Read weighting (default: uniform)")
+    parser.add_argument("--target_size", type=int, help="Expected amplicon size, required by the length and quality modes")
+    parser.add_argument("--seed", type=int, default=11, help="Random seed (default: 11)")
+    parser.add_argument("--threads", type=int, default=1, help="Threads used to inflate and compress BGZF")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.mode != "uniform" and not args.target_size:
+        parser.error(f"--mode {args.mode} requires --target_size")
+    return args
+
+
+def read_weights(seqs, quals, mode, target_size):
+    """Return the sampling weight of each read of a block."""
+    if mode == "uniform":
+        return np.ones(len(seqs))
+    lengths, mean_quals = block_stats(seqs, quals)
+    distance = (lengths - target_size) / (LENGTH_TOLERANCE * target_size)
+    weights = np.exp(-0.5 * distance ** 2)
+    if mode == "quality":
+        weights = weights * np.minimum(mean_quals / MAX_QUALITY, 1)
+    return np.maximum(weights, MIN_WEIGHT)
+
+
+def sample_reads(path, n_reads, mode="uniform", target_size=None, seed=11, threads=1):
+    """Return (selected records in input order, number of reads seen)."""
+    rng = np.random.default_rng(seed)
+    keys = np.empty(0)
+    order = np.empty(0, dtype=np.int64)
+    records = []
+    n_seen = 0
+    for lines in iter_line_blocks(iter_chunks(path, threads=threads)):
+        n_block = len(lines) // 4
+        weights = read_weights(lines[1::4], lines[3::4], mode, target_size)
+        block_keys = np.log(rng.random(n_block)) / weights
+        all_keys = np.concatenate((keys, block_keys))
+        if len(all_keys) > n_reads:
+            keep = np.argpartition(all_keys, len(all_keys) - n_reads)[len(all_keys) - n_reads:]
+        else:
+            keep = np.arange(len(all_keys))
+        n_kept = len(keys)
+        records = [
+            records[i] if i < n_kept else b"\n".join(lines[4 * (i - n_kept):4 * (i - n_kept) + 4])
+            for i in keep
+        ]
+        keys = all_keys[keep]
+        order = np.concatenate((order, np.arange(n_seen, n_seen + n_block)))[keep]
+        n_seen += n_block
+    return [records[i] for i in np.argsort(order)], n_seen
+
+
+def main():
+    args = parse_args()
+    with Metrics("subsample_reads", args.sample, args.profile) as metrics:
+        with metrics.span("sample"):
+            records, n_seen = sample_reads(args.fastq, args.n_reads, args.mode, args.target_size,
+                                           args.seed, args.threads)
+        metrics.rows("reads", n_seen)
+        metrics.rows("subsampled_reads", len(records))
+
+        with metrics.span("write"):
+            with open(f"{args.sample}_downsampled.fastq.gz", "wb") as f, BgzfWriter(f, args.threads) as writer:
+                for record in records:
+                    writer.write(record + b"\n")
+    print(f"{args.fastq}: kept {len(records)} of {n_seen} reads")
+
+
+if __name__ == "__main__":
+    main()
@@ -39,6 +39,9 @@ def helpMessage () {
                                       Default: true
       --qc_only                       Only perform preliminary QC step using Nanoplot
                                       Default: false
+      --nanoplot                      Generate the NanoPlot reports. When false, read statistics are
+                                      derived with fastq_stats.py only
+                                      Default: true
       --preprocessing_only            Only perform preprocessing steps specied
                                       Default: false
       --porechop_options              Porechop_ABI options
@@ -51,6 +54,13 @@ def helpMessage () {
                                       [False]
       --chopper_options               Chopper options
                                       Default: ''
+      --subsample                     Subsample the preprocessed reads
+                                      Default: false
+      --reads_downsampling_size       Number of reads to subsample
+                                      Default: 10000
+      --subsample_mode                How reads are weighted when subsampling: uniform, length (prefer reads
+                                      close to the target_size) or quality (length and mean read quality)
+                                      Default: 'uniform'
 
       #### Polishing ###
       --polishing                     Run polishing step
@@ -68,6 +78,11 @@ def helpMessage () {
                                        Default: '10000'
       --rattle_clustering_max_variance  Use all the reads without any length filtering
                                        Default: false
+      --primer_prefilter               Before clustering, drop reads outside target_size +/- 20% or without
+                                       the samplesheet primers, and orient reads to the forward primer strand
+                                       Default: false
+      --primer_prefilter_options       primer_prefilter.py options, e.g. '--length_tolerance 0.3 --max_mismatches 3'
+                                       Default: ''
       --rattle_clustering_options      Rattle clustering options
                                        Default: ''
       --rattle_polishing_options       Rattle polishing options
@@ -80,9 +95,37 @@ def helpMessage () {
                                       Default: ''
       --blastn_COI                    Path to blast database for COI [required if performing analysis on COI gene]
                                       Default: ''
+      --coi_orientation               How the orientation of COI consensus is derived: kmer (minimizer index of the
+                                      blastn_COI fasta, blast is only run on undecided consensus) or blast
+                                      Default: 'kmer'
+      --coi_index_dir                 Directory in which the minimizer index of blastn_COI is kept between runs
+                                      Default: [outdir]/01_pipeline_info/coi_orientation_index
+      --bam_viewer                    How the BAM viewer of the HTML report loads the alignments: inline (embedded in
+                                      the page) or served (range requests to the files of 05_mapping_to_consensus,
+                                      open it through `ont_amplicon serve-report [outdir]/SampleName`)
+                                      Default: 'inline'
       --taxdump                       Path to taxonomykit database directory [required if not performing qc_only or preprocessing_only]
                                       Default: ''
 
+      #### Resource options ####
+      --dynamic_resources             Size the cpus and memory of RATTLE, MEDAKA2 and COVSTATS from the
+                                      number of preprocessed reads and bases of each sample
+                                      Default: false
+      --max_cpus                      Upper bound of the dynamic cpus hints
+                                      Default: 8
+      --max_memory                    Upper bound of the dynamic memory hints (GB)
+                                      Default: 64
+      --keep_intermediates            Also save the table of consensus sequences and their top blast hits
+                                      (SampleName_*_megablast_top_hits.txt) written before the coverage statistics are added
+                                      Default: false
+      --profile_scripts               Dump cProfile and tracemalloc output of the Python scripts
+                                      alongside their timing and memory metrics
+                                      Default: false
+      --manifest_dir                  Directory in which the Python stages (top blast hit, coverage statistics, HTML report)
+                                      keep their outputs with a manifest of their inputs, so that a rerun restores them
+                                      instead of recomputing them when their inputs, parameters and code are unchanged
+                                      Default: null (disabled)
+
       #### Mapping back to ref options ####
       --mapping_back_to_ref           Mapped back to reference blast match
                                       Default: 'true'
@@ -218,6 +261,43 @@ process BLASTN_COI {
     """
 }
 
+//Build the minimizer index of the COI reference sequences once, it is kept in coi_index_dir for later runs
+process COI_ORIENTATION_INDEX {
+  label "setting_2"
+  containerOptions "${bindOptions}"
+  storeDir "${params.coi_index_dir ?: params.outdir + '/01_pipeline_info/coi_orientation_index'}"
+
+  input:
+    path(reference)
+  output:
+    path("${reference.getName()}.orientation_index.npy"), emit: index
+
+  script:
+    """
+    ont_amplicon revcomp --orient_reference ${reference} --orient_index ${reference.getName()}.orientation_index.npy
+    """
+}
+
+//Derive the orientation of the COI consensus from the minimizer index, leaving ambiguous ones for BLASTN_COI
+process ORIENT_COI {
+  tag "${sampleid}"
+  label "setting_1"
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
+
+  input:
+    tuple val(sampleid), path(assembly), val(target_gene), path(orient_index)
+  output:
+    tuple val(sampleid), path("${sampleid}_kmer_ids_to_reverse_complement.txt"), emit: ids
+    tuple val(sampleid), path("${sampleid}_ambiguous_orientation.fasta"), val(target_gene), emit: ambiguous
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true
+
+  script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
+    """
+    ont_amplicon revcomp --sample ${sampleid} --fasta ${assembly} --orient_index ${orient_index}${profile}
+    """
+}
+
 process BLASTN2 {
   publishDir "${params.outdir}/${sampleid}/04_megablast", mode: 'copy', pattern: '{*_megablast_top_10_hits.txt,*_blast_status.txt}'
   tag "${sampleid}"
@@ -277,18 +357,25 @@ process CHOPPER {
 process COVSTATS {
   tag "$sampleid"
   label "setting_1"
-  publishDir "${params.outdir}/${sampleid}/05_mapping_to_consensus", mode: 'copy'
+  publishDir "${params.outdir}/${sampleid}/05_mapping_to_consensus", mode: 'copy', pattern: '*top_blast_with_cov_stats.txt'
+  publishDir "${params.outdir}/${sampleid}/04_megablast", mode: 'copy', pattern: '*_megablast_top_hits.txt'
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
 
   input:
-    tuple val(sampleid), path(bed), path(consensus), path(coverage), path(mapping_qual), path(top_hits), path(nanostats), val(target_size), path(reads_fasta), path(contig_seqids)
+    tuple val(sampleid), path(bed), path(consensus), path(coverage), path(mapping_qual), path(top_hits), path(consensus_seqs, stageAs: 'consensus/*'), path(nanostats), val(target_size), path(read_lengths), path(consensus_fastq), path(pileup), val(resources)
   output:
     path("*top_blast_with_cov_stats.txt")
+    path("*_megablast_top_hits.txt"), optional: true
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true, emit: metrics
     tuple val(sampleid), path("*top_blast_with_cov_stats.txt"), emit: detections_summary
     path("*top_blast_with_cov_stats.txt"), emit: detections_summary2
 
   script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
+  def intermediates = (params.keep_intermediates) ? " --write_intermediates" : ''
+  def manifest = (params.manifest_dir) ? " --manifest_dir ${file(params.manifest_dir)}" : ''
     """
-    derive_coverage_stats.py --sample ${sampleid} --blastn_results ${top_hits} --nanostat ${nanostats} --coverage ${coverage} --bed ${bed} --target_size ${target_size} --contig_seqids ${contig_seqids} --reads_fasta ${reads_fasta} --consensus ${consensus} --mapping_quality ${mapping_qual}
+    ont_amplicon annotate --sample ${sampleid} --tophits ${top_hits} --fasta ${consensus_seqs} --nanostat ${nanostats} --coverage ${coverage} --bed ${bed} --target_size ${target_size} --read_lengths ${read_lengths} --consensus ${consensus} --mapping_quality ${mapping_qual} --consensus_fastq ${consensus_fastq} --pileup ${pileup}${intermediates}${manifest}${profile}
     """
 }
 /*
@@ -351,6 +438,7 @@ process EXTRACT_BLAST_HITS {
   tag "${sampleid}"
   label "setting_1"
   containerOptions "${bindOptions}"
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
 
   input:
     tuple val(sampleid), path(blast_results), path(status), val(target_organism), val(target_gene), val(target_size)
@@ -359,15 +447,18 @@ process EXTRACT_BLAST_HITS {
     tuple val(sampleid), path("${sampleid}*_megablast_top_hits_tmp.txt"), emit: topblast
     tuple val(sampleid), path("${sampleid}_reference_match.fasta"), emit: reference_fasta_files
     tuple val(sampleid), path("${sampleid}_final_polished_consensus_match.fasta"), emit: consensus_fasta_files
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true, emit: metrics
 
   script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
+  def manifest = (params.manifest_dir) ? " --manifest_dir ${file(params.manifest_dir)}" : ''
     target_organism_str = (target_organism instanceof List)
     ? "\"${target_organism.join('|')}\""
     : "\"${target_organism}\""
     """
     if [[ \$(wc -l < *_megablast_top_10_hits.txt) -ge 2 ]]
       then
-        select_top_blast_hit.py --sample_name ${sampleid} --blastn_results ${sampleid}*_top_10_hits.txt --target_organism ${target_organism_str} --taxonkit_database_dir ${params.taxdump}
+        ont_amplicon top-blast-hit --sample_name ${sampleid} --blastn_results ${sampleid}*_top_10_hits.txt --target_organism ${target_organism_str} --taxonkit_database_dir ${params.taxdump}${manifest}${profile}
 
         # extract segment of consensus sequence that align to reference
         awk  -F  '\\t' 'NR>1 { printf ">%s\\n%s\\n",\$2,\$23 }' ${sampleid}*_top_hits_tmp.txt | sed 's/-//g' > ${sampleid}_final_polished_consensus_match.fasta
@@ -455,23 +546,6 @@ process CLUSTER2FASTA {
     """
 }
 
-process FASTA2TABLE {
-  tag "$sampleid"
-  label "setting_1"
-  publishDir "${params.outdir}/${sampleid}/04_megablast", mode: 'copy'
-
-  input:
-    tuple val(sampleid), path(tophits), path(fasta)
-  output:
-    file("${sampleid}*_megablast_top_hits.txt")
-    tuple val(sampleid), file("${sampleid}*_megablast_top_hits.txt"), emit: blast_results
-
-  script:
-    """
-    fasta2table.py --fasta ${fasta} --sample ${sampleid} --tophits ${tophits}
-    """
-}
-
 //If Racon polishing failed or produced an empty file, then Medaka will be run on the Rattle assembly.
 //If Medaka polishing fails, then the script will run samtools consensus to produce a consensus sequence from the Rattle assembly.
 process MEDAKA2 {
@@ -480,7 +554,7 @@ process MEDAKA2 {
   label 'setting_3'
 
   input:
-   tuple val(sampleid), path(fastq), path(rattle_assembly), path(assembly)
+   tuple val(sampleid), path(fastq), path(rattle_assembly), path(assembly), val(resources)
 
   output:
    path("${sampleid}_medaka_consensus.fasta")
@@ -613,11 +687,13 @@ process MOSDEPTH {
 
   output:
     tuple val(sampleid), path("${sampleid}.thresholds.bed"), emit: mosdepth_results
+    tuple val(sampleid), path("${sampleid}.per-base.bed"), emit: per_base
 
   script:
     """
     if [[ ! -s ${consensus} ]]; then
       touch ${sampleid}.thresholds.bed
+      touch ${sampleid}.per-base.bed
 
     else
       mosdepth --by ${bed} --thresholds 30 -t ${task.cpus} ${sampleid} ${bam}
@@ -627,6 +703,26 @@ process MOSDEPTH {
     """
 }
 
+process DEPTH_PROFILE {
+  tag "$sampleid"
+  label "setting_1"
+  publishDir "${params.outdir}/${sampleid}/05_mapping_to_consensus", mode: 'copy', pattern: '*_depth_profile.npz'
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
+
+  input:
+    tuple val(sampleid), path(per_base)
+
+  output:
+    tuple val(sampleid), path("${sampleid}_depth_profile.npz"), emit: depth_profile
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true, emit: metrics
+
+  script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
+    """
+    ont_amplicon depth-profile --sample ${sampleid} --per_base ${per_base}${profile}
+    """
+}
+
 process PYFAIDX {
   tag "$sampleid"
   label "setting_3"
@@ -672,21 +768,27 @@ process PORECHOP_ABI {
 }
 
 process QCREPORT {
-  publishDir "${params.outdir}/00_QC_report", mode: 'copy', overwrite: true
+  publishDir "${params.outdir}/00_QC_report", mode: 'copy', overwrite: true, pattern: 'run_qc_report.*'
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
   containerOptions "${bindOptions}"
 
   input:
     path multiqc_files
+    path samplesheet
 
   output:
-    path("run_qc_report_*txt")
-    path("run_qc_report_*html")
-    path("run_qc_report_*html"), emit: qc_report_html
-    path("run_qc_report_*txt"), emit: qc_report_txt
+    path("run_qc_report.txt")
+    path("run_qc_report.html")
+    path("run_qc_report.sqlite")
+    path("run_qc_report.html"), emit: qc_report_html
+    path("run_qc_report.txt"), emit: qc_report_txt
+    path("run_qc_report.sqlite"), emit: run_store
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true
 
   script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
     """
-    seq_run_qc_report.py
+    ont_amplicon run-qc --samplesheet ${samplesheet}${profile}
     """
 }
 
@@ -736,7 +838,7 @@ process RATTLE {
   publishDir "${params.outdir}/${sampleid}/02_clustering", mode: 'copy', pattern: '{*_rattle.log,*_rattle_status.txt}'
 
   input:
-    tuple val(sampleid), path(fastq), val(target_size)
+    tuple val(sampleid), path(fastq), val(target_size), val(resources)
 
   output:
     file("${sampleid}_rattle.log")
@@ -806,23 +908,44 @@ process REFORMAT {
     """
 }
 
+//Derive cpus and memory hints for RATTLE, MEDAKA2 and COVSTATS from the number of preprocessed reads and bases
+process RESOURCE_HINTS {
+  tag "${sampleid}"
+  label "setting_1"
+  publishDir "${params.outdir}/${sampleid}/01_QC", mode: 'copy', pattern: '*_resources.csv'
+
+  input:
+    tuple val(sampleid), path(nanostats)
+
+  output:
+    tuple val(sampleid), path("${sampleid}_resources.csv"), emit: hints
+
+  script:
+    """
+    ont_amplicon resource-hints --sample ${sampleid} --nanostat ${nanostats} --max_cpus ${params.max_cpus} --max_memory ${params.max_memory}
+    """
+}
+
 process REVCOMP {
   publishDir "${params.outdir}/${sampleid}/04_megablast", mode: 'copy', pattern: '{*fasta}'
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
   tag "${sampleid}"
   label "setting_1"
   containerOptions "${bindOptions}"
 
   input:
-    tuple val(sampleid), path(contigs), path(ids_to_revcomp)
+    tuple val(sampleid), path(contigs), path(ids_to_revcomp, stageAs: 'ids/*')
 
 
   output:
     file "${sampleid}_final_polished_consensus_rc.fasta"
     tuple val(sampleid), path("${sampleid}_final_polished_consensus_rc.fasta"), emit: revcomp, optional: true
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true
 
   script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
     """
-    reverse_complement.py --sample ${sampleid} --ids_to_rc ${ids_to_revcomp} --fasta ${contigs}
+    ont_amplicon revcomp --sample ${sampleid} --ids_to_rc ${ids_to_revcomp} --fasta ${contigs}${profile}
     """
 }
 
@@ -867,25 +990,24 @@ process SAMTOOLS_CONSENSUS {
     tuple val(sampleid), path(consensus), path("${sampleid}_aln.sorted.bam"), path("${sampleid}_aln.sorted.bam.bai"), emit: sorted_bams
     tuple val(sampleid), path("${sampleid}_coverage.txt"), emit: coverage
     tuple val(sampleid), path("${sampleid}_mapq.txt"), emit: mapping_quality
-    tuple val(sampleid), path("${sampleid}_contigs_reads_ids.txt"), emit: contig_seqids
+    tuple val(sampleid), path("${sampleid}_final_polished_consensus_match.fastq"), path("${sampleid}_final_polished_consensus_match.pileup"), emit: consensus_quality
   script:
     """
     if [[ ! -s ${consensus} ]]; then
-      touch ${sampleid}_contigs_reads_ids.txt
       touch ${sampleid}_aln.sorted.bam
       touch ${sampleid}_aln.sorted.bam.bai
       touch ${sampleid}_coverage.txt
       touch ${sampleid}_mapq.txt
       touch ${sampleid}_final_polished_consensus_match.fastq
+      touch ${sampleid}_final_polished_consensus_match.pileup
     else
-      samtools view -S -F 4 ${sample} | cut -f1,3 | sort | uniq > ${sampleid}_contigs_reads_ids.txt
       samtools view -Sb -F 4 ${sample} | samtools sort -o ${sampleid}_aln.sorted.bam
       samtools index ${sampleid}_aln.sorted.bam
       samtools coverage ${sampleid}_aln.sorted.bam  > ${sampleid}_coverage.txt
       samtools coverage -A -w 50 ${sampleid}_aln.sorted.bam > ${sampleid}_histogram.txt
       samtools view ${sampleid}_aln.sorted.bam | awk '{mapq[\$3]+=\$5; count[\$3]++} END {for (chr in mapq) printf "%s\\t%.2f\\n", chr, mapq[chr]/count[chr]}' > ${sampleid}_mapq.txt
       samtools consensus -f fastq -a -A -X r10.4_sup -o ${sampleid}_final_polished_consensus_match.fastq ${sampleid}_aln.sorted.bam
-      samtools consensus -f pileup -a -A -X r10.4_sup -o ${sampleid}_final_polished_consensus_match.pileup ${sampleid}_aln.sorted.bam
+      samtools mpileup -aa -B -Q 0 -d 0 -f ${consensus} -o ${sampleid}_final_polished_consensus_match.pileup ${sampleid}_aln.sorted.bam
     fi
     """
 }
@@ -905,17 +1027,20 @@ process TIMESTAMP_START {
 }
 
 process HTML_REPORT {
-  publishDir "${params.outdir}/${sampleid}/07_html_report", mode: 'copy', overwrite: true
+  publishDir "${params.outdir}/${sampleid}/07_html_report", mode: 'copy', overwrite: true, saveAs: { filename -> (filename ==~ /.*(_metrics\.json|\.prof|_tracemalloc\.txt)$/) ? null : filename }
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
   containerOptions "${bindOptions}"
   label 'setting_3'
 
   input:
-    tuple val(sampleid), path(raw_nanoplot), path(filtered_nanoplot), path (rattle_status), path(consensus_fasta), path(top_blast_hits), path(blast_status), path(consensus_match_fasta), path(aln_sorted_bam), path(aln_sorted_bam_bai), path(blast_with_cov_stats),
+    tuple val(sampleid), path(raw_nanoplot), path(filtered_nanoplot), path (rattle_status), path(consensus_fasta), path(top_blast_hits), path(blast_status), path(consensus_match_fasta), path(aln_sorted_bam), path(aln_sorted_bam_bai), path(blast_with_cov_stats), path(depth_profile),
     path(timestamp),
-    path(qcreport_html),
+    path(qcreport_html, stageAs: 'run_qc/*'),
     path(qcreport_txt),
+    path(run_store),
     path(configyaml),
-    path(samplesheet)
+    path(samplesheet),
+    path(trace, stageAs: 'execution_trace.txt')
 
   output:
     path("*"), optional: true
@@ -924,51 +1049,101 @@ process HTML_REPORT {
   script:
   analyst_name = params.analyst_name.replaceAll(/ /, '_')
   facility = params.facility.replaceAll(/ /, '_')
+  def profile = (params.profile_scripts) ? " --profile" : ''
+  def bam_viewer = (params.bam_viewer == 'served') ? " --bam_viewer served --bam_data_url ../05_mapping_to_consensus/" : ''
+  def manifest = (params.manifest_dir) ? " --manifest_dir ${file(params.manifest_dir)}" : ''
     """
     cp ${qcreport_html} run_qc_report.html
     cp ${params.tool_versions} versions.yml
     cp ${params.default_params} default_params.yml
 
-    build_report.py --samplesheet ${samplesheet} --result_dir . --params_file ${configyaml} --analyst ${analyst_name} --facility ${facility} --versions versions.yml --default_params_file default_params.yml
+    ont_amplicon report --samplesheet ${samplesheet} --result_dir . --params_file ${configyaml} --analyst ${analyst_name} --facility ${facility} --versions versions.yml --default_params_file default_params.yml --trace ${trace}${bam_viewer}${manifest}${profile}
     """
 }
 
-process SEQTK {
+process RUN_SUMMARY {
+  publishDir "${params.outdir}/00_run_summary", mode: 'copy', overwrite: true, pattern: 'run_summary.*'
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
+  containerOptions "${bindOptions}"
+  label 'setting_3'
+
+  input:
+    path(detections, stageAs: 'detections/*')
+    path(qcreport_txt)
+    path(metrics, stageAs: 'metrics/*')
+
+  output:
+    path("run_summary.sqlite")
+    path("run_summary.html")
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true
+
+  script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
+    """
+    ont_amplicon run-summary --detections detections/* --run_qc ${qcreport_txt} --metrics \$(find metrics -name '*_metrics.json' 2>/dev/null)${profile}
+    """
+}
+
+//Extract the mapped reads and their lengths from the BAM file in a single pass, for the read length QC of COVSTATS
+process MAPPED_READS {
   tag "${sampleid}"
   label "setting_2"
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
 
   input:
-    tuple val(sampleid), path(contig_seqids), path(fastq)
-    output:
-    tuple val(sampleid), path("${sampleid}.fasta"), emit: fasta
-    tuple val(sampleid), path(contig_seqids), emit: contig_seqids
+    tuple val(sampleid), path(consensus), path(bam), path(bai)
+
+  output:
+    tuple val(sampleid), path("${sampleid}_read_lengths.npy"), emit: read_lengths
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true, emit: metrics
 
   script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
     """
-    if [[ ! -s ${contig_seqids} ]]; then
-      touch ${sampleid}.fasta
-    else
-      seqtk seq -A -C ${fastq} > ${sampleid}_all_reads.fasta
-      cut -f1 ${contig_seqids} | sort | uniq > reads_ids.txt
-      seqtk subseq ${sampleid}_all_reads.fasta reads_ids.txt > ${sampleid}.fasta
-    fi
+    ont_amplicon mapped-reads --sample ${sampleid} --bam ${bam} --threads ${task.cpus}${profile}
+    """
+}
+
+//Drop reads of off-target length or without primers and orient the others to the forward primer strand
+process PRIMER_PREFILTER {
+  tag "${sampleid}"
+  label "setting_2"
+  publishDir "${params.outdir}/${sampleid}/00_preprocessing", mode: 'copy', pattern: '*_prefilter.log'
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
+
+  input:
+    tuple val(sampleid), path(fastq), val(fwd_primer), val(rev_primer), val(target_size)
+
+  output:
+    path("${sampleid}_prefilter.log")
+    tuple val(sampleid), path("${sampleid}_prefiltered.fastq.gz"), emit: prefiltered_fq
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true
+
+  script:
+  def primers = (fwd_primer && rev_primer) ? " --fwd_primer ${fwd_primer} --rev_primer ${rev_primer}" : ''
+  def prefilter_options = (params.primer_prefilter_options) ? " ${params.primer_prefilter_options}" : ''
+  def profile = (params.profile_scripts) ? " --profile" : ''
+    """
+    ont_amplicon prefilter --fastq ${fastq} --sample ${sampleid} --target_size ${target_size}${primers} --threads ${task.cpus}${prefilter_options}${profile}
     """
 }
 
 process SUBSAMPLE {
   tag "${sampleid}"
   label "setting_2"
+  publishDir "${params.outdir}/01_pipeline_info/metrics", mode: 'copy', pattern: '{*_metrics.json,*.prof,*_tracemalloc.txt}'
 
   input:
-    tuple val(sampleid), path(fastq)
+    tuple val(sampleid), path(fastq), val(target_size)
 
   output:
     tuple val(sampleid), path("${sampleid}_downsampled.fastq.gz"), emit: subsampled_fq
+    path("{*_metrics.json,*.prof,*_tracemalloc.txt}"), optional: true
 
   script:
+  def profile = (params.profile_scripts) ? " --profile" : ''
     """
-    seqkit sample -2 ${fastq} -n ${params.reads_downsampling_size} \
-    | gzip  > ${sampleid}_downsampled.fastq.gz
+    ont_amplicon subsample --fastq ${fastq} --sample ${sampleid} --n_reads ${params.reads_downsampling_size} --mode ${params.subsample_mode} --target_size ${target_size} --threads ${task.cpus}${profile}
     """
 }
 
@@ -1136,18 +1311,28 @@ workflow {
     QC_POST_DATA_PROCESSING ( filtered_fq )
 
     if (params.subsample) {
-      SUBSAMPLE ( REFORMAT.out.reformatted_fq )
+      SUBSAMPLE ( REFORMAT.out.reformatted_fq.join(ch_target_size) )
       final_fq = SUBSAMPLE.out.subsampled_fq
     }
     else {
       final_fq = REFORMAT.out.reformatted_fq
     }
 
+    //Size the read-dependent processes from the preprocessing statistics
+    if (params.dynamic_resources) {
+      RESOURCE_HINTS ( QC_POST_DATA_PROCESSING.out.filtstats )
+      ch_resources = RESOURCE_HINTS.out.hints
+        .map { sampleid, hints -> tuple(sampleid, hints.splitCsv(header: true).collectEntries { row -> [(row.process): row] }) }
+    }
+    else {
+      ch_resources = final_fq.map { sampleid, fastq -> tuple(sampleid, [:]) }
+    }
+
     //Derive QC report
     ch_multiqc_files = Channel.empty()
     ch_multiqc_files = ch_multiqc_files.mix(QC_PRE_DATA_PROCESSING.out.read_counts.collect().ifEmpty([]))
     ch_multiqc_files = ch_multiqc_files.mix(QC_POST_DATA_PROCESSING.out.read_counts.collect().ifEmpty([]))
-    QCREPORT(ch_multiqc_files.collect())
+    QCREPORT(ch_multiqc_files.collect(), file(params.samplesheet))
 
     if (!params.preprocessing_only) {
       //Currently only one analysis mode in ont_amplicon, consider removing if no other mode is added to this pipeline
@@ -1156,7 +1341,14 @@ workflow {
         //Perform clustering using Rattle and convert to fasta file
         //Branch outputs of Rattle into passed and failed
         //If the clustering step succeeds, it will proceed to the polishing step
-        ch_fq_target_size = (final_fq.join(ch_target_size))
+        if (params.primer_prefilter) {
+          PRIMER_PREFILTER ( final_fq.join(ch_primers).join(ch_target_size) )
+          cluster_fq = PRIMER_PREFILTER.out.prefiltered_fq
+        }
+        else {
+          cluster_fq = final_fq
+        }
+        ch_fq_target_size = (cluster_fq.join(ch_target_size).join(ch_resources))
         RATTLE ( ch_fq_target_size )
         CLUSTER2FASTA ( RATTLE.out.clusters )
 
@@ -1164,7 +1356,7 @@ workflow {
         if (params.polishing) {
           MINIMAP2_RACON ( CLUSTER2FASTA.out.fasta )
           RACON ( MINIMAP2_RACON.out.draft_mapping)
-          MEDAKA2 ( RACON.out.polished )
+          MEDAKA2 ( RACON.out.polished.join(ch_resources) )
           ch_branched = MEDAKA2.out.consensus2
             | branch { sampleid, clusters, consensus, status ->
               passed: status == "passed"
@@ -1188,10 +1380,29 @@ workflow {
 
         //Blast steps for samples targetting COI
         ch_coi_for_blast = (CUTADAPT.out.trimmed.join(ch_coi))
-        //Blast to COI database
-        BLASTN_COI(ch_coi_for_blast)
+        if (params.coi_orientation == 'kmer') {
+          //Orient the consensus with a minimizer index of the COI database
+          ch_coi_reference = (params.blastn_COI) ? Channel.value(file(params.blastn_COI)) : Channel.empty()
+          COI_ORIENTATION_INDEX ( ch_coi_reference )
+          ORIENT_COI ( ch_coi_for_blast.combine(COI_ORIENTATION_INDEX.out.index) )
+          //Only blast the consensus whose orientation could not be decided
+          ch_ambiguous = ORIENT_COI.out.ambiguous.branch { sampleid, fasta, target_gene ->
+            blast: fasta.size() > 0
+            oriented: true
+          }
+          BLASTN_COI ( ch_ambiguous.blast )
+          //Samples without ambiguous consensus pass their empty fasta as an empty list of ids, so that every sample
+          //has exactly two id files and is grouped as soon as both are ready
+          ch_no_blast_ids = ch_ambiguous.oriented.map { sampleid, fasta, target_gene -> tuple(sampleid, fasta) }
+          ch_revcomp_ids = ORIENT_COI.out.ids.mix(BLASTN_COI.out.coi_blast_results, ch_no_blast_ids).groupTuple(size: 2)
+        }
+        else {
+          //Blast to COI database
+          BLASTN_COI(ch_coi_for_blast)
+          ch_revcomp_ids = BLASTN_COI.out.coi_blast_results
+        }
         //Identify consensus that are in the wrong orientation and reverse complement them
-        ch_revcomp = (CUTADAPT.out.trimmed.join(BLASTN_COI.out.coi_blast_results))
+        ch_revcomp = (CUTADAPT.out.trimmed.join(ch_revcomp_ids))
         REVCOMP ( ch_revcomp )
         //Blast to NCBI nt database
         BLASTN ( REVCOMP.out.revcomp )
@@ -1207,8 +1418,6 @@ workflow {
 
         //Extract top blast hit, assign taxonomy information to identify consensus that match target organism
         EXTRACT_BLAST_HITS ( ch_blast_merged.join(ch_targets) )
-        //Add consensus sequence to blast results summary table
-        FASTA2TABLE ( EXTRACT_BLAST_HITS.out.topblast.join(consensus) )
 
         //MAPPING BACK TO CONSENSUS
         mapping2consensus_ch = (EXTRACT_BLAST_HITS.out.consensus_fasta_files.join(REFORMAT.out.cov_derivation_ch))
@@ -1219,16 +1428,21 @@ workflow {
         //Derive bed file for mosdepth to run coverage statistics
         PYFAIDX ( EXTRACT_BLAST_HITS.out.consensus_fasta_files )
         MOSDEPTH (SAMTOOLS_CONSENSUS.out.sorted_bams.join(PYFAIDX.out.bed))
-        SEQTK (SAMTOOLS_CONSENSUS.out.contig_seqids.join(final_fq))
-        //Derive summary file presenting coverage statistics alongside blast results
+        //Bin the read depth along each consensus for the sparklines of the HTML report
+        DEPTH_PROFILE (MOSDEPTH.out.per_base)
+        //Read lengths of the mapped reads for the read length QC
+        MAPPED_READS (SAMTOOLS_CONSENSUS.out.sorted_bams)
+        //Add the consensus sequences and coverage statistics to the blast results summary table in a single step
         cov_stats_summary_ch = MOSDEPTH.out.mosdepth_results.join(EXTRACT_BLAST_HITS.out.consensus_fasta_files)
                                                              .join(SAMTOOLS_CONSENSUS.out.coverage)
                                                              .join(SAMTOOLS_CONSENSUS.out.mapping_quality)
-                                                             .join(FASTA2TABLE.out.blast_results)
+                                                             .join(EXTRACT_BLAST_HITS.out.topblast)
+                                                             .join(consensus)
                                                              .join(QC_POST_DATA_PROCESSING.out.filtstats)
                                                              .join(ch_target_size)
-                                                             .join(SEQTK.out.fasta)
-                                                             .join(SEQTK.out.contig_seqids)
+                                                             .join(MAPPED_READS.out.read_lengths)
+                                                             .join(SAMTOOLS_CONSENSUS.out.consensus_quality)
+                                                             .join(ch_resources)
 
         COVSTATS(cov_stats_summary_ch)
 
@@ -1237,16 +1451,24 @@ workflow {
                                                                                 .join(CUTADAPT.out.trimmed)
                                                                                 .join(ch_blast_merged)
                                                                                 .join(SAMTOOLS_CONSENSUS.out.sorted_bams)
-                                                                                .join(COVSTATS.out.detections_summary))
+                                                                                .join(COVSTATS.out.detections_summary)
+                                                                                .join(DEPTH_PROFILE.out.depth_profile))
         files_for_report_global_ch = TIMESTAMP_START.out.timestamp
             .concat(QCREPORT.out.qc_report_html)
             .concat(QCREPORT.out.qc_report_txt)
+            .concat(QCREPORT.out.run_store)
             .concat(configyaml)
-            .concat(Channel.from(params.samplesheet).map { file(it) }).toList()
+            .concat(Channel.from(params.samplesheet).map { file(it) })
+            .concat(Channel.of(file(params.trace_file))).toList()
 
         HTML_REPORT(files_for_report_ind_samples_ch
             .combine(files_for_report_global_ch))
 
+        //Aggregate the flagged blast hits, run QC and stage timings of all samples in a single store and overview page
+        RUN_SUMMARY(COVSTATS.out.detections_summary2.collect(),
+                    QCREPORT.out.qc_report_txt,
+                    EXTRACT_BLAST_HITS.out.metrics.mix(COVSTATS.out.metrics, DEPTH_PROFILE.out.metrics, MAPPED_READS.out.metrics).collect().ifEmpty([]))
+
         //MAPPING BACK TO REFERENCE
         if (params.mapping_back_to_ref) {
           mapping_ch = (EXTRACT_BLAST_HITS.out.reference_fasta_files.join(REFORMAT.out.cov_derivation_ch))
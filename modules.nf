@@ -26,6 +26,7 @@ process NANOPLOT {
   publishDir "${params.outdir}/${sampleid}/01_QC/nanoplot",  pattern: '{*NanoPlot-report.html}', mode: 'link'
   publishDir "${params.outdir}/${sampleid}/01_QC/nanoplot",  pattern: '{*NanoStats.txt}', mode: 'link'
   publishDir "${params.outdir}/${sampleid}/01_QC/nanoplot",  pattern: '{*LengthvsQualityScatterPlot_dot.html}', mode: 'link'
+  publishDir "${params.outdir}/${sampleid}/01_QC/nanoplot",  pattern: '{*LengthHistogram.txt}', mode: 'link'
   tag "${sampleid}"
   label "setting_2"
 
@@ -35,6 +36,7 @@ process NANOPLOT {
     path("*NanoPlot-report.html"), optional: true
     path("*NanoStats.txt"), optional: true
     path("*LengthvsQualityScatterPlot_dot.html"), optional: true
+    path("*LengthHistogram.txt"), optional: true
     path("*NanoStats.txt"), emit: read_counts
     tuple val(sampleid), path("${sampleid}_filtered_NanoStats.txt"), emit: filtstats, optional: true
     tuple val(sampleid), path("${sampleid}_raw_NanoPlot-report.html"), emit: rawnanoplot, optional: true
@@ -43,20 +45,24 @@ process NANOPLOT {
   
   script:
   def fastq = sample.getBaseName() + ".fastq.gz"
+  //When the NanoPlot report is not required, only derive the read statistics with `ont_amplicon fastq-stats`
+  def stats_command = (params.nanoplot) ? "NanoPlot -t ${task.cpus} --fastq ${sample} --plots dot --N50 --tsv_stats --prefix" : "ont_amplicon fastq-stats --threads ${task.cpus} --fastq ${sample} --prefix"
   """
   
   if [[ ${sample} == *trimmed.fastq.gz ]] || [[ ${sample} == *filtered.fastq.gz ]] ;
   then
     if [ -n "\$(gunzip < ${sample} | head -n 1 | tr '\0\n' __)" ];
     then
-        NanoPlot -t ${task.cpus} --fastq ${sample} --prefix ${sampleid}_filtered_ --plots dot --N50 --tsv_stats
+        ${stats_command} ${sampleid}_filtered_
     else
         echo "Metrics dataset\nnumber_of_reads\t0" > ${sampleid}_filtered_NanoStats.txt
-        touch ${sampleid}_filtered_LengthvsQualityScatterPlot_dot.html
-        touch ${sampleid}_filtered_NanoPlot-report.html
     fi
+    touch ${sampleid}_filtered_LengthvsQualityScatterPlot_dot.html
+    touch ${sampleid}_filtered_NanoPlot-report.html
   else
-    NanoPlot -t ${task.cpus} --fastq ${sample} --prefix ${sampleid}_raw_ --plots dot --N50 --tsv_stats
+    ${stats_command} ${sampleid}_raw_
+    touch ${sampleid}_raw_LengthvsQualityScatterPlot_dot.html
+    touch ${sampleid}_raw_NanoPlot-report.html
   fi
   """
 }